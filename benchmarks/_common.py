@@ -0,0 +1,67 @@
+"""Общие заготовки бенчмарков: синтетические пользователи и окружение бота.
+
+Бенчмарки импортируют бота только после configure_environment: все данные
+(users_data.json, журналы, архивы) создаются во временном каталоге, а не
+рядом с tgbotAltShift.py.
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def synthetic_users(count: int, seed: int = 42):
+    """Генерирует пары (user_id, данные) в формате users_data.json"""
+    rng = random.Random(seed)
+    base = int(time.time()) - 365 * 86400
+    for i in range(count):
+        joined = base + rng.randrange(365 * 86400)
+        yield str(1_000_000_000 + i * 7), {
+            "username": f"user{i}" if i % 5 else "без username",
+            "first_name": f"Имя{i}",
+            "last_name": "",
+            "join_date": time.strftime(DATETIME_FORMAT, time.localtime(joined)),
+            "downloads": rng.randrange(4),
+            "last_active": time.strftime(DATETIME_FORMAT, time.localtime(joined + rng.randrange(86400)))
+        }
+
+
+def write_users_file(path: str, count: int):
+    """Записывает users_data.json на count пользователей, не собирая его в памяти"""
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("{")
+        for i, (user_id, data) in enumerate(synthetic_users(count)):
+            f.write(("," if i else "") + json.dumps(user_id) + ": " + json.dumps(data, ensure_ascii=False))
+        f.write("}")
+
+
+def make_workdir(users: int = 0) -> str:
+    """Создает временный каталог данных, при users > 0 - с users_data.json"""
+    workdir = tempfile.mkdtemp(prefix="tgbot-bench-")
+    if users:
+        write_users_file(os.path.join(workdir, "users_data.json"), users)
+    return workdir
+
+
+def configure_environment(workdir: str, storage: str = "json", **overrides: str):
+    """Настраивает окружение бота на каталог workdir; вызывается до импорта бота.
+
+    Бот работает в режиме webhook и без файла журнала, поэтому при импорте
+    не обращается к Telegram и не пишет bot.log рядом с кодом.
+    """
+    os.environ.update({
+        "DATA_DIR": workdir,
+        "ZIP_FILE_PATH": os.path.join(workdir, "AltShift_Fast.zip"),
+        "USER_STORAGE": storage,
+        "BOT_MODE": "webhook",
+        "LOG_FILE": "",
+    })
+    os.environ.update(overrides)
@@ -0,0 +1,63 @@
+"""Бенчмарк главной страницы: рендер на каждый запрос против кэша с ETag.
+
+Бот работает на временном каталоге данных с синтетическими пользователями,
+рабочие users_data.json и журналы не затрагиваются.
+
+Запуск: python benchmarks/bench_dashboard.py [число запросов] [число пользователей]
+"""
+import sys
+import time
+
+from _common import configure_environment, make_workdir
+
+configure_environment(make_workdir(int(sys.argv[2]) if len(sys.argv) > 2 else 10000))
+
+from flask import render_template_string  # noqa: E402
+
+import tgbotAltShift as bot_module  # noqa: E402
+
+
+@bot_module.app.route('/_bench/legacy_home')
+def legacy_home():
+    """Прежняя реализация: шаблон разбирается и компилируется на каждый запрос"""
+    stats = bot_module.user_manager.get_statistics()
+    return render_template_string(
+        bot_module.HOME_TEMPLATE_SOURCE,
+        total_users=stats["total_users"],
+        active_today=stats["active_today"],
+        total_downloads=stats["total_downloads"],
+        last_updated=stats["last_updated"],
+        start_time=bot_module.bot_status["last_start"] or "Неизвестно",
+        error_count=bot_module.bot_status["error_count"],
+        zip_available=bot_module.release_manager.get_current() is not None
+    )
+
+
+def measure(client, path: str, requests: int, headers=None) -> float:
+    """Возвращает число запросов в секунду"""
+    client.get(path, headers=headers)
+    started = time.perf_counter()
+    for _ in range(requests):
+        client.get(path, headers=headers)
+    return requests / (time.perf_counter() - started)
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    bot_module.startup.wait()
+    client = bot_module.app.test_client()
+    etag = client.get('/').headers['ETag']
+
+    results = [
+        ("render_template_string на каждый запрос", measure(client, '/_bench/legacy_home', requests)),
+        ("кэшированная страница (200)", measure(client, '/', requests)),
+        ("условный запрос If-None-Match (304)", measure(client, '/', requests, {'If-None-Match': etag})),
+    ]
+    print(f"Запросов на вариант: {requests}, пользователей: {bot_module.user_manager.get_total_users()}")
+    for name, rps in results:
+        print(f"{name:45s} {rps:10.0f} запросов/с")
+    print(f"Данные бенчмарка: {bot_module.DATA_DIR}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""Бенчмарк выгрузки и загрузки пользователей.
+
+Заполняет хранилище заданным числом пользователей и замеряет время и
+прирост памяти процесса (пик RSS относительно начала) для:
+
+* прежнего способа - весь список пользователей собирается в памяти и
+  сериализуется одним json.dumps, как при чтении users_data.json целиком;
+* потоковой выгрузки /export/users в NDJSON и CSV (тело читается через
+  тестовый клиент Flask по частям; NDJSON сохраняется в файл для загрузки);
+* загрузки выгрузки NDJSON через /import/users в пустое хранилище.
+
+Запуск: python benchmarks/bench_export.py --users 1000000 --storage json
+"""
+import argparse
+import json
+import os
+import threading
+import time
+
+import psutil
+
+from _common import configure_environment, make_workdir
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200000, help="число пользователей в хранилище")
+    parser.add_argument("--storage", choices=("json", "sqlite"), default="json")
+    return parser.parse_args()
+
+
+class PeakMemory:
+    """Следит за RSS процесса в фоне и запоминает максимум"""
+
+    def __init__(self):
+        self.process = psutil.Process()
+        self.stop_event = threading.Event()
+
+    def __enter__(self):
+        self.start = self.peak = self.process.memory_info().rss
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def _sample(self):
+        while not self.stop_event.wait(0.005):
+            self.peak = max(self.peak, self.process.memory_info().rss)
+
+    def __exit__(self, *exc):
+        self.stop_event.set()
+        self.thread.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+
+    @property
+    def growth_mb(self) -> float:
+        return (self.peak - self.start) / (1024 * 1024)
+
+
+def measure(name: str, func):
+    with PeakMemory() as memory:
+        started = time.perf_counter()
+        size = func()
+        elapsed = time.perf_counter() - started
+    print(f"{name:>18} {elapsed:9.2f} {size / (1024 * 1024):10.1f} {memory.growth_mb:12.1f}")
+
+
+def main():
+    args = parse_args()
+    workdir = make_workdir(args.users)
+    configure_environment(workdir, args.storage, ADMIN_TOKEN="bench")
+
+    import logging
+    logging.disable(logging.INFO)
+    import tgbotAltShift as bot_module
+    bot_module.startup.wait()
+    user_manager = bot_module.user_manager
+    client = bot_module.app.test_client()
+    headers = {"X-Admin-Token": "bench"}
+
+    def legacy():
+        users = {user_id: user_manager.get_user(user_id) for _, user_id in user_manager.iter_user_ids()}
+        return len(json.dumps(users, ensure_ascii=False))
+
+    def stream(fmt, path=None):
+        response = client.get(f"/export/users?format={fmt}", headers=headers, buffered=False)
+        size = 0
+        out = open(path, "wb") if path else None
+        for chunk in response.response:
+            size += len(chunk)
+            if out:
+                out.write(chunk)
+        if out:
+            out.close()
+        response.close()
+        return size
+
+    export_path = os.path.join(workdir, "export.ndjson")
+    print(f"Пользователей: {user_manager.get_total_users()}, хранилище: {args.storage}")
+    print(f"{'способ':>18} {'время, с':>9} {'объем, МБ':>10} {'прирост, МБ':>12}")
+    # Потоковые способы идут первыми: память, освобожденная после сборки в
+    # памяти, осталась бы у процесса и скрыла их прирост
+    measure("поток NDJSON", lambda: stream("ndjson", export_path))
+    measure("поток CSV", lambda: stream("csv"))
+    measure("в памяти", legacy)
+
+    # Загрузка в пустое хранилище того же типа
+    if args.storage == "sqlite":
+        target = bot_module.SQLiteUserManager(os.path.join(workdir, "import.db"))
+    else:
+        target = bot_module.UserManager(os.path.join(workdir, "import.json"))
+    user_manager.set_instance(target)
+
+    def load():
+        with open(export_path, "rb") as f:
+            # input_stream отдается приложению как есть - тестовый клиент не копирует тело
+            response = client.post("/import/users?format=ndjson", headers=headers, input_stream=f,
+                                   content_length=os.path.getsize(export_path),
+                                   content_type="application/x-ndjson")
+        assert response.status_code == 200, response.get_data(as_text=True)
+        return os.path.getsize(export_path)
+
+    measure("импорт NDJSON", load)
+    print(f"Загружено пользователей: {target.get_total_users()}")
+    target.close()
+    print(f"Данные бенчмарка: {workdir}")
+
+
+if __name__ == "__main__":
+    main()
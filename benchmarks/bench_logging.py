@@ -0,0 +1,102 @@
+"""Бенчмарк журнала: запись в файл из потока обработчика против очереди.
+
+Несколько потоков пишут одинаковые записи двумя способами и замеряют,
+сколько времени вызов logger.info занимает в самом потоке:
+
+* прежний - f-строка, StreamHandler и FileHandler прямо в потоке;
+* текущий - %-аргументы и DeferredQueueHandler бота; форматирование JSON,
+  запись на диск и ротацию выполняет фоновый QueueListener.
+
+Консольный вывод обоих вариантов уходит в /dev/null. Для текущего
+варианта отдельно выводится время, за которое слушатель дописал очередь.
+
+Запуск: python benchmarks/bench_logging.py --threads 4 --calls 20000
+"""
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+
+from _common import configure_environment, make_workdir
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=4, help="потоков, пишущих в журнал")
+    parser.add_argument("--calls", type=int, default=20000, help="записей на поток")
+    parser.add_argument("--sample-rate", type=float, default=1.0, help="LOG_SAMPLE_RATE текущего варианта")
+    return parser.parse_args()
+
+
+def percentile(samples, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else 0.0
+
+
+def run_threads(threads: int, calls: int, log_call):
+    """Запускает потоки и возвращает время каждого вызова в микросекундах"""
+    samples = [[] for _ in range(threads)]
+
+    def worker(index):
+        own = samples[index]
+        for i in range(calls):
+            started = time.perf_counter()
+            log_call(index * calls + i)
+            own.append((time.perf_counter() - started) * 1e6)
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return [sample for own in samples for sample in own]
+
+
+def main():
+    args = parse_args()
+    workdir = make_workdir()
+    devnull = open(os.devnull, "w", encoding="utf-8")
+
+    legacy_logger = logging.getLogger("legacy")
+    legacy_logger.propagate = False
+    legacy_logger.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    for handler in (logging.StreamHandler(devnull),
+                    logging.FileHandler(os.path.join(workdir, "legacy.log"), encoding="utf-8")):
+        handler.setFormatter(formatter)
+        legacy_logger.addHandler(handler)
+
+    def legacy_call(user_id):
+        legacy_logger.info(f"Пользователь {user_id} скачал приложение")
+
+    configure_environment(workdir, LOG_FILE=os.path.join(workdir, "bot.log"),
+                          LOG_SAMPLE_RATE=str(args.sample_rate))
+    # Консольный обработчик бота запоминает sys.stderr при импорте
+    stderr = sys.stderr
+    sys.stderr = devnull
+    try:
+        import tgbotAltShift as bot_module
+        bot_module.startup.wait()
+    finally:
+        sys.stderr = stderr
+    logger = bot_module.logger
+
+    def current_call(user_id):
+        logger.info("Пользователь %s скачал приложение", user_id, extra={"sampled": True})
+
+    print(f"Потоков: {args.threads}, записей на поток: {args.calls}, доля выборки: {args.sample_rate}")
+    print(f"{'вариант':>10} {'среднее, мкс':>13} {'p50, мкс':>9} {'p99, мкс':>9} {'макс, мкс':>10}")
+    for name, call in (("прежний", legacy_call), ("текущий", current_call)):
+        samples = run_threads(args.threads, args.calls, call)
+        print(f"{name:>10} {sum(samples) / len(samples):13.1f} {percentile(samples, 0.5):9.1f} "
+              f"{percentile(samples, 0.99):9.1f} {max(samples):10.1f}")
+    started = time.perf_counter()
+    bot_module.log_listener.stop()
+    print(f"Слушатель дописал очередь за {time.perf_counter() - started:.3f} с")
+    print(f"Данные бенчмарка: {workdir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""Бенчмарк памяти: байт на пользователя для словарей и для UserRecord.
+
+Оба варианта строятся из одного и того же JSON, как при загрузке
+users_data.json, и учитывают все объекты (ключи, строки дат, числа).
+Каждый вариант измеряется в отдельном процессе через tracemalloc. Бот
+импортируется в обоих вариантах до начала замера и с данными во временном
+каталоге, поэтому его модули и служебные потоки в результат не попадают.
+Ограниченный кэш разбора дат (_ten_minutes_timestamp) к записям не
+относится и очищается перед замером.
+Запуск: python benchmarks/bench_memory.py [число пользователей ...]
+"""
+import json
+import subprocess
+import sys
+import tracemalloc
+
+import _common as common
+from _common import ROOT, synthetic_users
+
+
+def measure(variant: str, count: int) -> int:
+    """Строит хранилище выбранного вида и возвращает занятую им память в байтах"""
+    # Хранилища загружаются при импорте, без фонового потока запуска
+    common.configure_environment(common.make_workdir(), STARTUP_BACKGROUND="0")
+    import logging
+    logging.disable(logging.INFO)
+    from tgbotAltShift import UserRecord, _ten_minutes_timestamp
+    source = json.dumps(dict(synthetic_users(count)), ensure_ascii=False)
+    tracemalloc.start()
+    if variant == "dicts":
+        users = json.loads(source)
+    else:
+        users = {int(user_id): UserRecord.from_json(user_id, data)
+                 for user_id, data in json.loads(source).items()}
+        _ten_minutes_timestamp.cache_clear()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(users) == count
+    return size
+
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == "--child":
+        print(measure(sys.argv[2], int(sys.argv[3])))
+        return
+
+    counts = [int(arg) for arg in sys.argv[1:]] or [100_000, 1_000_000]
+    print(f"{'пользователей':>14} {'dict, Б/польз.':>16} {'UserRecord, Б/польз.':>22} {'экономия':>9}")
+    for count in counts:
+        results = {}
+        for variant in ("dicts", "records"):
+            output = subprocess.run(
+                [sys.executable, __file__, "--child", variant, str(count)],
+                check=True, capture_output=True, text=True, cwd=ROOT
+            ).stdout
+            results[variant] = int(output.strip().splitlines()[-1]) / count
+        saving = 1 - results["records"] / results["dicts"]
+        print(f"{count:>14} {results['dicts']:>16.0f} {results['records']:>22.0f} {saving:>8.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""Нагрузочный бенчмарк: синтетические обновления Telegram без сети.
+
+Генерирует поток telebot.types.Update (/start, /stats, /download, текст)
+для заданного числа пользователей и прогоняет его через обработчики бота
+двумя путями:
+
+* polling - PollingEngine забирает пачки через getUpdates и отдает их
+  UpdateDispatcher;
+* webhook - POST /webhook через тестовый клиент Flask и UpdateDispatcher.
+
+HTTP API Telegram подменяется заглушкой (apihelper.CUSTOM_REQUEST_SENDER и
+сессия requests для потоковой загрузки архива),
+данные пишутся во временный каталог. Выводятся обновлений в секунду,
+p50/p99 времени обработки и объем записанных на диск данных.
+
+Запуск: python benchmarks/bench_replay.py --users 1000 --updates 5000
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+import zipfile
+
+import _common as common
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000, help="число разных пользователей")
+    parser.add_argument("--updates", type=int, default=5000, help="число обновлений в каждом прогоне")
+    parser.add_argument("--mix", default="start=0.3,stats=0.1,download=0.2,text=0.4",
+                        help="доли типов обновлений")
+    parser.add_argument("--mode", choices=("polling", "webhook", "both"), default="both")
+    parser.add_argument("--storage", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--threads", type=int, default=4, help="потоков обработки UpdateDispatcher")
+    parser.add_argument("--api-latency-ms", type=float, default=0.0, help="задержка ответа заглушки API")
+    parser.add_argument("--zip-mb", type=float, default=1.0, help="размер тестового архива")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+def configure_environment(args, workdir: str):
+    """Настраивает окружение до импорта бота: временные данные и без ограничений скорости"""
+    zip_path = os.path.join(workdir, "AltShift_Fast.zip")
+    # Бот публикует только целые ZIP-архивы; содержимое сохраняется без сжатия
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_STORED) as archive:
+        archive.writestr("AltShift_Fast.exe", os.urandom(int(args.zip_mb * 1024 * 1024)))
+    # Архив "давно" не менялся, поэтому публикация не ждет его успокоения
+    old = time.time() - 3600
+    os.utime(zip_path, (old, old))
+    # Обработчики выполняются синхронно в потоках бенчмарка и UpdateDispatcher
+    common.configure_environment(
+        workdir, args.storage,
+        UPDATE_WORKERS=str(args.threads),
+        UPDATE_QUEUE_SIZE=str(max(args.updates, 1000)),
+        OUTBOUND_GLOBAL_RATE="1000000",
+        OUTBOUND_CHAT_RATE="1000000",
+        OUTBOUND_CHAT_BURST="1000000",
+        # Синтетический поток не должен упираться в ограничение частоты на пользователя
+        USER_RATE_LIMIT="1000000",
+        LOG_FILE=os.path.join(workdir, "bot.log"),
+    )
+    os.chdir(workdir)
+
+
+class TelegramApiStub:
+    """Заглушка HTTP API Telegram: отвечает успешно, не обращаясь к сети"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.ids = itertools.count(1)
+        self.calls = 0
+        self.documents = 0
+        self.lock = threading.Lock()
+        # Обновления, которые отдает getUpdates (как Telegram - начиная с offset)
+        self.updates = []
+
+    def __call__(self, method, url, params=None, files=None, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        if api_method == "getUpdates":
+            return self.get_updates(params or {})
+        with self.lock:
+            self.calls += 1
+            self.documents += api_method == "sendDocument"
+        if self.latency:
+            time.sleep(self.latency)
+        result = True
+        if api_method in ("sendMessage", "sendDocument"):
+            chat_id = int((params or {}).get("chat_id", 0))
+            result = {"message_id": next(self.ids), "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "private"}}
+            if api_method == "sendDocument":
+                result["document"] = {"file_id": "stub-file-id", "file_unique_id": "stub"}
+        return _StubResponse({"ok": True, "result": result})
+
+    def post(self, url, data=None, **kwargs):
+        """Сессия requests для ScheduledTeleBot.upload_document: тело читается потоком"""
+        chat_id = 0
+        for chunk in data:
+            match = _CHAT_ID_FIELD.search(chunk) if not chat_id else None
+            if match:
+                chat_id = int(match.group(1))
+        return self(None, url, params={"chat_id": chat_id})
+
+    def get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        batch = [update for update in self.updates if update["update_id"] >= offset][:limit]
+        if not batch:
+            # Long polling без новых обновлений
+            time.sleep(0.01)
+        return _StubResponse({"ok": True, "result": batch})
+
+
+_CHAT_ID_FIELD = re.compile(rb'name="chat_id"\r\n\r\n(-?\d+)')
+
+
+class _StubResponse:
+    status_code = 200
+    reason = "OK"
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.text = json.dumps(payload)
+
+    def json(self):
+        return self.payload
+
+
+def parse_mix(args):
+    """Разбирает --mix в пары (тип обновления, доля)"""
+    return [(name, float(share)) for name, share in (item.split("=") for item in args.mix.split(","))]
+
+
+def generate_updates(args, start_id: int):
+    """Генерирует словари обновлений в формате Bot API"""
+    rng = random.Random(args.seed + start_id)
+    mix = parse_mix(args)
+    names = [name for name, _ in mix]
+    weights = [share for _, share in mix]
+    for update_id in range(start_id, start_id + args.updates):
+        user_id = 100000 + rng.randrange(args.users)
+        kind = rng.choices(names, weights)[0]
+        text = "привет, бот" if kind == "text" else f"/{kind}"
+        message = {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}",
+                     "username": f"user{user_id}"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}] if kind != "text" else []
+        }
+        yield {"update_id": update_id, "message": message}
+
+
+def percentile(samples, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else 0.0
+
+
+def written_bytes(process) -> int:
+    counters = process.io_counters()
+    return getattr(counters, "write_chars", counters.write_bytes)
+
+
+def run_polling(bot_module, stub, updates, samples):
+    """Путь опроса: PollingEngine и ожидание, пока UpdateDispatcher все обработает"""
+    dispatcher = bot_module.update_dispatcher
+    expected = dispatcher.processed + dispatcher.failed + len(updates)
+    stub.updates = updates
+    engine = threading.Thread(target=bot_module.polling_engine.run, daemon=True)
+    engine.start()
+    while dispatcher.processed + dispatcher.failed < expected:
+        time.sleep(0.005)
+    bot_module.polling_engine.stop()
+    engine.join()
+
+
+def run_webhook(bot_module, stub, updates, samples):
+    """Путь webhook: POST /webhook и ожидание, пока UpdateDispatcher все обработает"""
+    client = bot_module.app.test_client()
+    dispatcher = bot_module.update_dispatcher
+    expected = dispatcher.processed + dispatcher.failed + len(updates)
+    for update in updates:
+        response = client.post("/webhook", data=json.dumps(update), content_type="application/json")
+        if response.status_code != 200:
+            raise RuntimeError(f"webhook вернул {response.status_code}")
+    while dispatcher.processed + dispatcher.failed < expected:
+        time.sleep(0.005)
+
+
+def main():
+    args = parse_args()
+    workdir = common.make_workdir()
+    configure_environment(args, workdir)
+
+    import psutil
+    from telebot import apihelper
+
+    stub = TelegramApiStub(args.api_latency_ms / 1000)
+    apihelper.CUSTOM_REQUEST_SENDER = stub
+    # Архивы бот загружает потоком через сессию requests, минуя CUSTOM_REQUEST_SENDER
+    apihelper._get_req_session = lambda reset=False: stub
+
+    import tgbotAltShift as bot_module
+    logging.getLogger().setLevel(logging.WARNING)
+    # Пока хранилища загружаются, /webhook отвечает 503
+    bot_module.startup.wait()
+    # Архив публикует лидер, а бенчмарк не запускает службы лидера
+    bot_module.publish_release()
+
+    samples = []
+    samples_lock = threading.Lock()
+    process_updates = bot_module.bot.process_new_updates
+
+    def timed_process(updates):
+        started = time.perf_counter()
+        process_updates(updates)
+        elapsed = time.perf_counter() - started
+        with samples_lock:
+            samples.append(elapsed)
+
+    bot_module.bot.process_new_updates = timed_process
+
+    modes = ("polling", "webhook") if args.mode == "both" else (args.mode,)
+    runners = {"polling": run_polling, "webhook": run_webhook}
+    process = psutil.Process()
+
+    print(f"Пользователей: {args.users}, обновлений на прогон: {args.updates}, "
+          f"хранилище: {args.storage}, потоков: {args.threads}, смесь: {args.mix}")
+    print(f"{'режим':>8} {'обновл./с':>10} {'p50, мс':>9} {'p99, мс':>9} {'вызовов API':>12} {'записано, КБ':>13}")
+    next_update_id = 1
+    for mode in modes:
+        updates = list(generate_updates(args, next_update_id))
+        next_update_id += len(updates)
+        samples.clear()
+        calls_before = stub.calls
+        written_before = written_bytes(process)
+        started = time.perf_counter()
+        runners[mode](bot_module, stub, updates, samples)
+        bot_module.user_manager.flush()
+        elapsed = time.perf_counter() - started
+        written = written_bytes(process) - written_before
+        print(f"{mode:>8} {len(updates) / elapsed:>10.0f} {percentile(samples, 0.5) * 1000:>9.2f} "
+              f"{percentile(samples, 0.99) * 1000:>9.2f} {stub.calls - calls_before:>12} {written / 1024:>13.1f}")
+
+    if dict(parse_mix(args)).get("download", 0) > 0:
+        # Без опубликованного архива /download отвечает текстом и загрузка не замеряется
+        assert stub.documents, "ни одного sendDocument: архив не опубликован"
+    storage = bot_module.user_manager.get_persistence_statistics()
+    print(f"Сохранение: пачек {storage['flushes']}, изменений {storage['flushed_changes']}, "
+          f"средняя пачка {storage['avg_batch_size']}, среднее время {storage['avg_flush_ms']} мс")
+    print(f"Данные бенчмарка: {workdir}")
+
+
+if __name__ == "__main__":
+    main()
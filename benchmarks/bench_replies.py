@@ -0,0 +1,181 @@
+"""Бенчмарк текстов ответов: сборка на каждое сообщение против кэша шаблонов.
+
+Замеряет процессорное время одного вызова обработчиков /start, /stats,
+/help и текстового сообщения в двух вариантах:
+
+* прежний - многострочные f-строки и подсчет статистики на каждое сообщение;
+* текущий - статические тексты собраны при импорте, блок статистики
+  берется из ReplyCache.
+
+Обработчики вызываются напрямую (без ограничения частоты и метрик), а
+bot.reply_to подменяется сбором текста, поэтому сеть не нужна. Перед
+замером проверяется, что оба варианта отвечают одинаково.
+
+Запуск: python benchmarks/bench_replies.py --users 100000 --calls 20000
+"""
+import argparse
+import time
+from datetime import datetime
+
+from _common import configure_environment, make_workdir
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100000, help="число пользователей в хранилище")
+    parser.add_argument("--calls", type=int, default=20000, help="вызовов каждого обработчика")
+    parser.add_argument("--storage", choices=("json", "sqlite"), default="json")
+    return parser.parse_args()
+
+
+def legacy_send_welcome(bot_module, message):
+    user_manager = bot_module.user_manager
+    user_id = str(message.from_user.id)
+    username = message.from_user.username or "без username"
+    first_name = message.from_user.first_name or ""
+    last_name = message.from_user.last_name or ""
+    user_manager.add_user(user_id, username, first_name, last_name)
+    welcome_text = f"""
+👋 Привет, {first_name}!
+
+Я бот для распространения приложения -AltShift-.
+
+📊 Статистика на данный момент:
+• Всего пользователей: {user_manager.get_total_users()}
+• Активных сегодня: {user_manager.get_active_today()}
+
+✨ Доступные команды:
+/start - Приветственное сообщение
+/stats - Показать статистику
+/download - Скачать приложение
+/help - Помощь и инструкции
+
+📱 Для связи с разработчиком: https://t.me/theEvil429
+    """
+    bot_module.bot.reply_to(message, welcome_text)
+
+
+def legacy_show_stats(bot_module, message):
+    user_manager = bot_module.user_manager
+    user_manager.touch(str(message.from_user.id))
+    limit = bot_module.TOP_DOWNLOADERS_DEFAULT
+    cache_stats = bot_module.file_cache.get_statistics()
+    stats_text = f"""
+📈 СТАТИСТИКА БОТА:
+
+👥 Пользователи:
+• Всего зарегистрировано: {user_manager.get_total_users()}
+• Активных сегодня: {user_manager.get_active_today()}
+
+📥 Скачивания приложения:
+• Всего скачиваний: {user_manager.get_total_downloads()}
+
+🏆 Топ-{limit} скачивающих:
+{bot_module.get_top_downloaders(limit)}
+
+📦 Кэш файла приложения:
+• Попаданий: {cache_stats["hits"]}
+• Промахов: {cache_stats["misses"]}
+
+🔄 Бот обновлен: {datetime.now().strftime("%d.%m.%Y %H:%M")}
+    """
+    bot_module.bot.reply_to(message, stats_text)
+
+
+def legacy_send_help(bot_module, message):
+    help_text = """
+🆘 ПОМОЩЬ И ИНСТРУКЦИИ
+
+📋 Основные команды:
+/start - Начать работу с ботом
+/stats - Статистика пользователей
+/download - Скачать приложение
+/help - Эта справка
+
+📥 Как установить приложение:
+1. Используйте команду /download
+2. Сохраните архив на компьютер
+3. Распакуйте архив программой WinRAR или 7-Zip
+4. Запустите файл .exe из распакованной папки
+
+⚠️ Возможные проблемы:
+• Антивирус блокирует файл - добавьте в исключения
+• Файл не запускается - установите Microsoft Visual C++ Redistributable
+• Архив поврежден - попробуйте скачать заново
+
+💬 Техническая поддержка:
+По всем вопросам пишите: https://t.me/theEvil429
+
+🌐 Дополнительные ресурсы:
+• GitHub: https://github.com/Fgmod/AltShift-v1.0.0
+    """
+    bot_module.bot.reply_to(message, help_text)
+
+
+def legacy_handle_text(bot_module, message):
+    response = f"Привет, {message.from_user.first_name}! 👋\n\n"
+    response += "Я понимаю только команды. Попробуйте:\n"
+    response += "/start - для начала работы\n"
+    response += "/help - для получения справки"
+    bot_module.bot.reply_to(message, response)
+
+
+def make_message(bot_module, text: str):
+    user_id = 100001
+    return bot_module.telebot.types.Message.de_json({
+        "message_id": 1,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "User1", "username": "user1"},
+        "text": text
+    })
+
+
+def cpu_per_call(func, calls: int) -> float:
+    """Процессорное время одного вызова в микросекундах"""
+    func()
+    started = time.process_time()
+    for _ in range(calls):
+        func()
+    return (time.process_time() - started) / calls * 1e6
+
+
+def main():
+    args = parse_args()
+    workdir = make_workdir(args.users)
+    configure_environment(workdir, args.storage)
+
+    import logging
+    logging.disable(logging.INFO)
+    import tgbotAltShift as bot_module
+
+    replies = []
+    bot_module.bot.reply_to = lambda message, text, **kwargs: replies.append(text)
+
+    cases = [
+        ("/start", legacy_send_welcome, bot_module.send_welcome, "/start"),
+        ("/stats", legacy_show_stats, bot_module.show_stats, "/stats"),
+        ("/help", legacy_send_help, bot_module.send_help, "/help"),
+        ("текст", legacy_handle_text, bot_module.handle_text, "привет"),
+    ]
+    print(f"Пользователей: {bot_module.user_manager.get_total_users()}, хранилище: {args.storage}, "
+          f"вызовов: {args.calls}")
+    print(f"{'обработчик':>10} {'прежний, мкс':>14} {'кэш, мкс':>10} {'ускорение':>10}")
+    for name, legacy, handler, text in cases:
+        message = make_message(bot_module, text)
+        # Обработчик без декоратора instrumented - без лимита частоты и метрик
+        current = handler.__wrapped__
+        replies.clear()
+        legacy(bot_module, message)
+        current(message)
+        if replies[0] != replies[1]:
+            raise SystemExit(f"Ответы на {name} различаются")
+        legacy_us = cpu_per_call(lambda: legacy(bot_module, message), args.calls)
+        current_us = cpu_per_call(lambda: current(message), args.calls)
+        replies.clear()
+        print(f"{name:>10} {legacy_us:14.1f} {current_us:10.1f} {legacy_us / current_us:9.1f}x")
+    print(f"Данные бенчмарка: {workdir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Бенчмарк холодного запуска: загрузка при импорте против фонового запуска.
+
+Готовит каталог данных с заданным числом пользователей и несколько раз запускает отдельный процесс, который импортирует бота в
+одном из режимов:
+
+* sync - STARTUP_BACKGROUND=0, хранилища загружаются при импорте (прежнее
+  поведение);
+* background - импорт возвращается сразу, хранилища загружаются в фоне.
+
+Для каждого запуска выводятся секунды от старта процесса до окончания
+импорта, до первого ответа /health и до готовности (/ready отвечает 200).
+Перед замером каталог один раз "прогревается" (миграция в SQLite), как у
+уже развернутого бота. Архив публикует процесс-лидер после запуска,
+поэтому в замер он не входит.
+
+Запуск: python benchmarks/bench_startup.py --users 1000000 --storage json
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from _common import write_users_file
+
+MODES = {"sync": "0", "background": "1"}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100000, help="число пользователей в хранилище")
+    parser.add_argument("--storage", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--runs", type=int, default=3, help="запусков каждого режима")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def prepare_template(args, template: str):
+    """Создает users_data.json и один раз запускает бота для прогрева"""
+    os.makedirs(template)
+    write_users_file(os.path.join(template, "users_data.json"), args.users)
+    run_child(args, template, "sync")
+
+
+def run_child(args, datadir: str, mode: str) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "DATA_DIR": datadir,
+        "ZIP_FILE_PATH": os.path.join(datadir, "AltShift_Fast.zip"),
+        "USER_STORAGE": args.storage,
+        "BOT_MODE": "webhook",
+        "STARTUP_BACKGROUND": MODES[mode],
+        "BENCH_STARTED": repr(time.time()),
+    })
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child"],
+        env=env, check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def child():
+    """Импортирует бота и замеряет время от запуска процесса до каждого этапа"""
+    import logging
+    # Время запуска передает родитель: оно включает старт интерпретатора
+    created = float(os.environ["BENCH_STARTED"])
+    logging.disable(logging.INFO)
+    import tgbotAltShift as bot_module
+    imported = time.time() - created
+    client = bot_module.app.test_client()
+    response = client.get("/health")
+    assert response.status_code == 200
+    health = time.time() - created
+    if not bot_module.startup.wait(bot_module.STARTUP_TIMEOUT):
+        raise SystemExit(f"Запуск не завершен: {bot_module.startup.error}")
+    assert client.get("/ready").status_code == 200
+    ready = time.time() - created
+    print(json.dumps({
+        "import": imported,
+        "health": health,
+        "ready": ready,
+        "stages": bot_module.startup.stages,
+        "users": bot_module.user_manager.get_total_users()
+    }))
+
+
+def main():
+    args = parse_args()
+    if args.child:
+        child()
+        return
+    workdir = tempfile.mkdtemp(prefix="tgbot-bench-")
+    template = os.path.join(workdir, "template")
+    prepare_template(args, template)
+
+    print(f"Пользователей: {args.users}, хранилище: {args.storage}, запусков: {args.runs}")
+    print(f"{'режим':>10} {'импорт, с':>10} {'/health, с':>11} {'готов, с':>9}  этапы")
+    for mode in MODES:
+        results = []
+        for run in range(args.runs):
+            datadir = os.path.join(workdir, f"{mode}-{run}")
+            shutil.copytree(template, datadir)
+            results.append(run_child(args, datadir, mode))
+            shutil.rmtree(datadir)
+        median = {key: statistics.median(r[key] for r in results) for key in ("import", "health", "ready")}
+        stages = {name: round(statistics.median(r["stages"][name] for r in results), 3)
+                  for name in results[0]["stages"]}
+        print(f"{mode:>10} {median['import']:10.3f} {median['health']:11.3f} {median['ready']:9.3f}  {stages}")
+    print(f"Данные бенчмарка: {workdir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""Конфигурация gunicorn для продакшен-режима бота.
+
+Запуск:
+    gunicorn -c gunicorn.conf.py tgbotAltShift:app
+
+Каждый процесс-воркер импортирует бота сам (без preload_app), поэтому у
+него свои потоки и соединение с базой. Общие данные пользователей лежат
+в SQLite, а опрос Telegram / регистрацию webhook выполняет ровно один
+процесс - тот, кто захватил блокировку лидера (см. start_bot_in_thread).
+"""
+import multiprocessing
+import os
+
+workers = int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count())))
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+worker_class = "gthread"
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+timeout = 60
+graceful_timeout = 30
+preload_app = False
+
+# Настройки читаются воркерами при импорте tgbotAltShift
+os.environ["WEB_CONCURRENCY"] = str(workers)
+os.environ.setdefault("BOT_MODE", "webhook")
+os.environ.setdefault("USER_STORAGE", "sqlite")
+# Лимит Telegram на исходящие сообщения общий для всех процессов
+os.environ.setdefault("OUTBOUND_GLOBAL_RATE", str(30 / workers))
+# Транзакция SQLite блокирует запись соседям, поэтому фиксируем ее чаще
+os.environ.setdefault("USERS_FLUSH_INTERVAL_MS", "50")
+# Ротация одного файла журнала из нескольких процессов теряет записи, поэтому
+# воркеры пишут журнал только в stdout, который собирает gunicorn
+if workers > 1:
+    os.environ.setdefault("LOG_FILE", "")
+
+
+def post_worker_init(worker):
+    """Запускает фоновые службы бота в каждом воркере"""
+    import tgbotAltShift
+    tgbotAltShift.start_bot_in_thread()
+
+
+def worker_exit(server, worker):
+    """Фиксирует несохраненные изменения перед остановкой воркера"""
+    import tgbotAltShift
+    # Воркер мог завершиться, не дождавшись загрузки пользователей
+    if tgbotAltShift.user_manager.ready:
+        tgbotAltShift.user_manager.flush()
@@ -1,13 +1,45 @@
 import telebot
 import os
 import json
+import hashlib
+import hmac
+import heapq
 import logging
-from datetime import datetime
-from typing import Dict, Any
-from flask import Flask, request, jsonify, render_template_string
+import logging.handlers
+import gzip
+import re
+from datetime import datetime, timezone, timedelta
+from typing import Dict, Any, Optional, List, Tuple, Iterator, Iterable
+from collections.abc import Mapping
+import sqlite3
+from flask import Flask, Response, request, jsonify, make_response, has_request_context
+from werkzeug.exceptions import ServiceUnavailable
 import threading
+import queue
+import random
+import itertools
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+import atexit
 import time
+import functools
+import shutil
+import copy
+import csv
+import io
+import struct
+import zipfile
+import psutil
 from dotenv import load_dotenv
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: межпроцессные блокировки не нужны, процесс всегда один
+    fcntl = None
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -22,15 +54,160 @@ bot_status = {
     "error_count": 0
 }
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('bot.log', encoding='utf-8')
-    ]
-)
+# Настройка логирования: обработчики сообщений только кладут записи в
+# очередь, а форматирует и пишет их фоновый поток QueueListener
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Пустой LOG_FILE - только вывод в консоль
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+# Формат файла журнала: "json" (по записи на строку) или "text"
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+# Ротация по размеру (LOG_MAX_BYTES) или, если задан LOG_ROTATE_WHEN
+# (например "midnight"), по времени; старые файлы сжимаются gzip
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "")
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "7"))
+# Доля записей о каждом обновлении (отмеченных extra={"sampled": True}),
+# которые попадают в журнал
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1"))
+
+LOG_TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# Поля обновления, которые попадают в JSON-записи
+LOG_CONTEXT_FIELDS = ("update_id", "user_id", "chat_id", "command", "latency_ms")
+log_context = threading.local()
+
+
+@contextmanager
+def logging_context(**fields):
+    """Добавляет поля ко всем записям журнала текущего потока"""
+    previous = getattr(log_context, "fields", {})
+    log_context.fields = {**previous, **fields}
+    try:
+        yield
+    finally:
+        log_context.fields = previous
+
+
+class LogContextFilter(logging.Filter):
+    """Переносит поля logging_context в запись, пока она в потоке-источнике"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for name, value in getattr(log_context, "fields", {}).items():
+            if not hasattr(record, name):
+                setattr(record, name, value)
+        return True
+
+
+class LogSamplingFilter(logging.Filter):
+    """Пропускает только долю rate записей, отмеченных как частые"""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate >= 1 or not getattr(record, "sampled", False):
+            return True
+        return random.random() < self.rate
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Форматирует запись как одну строку JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage()
+        }
+        for name in LOG_CONTEXT_FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который оставляет форматирование слушателю.
+
+    Стандартный prepare() форматирует запись в потоке-источнике; здесь
+    подставляются только аргументы сообщения (они могут измениться позже),
+    а дата, JSON и запись на диск - забота фонового потока.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # Трассировка держит кадры стека, поэтому переводим ее в текст сразу
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class LogListener(logging.handlers.QueueListener):
+    """QueueListener, который можно останавливать повторно (atexit и gunicorn)"""
+
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+
+def _gzip_log_name(name: str) -> str:
+    return name + ".gz"
+
+
+def _gzip_log_rotator(source: str, dest: str):
+    """Сжимает файл журнала при ротации (выполняется в потоке слушателя)"""
+    with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+def configure_logging() -> LogListener:
+    """Направляет записи всех логгеров через очередь в консоль и файл"""
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter(LOG_TEXT_FORMAT))
+    handlers: List[logging.Handler] = [console]
+    if LOG_FILE:
+        if LOG_ROTATE_WHEN:
+            file_handler = logging.handlers.TimedRotatingFileHandler(
+                LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
+            )
+        else:
+            file_handler = logging.handlers.RotatingFileHandler(
+                LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
+            )
+        file_handler.namer = _gzip_log_name
+        file_handler.rotator = _gzip_log_rotator
+        file_handler.setFormatter(
+            JsonLogFormatter() if LOG_FORMAT == "json" else logging.Formatter(LOG_TEXT_FORMAT)
+        )
+        handlers.append(file_handler)
+
+    queue_handler = DeferredQueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(LogSamplingFilter(LOG_SAMPLE_RATE))
+    queue_handler.addFilter(LogContextFilter())
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    listener = LogListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+log_listener = configure_logging()
+# Регистрируется первым, поэтому останавливается последним и успевает
+# записать сообщения остальных обработчиков atexit
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
 # Токен из переменных окружения
@@ -38,119 +215,3270 @@ BOT_TOKEN = os.getenv("BOT_TOKEN", "8498564975:AAHDRpdELwIjlxm0o2ueNYf0dHqZvicU5
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN не установлен. Установите его в переменных окружения.")
 
-bot = telebot.TeleBot(BOT_TOKEN)
+# Ограничения исходящих запросов к Telegram
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_CHAT_BURST = int(os.getenv("OUTBOUND_CHAT_BURST", "3"))
+OUTBOUND_WORKERS = int(os.getenv("OUTBOUND_WORKERS", "8"))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
+
+# Приоритеты исходящих сообщений: ответы пользователям идут раньше рассылок
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+
+# Загрузка файлов: размер блока чтения с диска и время ожидания ответа Telegram
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_READ_TIMEOUT = int(os.getenv("UPLOAD_READ_TIMEOUT", "300"))
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity в запасе"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def wait_time(self) -> float:
+        """Через сколько секунд будет доступен токен (0 - уже доступен)"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        """Запрещает отправку на seconds секунд (ответ 429 с retry_after)"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class LatencyHistogram:
+    """Гистограмма задержек с фиксированными границами корзин (в секундах)"""
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        with self.lock:
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    self.counts[i] += 1
+                    break
+            else:
+                self.counts[-1] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Возвращает накопительные счетчики по корзинам, как в Prometheus"""
+        with self.lock:
+            cumulative = list(itertools.accumulate(self.counts))
+            return {
+                "buckets": {str(bound): cumulative[i] for i, bound in enumerate(self.buckets)},
+                "count": self.count,
+                "sum": round(self.sum, 6),
+                "avg": round(self.sum / self.count, 6) if self.count else 0
+            }
+
+
+class _MetricFamily:
+    """Метрика с набором меток; значения для каждой комбинации меток хранятся отдельно"""
+
+    def __init__(self, name: str, help_text: str, metric_type: str, label_names: Tuple[str, ...],
+                 factory, func=None):
+        self.name = name
+        self.help_text = help_text
+        self.metric_type = metric_type
+        self.label_names = label_names
+        self.factory = factory
+        # Значение без меток, которое вычисляется при каждом сборе метрик
+        self.func = func
+        self.lock = threading.Lock()
+        self.children: Dict[Tuple[str, ...], Any] = {}
+
+    def labels(self, *values) -> Any:
+        key = tuple(str(value) for value in values)
+        child = self.children.get(key)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(key, self.factory())
+        return child
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Возвращает значения по первой метке, например по методу API"""
+        with self.lock:
+            children = dict(self.children)
+        return {",".join(key): child.snapshot() for key, child in children.items()}
+
+    def _format_labels(self, key: Tuple[str, ...], extra: str = "") -> str:
+        pairs = [f'{name}="{value}"' for name, value in zip(self.label_names, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}"]
+        if self.func is not None:
+            lines.append(f"{self.name} {self.func()}")
+            return lines
+        with self.lock:
+            children = list(self.children.items())
+        for key, child in children:
+            if self.metric_type == "histogram":
+                snapshot = child.snapshot()
+                for bound, count in snapshot["buckets"].items():
+                    bucket_labels = self._format_labels(key, 'le="%s"' % bound)
+                    lines.append(f"{self.name}_bucket{bucket_labels} {count}")
+                inf_labels = self._format_labels(key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{inf_labels} {snapshot['count']}")
+                lines.append(f"{self.name}_sum{self._format_labels(key)} {snapshot['sum']}")
+                lines.append(f"{self.name}_count{self._format_labels(key)} {snapshot['count']}")
+            else:
+                lines.append(f"{self.name}{self._format_labels(key)} {child.snapshot()}")
+        return lines
+
+
+class _CounterValue:
+    __slots__ = ("lock", "value")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        with self.lock:
+            self.value += amount
+
+    def snapshot(self) -> float:
+        return self.value
+
+
+# Реестр метрик в формате Prometheus
+class MetricsRegistry:
+    """Хранит счетчики, измерители и гистограммы и отдает их текстом для /metrics.
+
+    Значения обновляются на месте, а измерители с func вычисляются только
+    в момент сбора, поэтому частый опрос /metrics обходится дешево.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.families: Dict[str, _MetricFamily] = {}
+
+    def _register(self, family: _MetricFamily) -> _MetricFamily:
+        with self.lock:
+            return self.families.setdefault(family.name, family)
+
+    def counter(self, name: str, help_text: str, labels: Tuple[str, ...] = (), func=None) -> _MetricFamily:
+        return self._register(_MetricFamily(name, help_text, "counter", labels, _CounterValue, func))
+
+    def gauge(self, name: str, help_text: str, func) -> _MetricFamily:
+        return self._register(_MetricFamily(name, help_text, "gauge", (), None, func))
+
+    def histogram(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = LatencyHistogram.BUCKETS) -> _MetricFamily:
+        return self._register(
+            _MetricFamily(name, help_text, "histogram", labels, lambda: LatencyHistogram(buckets))
+        )
+
+    def render(self) -> str:
+        """Возвращает все метрики в текстовом формате Prometheus"""
+        with self.lock:
+            families = list(self.families.values())
+        lines: List[str] = []
+        for family in families:
+            try:
+                lines.extend(family.render())
+            except Exception as e:
+                logger.error("Ошибка сбора метрики %s: %s", family.name, e)
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+
+class _OutboundJob:
+    __slots__ = ("method", "func", "args", "kwargs", "chat_id", "future", "attempts", "enqueued")
+
+    def __init__(self, method, func, args, kwargs, chat_id):
+        self.method = method
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.chat_id = chat_id
+        self.future = Future()
+        self.attempts = 0
+        self.enqueued = time.monotonic()
+
+
+# Планировщик исходящих запросов к Telegram
+class OutboundScheduler:
+    """Очередь исходящих запросов с ограничением скорости.
+
+    Запросы выполняются пулом потоков в порядке приоритета. Перед отправкой
+    берется токен из общего ведра (лимит бота) и из ведра чата. На ответ
+    429 планировщик приостанавливает все отправки на retry_after и повторяет запрос.
+    """
+
+    def __init__(self, workers: int, global_rate: float, chat_rate: float, chat_burst: int):
+        self.lock = threading.Lock()
+        self.queue: queue.PriorityQueue = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        # Ведра чатов с LRU-вытеснением, чтобы таблица не росла бесконечно
+        self.chat_buckets: OrderedDict = OrderedDict()
+        self.local = threading.local()
+        self.latency = metrics.histogram(
+            "bot_outbound_request_duration_seconds", "Telegram API call latency by method", ("method",)
+        )
+        self.queue_wait = metrics.histogram(
+            "bot_outbound_queue_wait_seconds", "Time outbound requests spend in the queue"
+        ).labels()
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.throttled = 0
+        self.threads = [
+            threading.Thread(target=self._worker, daemon=True, name=f"outbound-{i}")
+            for i in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    @contextmanager
+    def priority(self, value: int):
+        """Задает приоритет отправок из текущего потока, например для рассылки"""
+        previous = getattr(self.local, "priority", PRIORITY_INTERACTIVE)
+        self.local.priority = value
+        try:
+            yield
+        finally:
+            self.local.priority = previous
+
+    def call(self, method: str, func, chat_id, *args, **kwargs):
+        """Ставит запрос в очередь и ждет его выполнения"""
+        job = _OutboundJob(method, func, args, kwargs, chat_id)
+        self._enqueue(job, getattr(self.local, "priority", PRIORITY_INTERACTIVE))
+        return job.future.result()
+
+    def _enqueue(self, job: _OutboundJob, priority: int):
+        self.queue.put((priority, next(self.sequence), job))
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            if len(self.chat_buckets) > 10000:
+                self.chat_buckets.popitem(last=False)
+        else:
+            self.chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def _acquire(self, chat_id):
+        """Ждет, пока не будет токена и в общем ведре, и в ведре чата"""
+        delayed = False
+        while True:
+            with self.lock:
+                chat_bucket = self._chat_bucket(chat_id)
+                wait = max(self.global_bucket.wait_time(), chat_bucket.wait_time())
+                if wait == 0:
+                    self.global_bucket.take()
+                    chat_bucket.take()
+                    return
+                if not delayed:
+                    self.throttled += 1
+                    delayed = True
+            time.sleep(wait)
+
+    def _worker(self):
+        while True:
+            priority, _, job = self.queue.get()
+            self.queue_wait.observe(time.monotonic() - job.enqueued)
+            self._acquire(job.chat_id)
+            started = time.perf_counter()
+            try:
+                result = job.func(job.chat_id, *job.args, **job.kwargs)
+            except telebot.apihelper.ApiTelegramException as e:
+                retry_after = (e.result_json.get("parameters") or {}).get("retry_after")
+                if e.error_code == 429 and retry_after and job.attempts < OUTBOUND_MAX_RETRIES:
+                    job.attempts += 1
+                    with self.lock:
+                        self.retried += 1
+                        # Лимит Telegram общий для бота: пауза нужна всем чатам, иначе
+                        # остальные отправки рассылки сразу получат новые 429
+                        self.global_bucket.block(retry_after)
+                        self._chat_bucket(job.chat_id).block(retry_after)
+                    logger.warning("Telegram ограничил %s, повтор через %s с", job.method, retry_after)
+                    # Ожидание в очереди считаем заново, без паузы до повтора
+                    job.enqueued = time.monotonic()
+                    self._enqueue(job, priority)
+                    continue
+                self._finish(job, started, error=e)
+            except Exception as e:
+                self._finish(job, started, error=e)
+            else:
+                self._finish(job, started, result=result)
+
+    def _finish(self, job: _OutboundJob, started: float, result=None, error=None):
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            if error is None:
+                self.sent += 1
+            else:
+                self.failed += 1
+        self.latency.labels(job.method).observe(elapsed)
+        if error is None:
+            job.future.set_result(result)
+        else:
+            job.future.set_exception(error)
+
+    def queue_depth(self) -> int:
+        """Возвращает число запросов, ожидающих отправки"""
+        return self.queue.qsize()
+
+    def get_statistics(self) -> Dict[str, Any]:
+        """Возвращает состояние очереди и гистограммы задержек по методам"""
+        with self.lock:
+            stats = {
+                "queue_depth": self.queue_depth(),
+                "sent": self.sent,
+                "failed": self.failed,
+                "retried_429": self.retried,
+                "throttled": self.throttled
+            }
+        stats["queue_wait_seconds"] = self.queue_wait.snapshot()
+        stats["latency_seconds"] = self.latency.snapshot()
+        return stats
+
+
+class MultipartFileStream:
+    """Тело запроса multipart/form-data, которое читает файл блоками при отправке.
+
+    requests собирает multipart из files= целиком в памяти; этот объект
+    отдается как data= и имеет __len__, поэтому уходит с Content-Length,
+    а в памяти одновременно лежит не больше UPLOAD_CHUNK_SIZE байт файла.
+    """
+
+    def __init__(self, fields: Dict[str, str], file_field: str, path: str):
+        self.path = path
+        self.boundary = os.urandom(16).hex()
+        head = []
+        for name, value in fields.items():
+            head.append(
+                f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+            )
+        head.append(
+            f'--{self.boundary}\r\nContent-Disposition: form-data; name="{file_field}"; '
+            f'filename="{os.path.basename(path)}"\r\nContent-Type: application/octet-stream\r\n\r\n'
+        )
+        self.head = "".join(head).encode('utf-8')
+        self.tail = f'\r\n--{self.boundary}--\r\n'.encode('utf-8')
+        self.file_size = os.path.getsize(path)
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self) -> int:
+        return len(self.head) + self.file_size + len(self.tail)
+
+    def __iter__(self) -> Iterator[bytes]:
+        yield self.head
+        with open(self.path, 'rb') as f:
+            for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+                yield chunk
+        yield self.tail
+
+
+class ScheduledTeleBot(telebot.TeleBot):
+    """TeleBot, отправляющий сообщения через OutboundScheduler"""
+
+    def __init__(self, token: str, scheduler: OutboundScheduler, **kwargs):
+        super().__init__(token, **kwargs)
+        self.scheduler = scheduler
+
+    def send_message(self, chat_id, text, *args, **kwargs):
+        return self.scheduler.call("send_message", super().send_message, chat_id, text, *args, **kwargs)
+
+    def send_document(self, chat_id, document, *args, **kwargs):
+        return self.scheduler.call("send_document", super().send_document, chat_id, document, *args, **kwargs)
+
+    def send_chat_action(self, chat_id, action, *args, **kwargs):
+        return self.scheduler.call("send_chat_action", super().send_chat_action, chat_id, action, *args, **kwargs)
+
+    def upload_document(self, chat_id, path: str, caption: Optional[str] = None) -> telebot.types.Message:
+        """Загружает файл с диска потоком, не читая его в память целиком"""
+        return self.scheduler.call("send_document", self._upload_document, chat_id, path, caption)
+
+    def _upload_document(self, chat_id, path: str, caption: Optional[str]) -> telebot.types.Message:
+        fields = {"chat_id": str(chat_id)}
+        if caption:
+            fields["caption"] = caption
+        body = MultipartFileStream(fields, "document", path)
+        url = (telebot.apihelper.API_URL or "https://api.telegram.org/bot{0}/{1}").format(self.token, "sendDocument")
+        response = telebot.apihelper._get_req_session().post(
+            url, data=body, headers={"Content-Type": body.content_type},
+            timeout=(telebot.apihelper.CONNECT_TIMEOUT, UPLOAD_READ_TIMEOUT),
+            proxies=telebot.apihelper.proxy
+        )
+        result = telebot.apihelper._check_result("sendDocument", response)
+        return telebot.types.Message.de_json(result["result"])
+
+
+# Режим получения обновлений: "polling" или "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+
+# Обновления в обоих режимах обрабатывает пул UpdateDispatcher,
+# поэтому собственный пул потоков telebot не нужен
+outbound_scheduler = OutboundScheduler(
+    OUTBOUND_WORKERS, OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST
+)
+bot = ScheduledTeleBot(BOT_TOKEN, outbound_scheduler, threaded=False)
 
 # Определяем базовую директорию
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-# Файлы теперь в той же директории
-USERS_FILE = os.path.join(BASE_DIR, "users_data.json")
-ZIP_FILE_PATH = os.path.join(BASE_DIR, "AltShift_Fast.zip")
+# Файлы данных по умолчанию лежат в той же директории; DATA_DIR позволяет
+# держать их отдельно (например, для бенчмарков)
+DATA_DIR = os.getenv("DATA_DIR", BASE_DIR)
+USERS_FILE = os.path.join(DATA_DIR, "users_data.json")
+USERS_DB_FILE = os.path.join(DATA_DIR, "users_data.db")
+ZIP_FILE_PATH = os.getenv("ZIP_FILE_PATH", os.path.join(BASE_DIR, "AltShift_Fast.zip"))
+FILE_CACHE_PATH = os.path.join(DATA_DIR, "file_cache.json")
+VOLUMES_DIR = os.path.join(DATA_DIR, "volumes")
+RELEASES_DIR = os.path.join(DATA_DIR, "releases")
+ACTIVITY_FILE = os.path.join(DATA_DIR, "activity.bin")
+ACTIVITY_ROLLUPS_FILE = os.path.join(DATA_DIR, "activity_rollups.json")
+BROADCAST_STATE_FILE = os.path.join(DATA_DIR, "broadcast_state.json")
+POLLING_STATE_FILE = os.path.join(DATA_DIR, "polling_state.json")
+
+# Администраторы: id в Telegram через запятую и токен для HTTP API
+ADMIN_IDS = {admin_id.strip() for admin_id in os.getenv("ADMIN_IDS", "").split(",") if admin_id.strip()}
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+# Рассылка: число параллельных отправок и размер порции между контрольными точками
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "200"))
+
+# Выгрузка и загрузка пользователей: сколько записей читается из хранилища
+# под одной блокировкой и сколько применяется одной пачкой при импорте
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "1000"))
+# Сколько ошибок разбора с номерами строк возвращает импорт
+IMPORT_ERRORS_KEEP = int(os.getenv("IMPORT_ERRORS_KEEP", "20"))
+
+# Журнал пользователей сворачивается в снимок по времени или по числу событий
+USERS_COMPACT_INTERVAL = int(os.getenv("USERS_COMPACT_INTERVAL", "300"))
+USERS_COMPACT_EVENTS = int(os.getenv("USERS_COMPACT_EVENTS", "1000"))
+
+# Ограничение частоты запросов одного пользователя: не больше USER_RATE_LIMIT
+# сообщений за USER_RATE_WINDOW секунд; таблица хранит USER_RATE_TABLE_SIZE
+# последних пользователей. Повторный /download в течение DOWNLOAD_COOLDOWN
+# секунд отправляет файл по file_id без учета в статистике
+USER_RATE_LIMIT = int(os.getenv("USER_RATE_LIMIT", "10"))
+USER_RATE_WINDOW = float(os.getenv("USER_RATE_WINDOW", "10"))
+USER_RATE_TABLE_SIZE = int(os.getenv("USER_RATE_TABLE_SIZE", "10000"))
+DOWNLOAD_COOLDOWN = float(os.getenv("DOWNLOAD_COOLDOWN", "300"))
+
+# История активности: как часто сохранять сводки, сколько часов хранить
+# почасовые сводки и сколько точек может вернуть один запрос истории
+ACTIVITY_CHECKPOINT_INTERVAL = int(os.getenv("ACTIVITY_CHECKPOINT_INTERVAL", "60"))
+ACTIVITY_HOURS_KEEP = int(os.getenv("ACTIVITY_HOURS_KEEP", str(24 * 90)))
+ACTIVITY_HISTORY_MAX_POINTS = int(os.getenv("ACTIVITY_HISTORY_MAX_POINTS", "2000"))
+
+# Размер топа скачивающих: по умолчанию в /stats и максимальный из хранимых
+TOP_DOWNLOADERS_DEFAULT = int(os.getenv("TOP_DOWNLOADERS_DEFAULT", "5"))
+TOP_DOWNLOADERS_MAX = int(os.getenv("TOP_DOWNLOADERS_MAX", "100"))
+
+# Очередь обработки входящих обновлений
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "4"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+UPDATE_DEDUP_SIZE = int(os.getenv("UPDATE_DEDUP_SIZE", "10000"))
+
+# Опрос Telegram (BOT_MODE=polling): обновлений за один getUpdates (не больше
+# 100), время ожидания long polling в секундах и пределы паузы после ошибок
+POLL_BATCH_SIZE = min(100, int(os.getenv("POLL_BATCH_SIZE", "100")))
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "50"))
+POLL_BACKOFF_BASE = float(os.getenv("POLL_BACKOFF_BASE", "1"))
+POLL_BACKOFF_MAX = float(os.getenv("POLL_BACKOFF_MAX", "60"))
+# Новые обновления не запрашиваются, пока столько полученных не обработано
+POLL_MAX_PENDING = int(os.getenv("POLL_MAX_PENDING", "300"))
+
+# Групповая запись изменений пользователей: не чаще раза в N мс или после K изменений
+USERS_FLUSH_INTERVAL_MS = int(os.getenv("USERS_FLUSH_INTERVAL_MS", "200"))
+USERS_FLUSH_MAX_CHANGES = int(os.getenv("USERS_FLUSH_MAX_CHANGES", "100"))
+
+# Сколько секунд главная страница отдается из кэша без перерисовки
+DASHBOARD_CACHE_TTL = float(os.getenv("DASHBOARD_CACHE_TTL", "5"))
+
+# Как часто перестраивается блок статистики в ответах /start и /stats
+REPLY_CACHE_TTL = float(os.getenv("REPLY_CACHE_TTL", "5"))
+
+# Архивы больше лимита Bot API на загрузку (50 МБ) отправляются томами
+DELIVERY_VOLUME_SIZE = int(os.getenv("DELIVERY_VOLUME_SIZE", str(49 * 1024 * 1024)))
+# Чат (например, закрытый канал), куда заранее загружаются тома, чтобы
+# первый /download после обновления архива шел по готовому file_id
+PREWARM_CHAT_ID = os.getenv("PREWARM_CHAT_ID", "")
+
+# Новый архив публикуется, когда его размер и время изменения не меняются
+# ARCHIVE_SETTLE_SECONDS; на диске хранится RELEASES_KEEP последних версий
+ARCHIVE_SETTLE_SECONDS = float(os.getenv("ARCHIVE_SETTLE_SECONDS", "2"))
+RELEASES_KEEP = int(os.getenv("RELEASES_KEEP", "3"))
+
+# Хранилище пользователей: "json" (снимок + журнал) или "sqlite"
+USER_STORAGE = os.getenv("USER_STORAGE", "json").lower()
+
+# Число процессов веб-сервера (выставляется gunicorn.conf.py). Несколько
+# процессов не могут делить JSON-файлы, поэтому им нужно хранилище SQLite
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+if WEB_CONCURRENCY > 1 and USER_STORAGE != "sqlite":
+    raise ValueError("При WEB_CONCURRENCY > 1 требуется USER_STORAGE=sqlite")
+
+# Файл блокировки: только процесс-лидер опрашивает Telegram или регистрирует webhook.
+# Остальные процессы раз в LEADER_RETRY_INTERVAL секунд пробуют занять место
+# завершившегося лидера
+LEADER_LOCK_FILE = os.path.join(DATA_DIR, "bot.leader.lock")
+LEADER_RETRY_INTERVAL = float(os.getenv("LEADER_RETRY_INTERVAL", "10"))
+
+# Загрузка пользователей и журнала активности идет в фоне, пока
+# веб-сервер уже отвечает на /health. STARTUP_BACKGROUND=0
+# выполняет их при импорте, как раньше. Обращение к еще не загруженному
+# хранилищу ждет не дольше STARTUP_TIMEOUT секунд
+STARTUP_BACKGROUND = os.getenv("STARTUP_BACKGROUND", "1") != "0"
+STARTUP_TIMEOUT = float(os.getenv("STARTUP_TIMEOUT", "300"))
+
+logger.info("Базовая директория: %s", BASE_DIR)
+logger.info("Путь к ZIP: %s", ZIP_FILE_PATH)
+logger.info("Путь к данным: %s", USERS_FILE)
+
+# Межпроцессная блокировка
+class ProcessLock:
+    """Неблокирующая блокировка на файле через flock.
+
+    Держится, пока открыт файловый дескриптор, и снимается ядром при
+    завершении процесса, поэтому упавший лидер не оставляет "вечную"
+    блокировку. Без fcntl (Windows) блокировка всегда считается захваченной.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fd = None
+
+    @property
+    def held(self) -> bool:
+        return self.fd is not None
+
+    def acquire(self) -> bool:
+        """Пытается захватить блокировку, не дожидаясь ее освобождения"""
+        with self.lock:
+            if self.fd is not None:
+                return True
+            if fcntl is None:
+                self.fd = -1
+                return True
+            fd = open(self.path, 'a+', encoding='utf-8')
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                fd.close()
+                return False
+            fd.truncate(0)
+            fd.write(str(os.getpid()))
+            fd.flush()
+            self.fd = fd
+            return True
+
+    def release(self):
+        """Освобождает блокировку"""
+        with self.lock:
+            if self.fd is None:
+                return
+            if fcntl is not None:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+                self.fd.close()
+            self.fd = None
+
+
+# Групповое сохранение изменений
+class GroupCommitWriter:
+    """Фоновый поток, который сохраняет накопленные изменения пачками.
+
+    Обработчики только отмечают, что есть несохраненные изменения, а
+    flush_func вызывается не чаще раза в interval_ms либо сразу после
+    max_pending изменений, а также при остановке.
+    """
+
+    def __init__(self, flush_func, interval_ms: int, max_pending: int, name: str):
+        self.flush_func = flush_func
+        self.interval = interval_ms / 1000
+        self.max_pending = max_pending
+        self.cond = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.pending = 0
+        self.stopping = False
+        self.flushes = 0
+        self.flushed_changes = 0
+        self.max_batch = 0
+        self.total_flush_time = 0.0
+        self.max_flush_time = 0.0
+        self.last_flush_time = 0.0
+        # Писателей несколько (пользователи, активность, состояние опроса) -
+        # метрики каждого идут под своей меткой writer
+        self.flush_histogram = metrics.histogram(
+            "bot_storage_flush_duration_seconds", "Time spent flushing a batch of changes by writer",
+            ("writer",), buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+        ).labels(name)
+        self.batch_histogram = metrics.histogram(
+            "bot_storage_flush_batch_size", "Number of changes written per flush by writer",
+            ("writer",), buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000)
+        ).labels(name)
+        self.thread = threading.Thread(target=self._loop, daemon=True, name=name)
+        self.thread.start()
+
+    def mark_dirty(self, count: int = 1):
+        """Отмечает новые несохраненные изменения"""
+        with self.cond:
+            self.pending += count
+            if self.pending >= self.max_pending:
+                self.cond.notify()
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending >= self.max_pending or self.stopping,
+                                   timeout=self.interval)
+                if self.stopping:
+                    return
+            self.flush()
+
+    def flush(self):
+        """Немедленно сохраняет все накопленные изменения"""
+        with self.flush_lock:
+            with self.cond:
+                batch = self.pending
+                self.pending = 0
+            if not batch:
+                return
+            started = time.perf_counter()
+            try:
+                self.flush_func()
+            except Exception as e:
+                logger.error("Ошибка группового сохранения: %s", e)
+                with self.cond:
+                    self.pending += batch
+                return
+            elapsed = time.perf_counter() - started
+            self.flush_histogram.observe(elapsed)
+            self.batch_histogram.observe(batch)
+            with self.cond:
+                self.flushes += 1
+                self.flushed_changes += batch
+                self.max_batch = max(self.max_batch, batch)
+                self.total_flush_time += elapsed
+                self.max_flush_time = max(self.max_flush_time, elapsed)
+                self.last_flush_time = elapsed
+
+    def stop(self):
+        """Останавливает поток и сохраняет остаток изменений"""
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        self.thread.join()
+        self.flush()
+
+    def get_statistics(self) -> Dict[str, Any]:
+        """Возвращает метрики сохранения: задержку и размер пачек"""
+        with self.cond:
+            return {
+                "pending_changes": self.pending,
+                "flushes": self.flushes,
+                "flushed_changes": self.flushed_changes,
+                "avg_batch_size": round(self.flushed_changes / self.flushes, 2) if self.flushes else 0,
+                "max_batch_size": self.max_batch,
+                "avg_flush_ms": round(self.total_flush_time / self.flushes * 1000, 3) if self.flushes else 0,
+                "max_flush_ms": round(self.max_flush_time * 1000, 3),
+                "last_flush_ms": round(self.last_flush_time * 1000, 3)
+            }
+
+
+# Топ пользователей по скачиваниям
+class DownloadLeaderboard:
+    """Поддерживает топ пользователей по скачиваниям в куче ограниченного размера.
+
+    Счетчики скачиваний только растут, поэтому пользователь, вытесненный из
+    топа, может вернуться в него лишь через очередное update(). Устаревшие
+    записи кучи не удаляются сразу, а отбрасываются при следующем обращении.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.heap: List[Tuple[int, int]] = []
+        self.members: Dict[int, int] = {}
+
+    def rebuild(self, counts: Iterator[Tuple[int, int]]):
+        """Строит топ заново по парам (user_id, скачивания)"""
+        top = heapq.nlargest(self.capacity, ((d, u) for u, d in counts if d > 0))
+        self.members = {user_id: downloads for downloads, user_id in top}
+        self.heap = top
+        heapq.heapify(self.heap)
+
+    def _is_stale(self, entry: Tuple[int, int]) -> bool:
+        return self.members.get(entry[1]) != entry[0]
+
+    def update(self, user_id: int, downloads: int):
+        """Учитывает новое значение счетчика пользователя"""
+        if downloads <= 0:
+            return
+        if user_id in self.members:
+            self.members[user_id] = downloads
+            heapq.heappush(self.heap, (downloads, user_id))
+            if len(self.heap) > 2 * self.capacity:
+                self.heap = [(d, u) for u, d in self.members.items()]
+                heapq.heapify(self.heap)
+            return
+        if len(self.members) < self.capacity:
+            self.members[user_id] = downloads
+            heapq.heappush(self.heap, (downloads, user_id))
+            return
+        while self._is_stale(self.heap[0]):
+            heapq.heappop(self.heap)
+        if downloads > self.heap[0][0]:
+            _, evicted = heapq.heapreplace(self.heap, (downloads, user_id))
+            del self.members[evicted]
+            self.members[user_id] = downloads
+
+    def top(self, limit: int) -> List[Tuple[int, int]]:
+        """Возвращает до limit пар (user_id, скачивания) по убыванию"""
+        return heapq.nlargest(min(limit, self.capacity), self.members.items(), key=lambda x: x[1])
+
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def format_timestamp(timestamp: int) -> str:
+    """Переводит время в секундах эпохи в строку формата users_data.json"""
+    return time.strftime(DATETIME_FORMAT, time.localtime(timestamp))
+
+
+@functools.lru_cache(maxsize=1 << 17)
+def _ten_minutes_timestamp(value: str) -> int:
+    """Переводит начало десятиминутки "ГГГГ-ММ-ДД ЧЧ:М" в секунды эпохи (локальное время)"""
+    return int(datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                        int(value[11:13]), int(value[14]) * 10).timestamp())
+
+
+def parse_timestamp(value: str) -> int:
+    """Переводит строку "ГГГГ-ММ-ДД ЧЧ:ММ:СС" в секунды эпохи (локальное время).
+
+    Переводы часов (в том числе получасовые) приходятся на границы
+    десятиминуток, поэтому их начало берется из кэша, а остаток просто
+    прибавляется - при загрузке миллиона пользователей это в несколько раз
+    быстрее, чем datetime на каждую строку.
+    """
+    if not value:
+        return 0
+    try:
+        minute, second = int(value[15]), int(value[17:19])
+        if second < 60:
+            return _ten_minutes_timestamp(value[:15]) + minute * 60 + second
+    except (ValueError, IndexError):
+        pass
+    return int(datetime.strptime(value, DATETIME_FORMAT).timestamp())
+
+
+_JSON_DECODER = json.JSONDecoder()
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def iter_json_object(text: str) -> Iterator[Tuple[str, Any]]:
+    """Разбирает JSON-объект верхнего уровня по одной паре ключ-значение.
+
+    json.loads разбирает весь документ одним вызовом и держит GIL секунды
+    на миллионе пользователей, из-за чего веб-сервер не отвечает даже на
+    /health. Здесь каждое значение разбирается отдельно, и между ними
+    другие потоки успевают поработать.
+    """
+    scan = _JSON_DECODER.scan_once
+    skip = _JSON_WHITESPACE.match
+    try:
+        idx = skip(text, 0).end()
+        if text[idx] != "{":
+            raise ValueError(f"Ожидался JSON-объект, позиция {idx}")
+        idx = skip(text, idx + 1).end()
+        if text[idx] == "}":
+            return
+        while True:
+            if text[idx] != '"':
+                raise ValueError(f"Ожидался ключ, позиция {idx}")
+            key, idx = scan(text, idx)
+            # json.dump пишет разделители ": " и ", " - проверяем их без регулярного выражения
+            if text.startswith(": ", idx):
+                idx += 2
+            else:
+                idx = skip(text, idx).end()
+                if text[idx] != ":":
+                    raise ValueError(f"Ожидалось ':', позиция {idx}")
+                idx = skip(text, idx + 1).end()
+            value, idx = scan(text, idx)
+            yield key, value
+            if text.startswith(", ", idx):
+                idx += 2
+                continue
+            idx = skip(text, idx).end()
+            if text[idx] == "}":
+                return
+            if text[idx] != ",":
+                raise ValueError(f"Ожидалось ',' или '}}', позиция {idx}")
+            idx = skip(text, idx + 1).end()
+    except (IndexError, StopIteration):
+        raise ValueError("Неожиданный конец JSON-объекта") from None
+
+
+def day_bounds(timestamp: float) -> Tuple[int, int]:
+    """Возвращает начало текущих и следующих суток (локальное время) в секундах эпохи"""
+    day = datetime.fromtimestamp(timestamp).replace(hour=0, minute=0, second=0, microsecond=0)
+    start = int(day.timestamp())
+    return start, int((day + timedelta(days=1)).timestamp())
+
+
+def iter_batches(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    """Разбивает поток элементов на списки не длиннее size, не читая его целиком"""
+    iterator = iter(items)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+class UserRecord:
+    """Компактная запись пользователя в памяти.
+
+    Вместо словаря с шестью строковыми ключами - объект со __slots__,
+    целым id и временем в секундах эпохи. В формат users_data.json
+    запись переводится только при записи на диск и при выдаче наружу.
+    """
+
+    __slots__ = ("user_id", "username", "first_name", "last_name",
+                 "join_ts", "downloads", "last_active_ts", "blocked")
+
+    def __init__(self, user_id: int, username: str, first_name: str, last_name: str,
+                 join_ts: int, downloads: int, last_active_ts: int, blocked: bool = False):
+        self.user_id = user_id
+        self.username = username
+        self.first_name = first_name
+        self.last_name = last_name
+        self.join_ts = join_ts
+        self.downloads = downloads
+        self.last_active_ts = last_active_ts
+        self.blocked = blocked
+
+    @classmethod
+    def from_json(cls, user_id: str, data: Dict[str, Any]) -> "UserRecord":
+        """Создает запись из словаря в формате users_data.json"""
+        return cls(
+            int(user_id),
+            data.get("username", ""),
+            data.get("first_name", ""),
+            data.get("last_name", ""),
+            parse_timestamp(data.get("join_date", "")),
+            int(data.get("downloads", 0)),
+            parse_timestamp(data.get("last_active", "")),
+            bool(data.get("blocked", False))
+        )
+
+    def to_json(self) -> Dict[str, Any]:
+        """Возвращает словарь в формате users_data.json"""
+        data = {
+            "username": self.username,
+            "first_name": self.first_name,
+            "last_name": self.last_name,
+            "join_date": format_timestamp(self.join_ts),
+            "downloads": self.downloads,
+            "last_active": format_timestamp(self.last_active_ts)
+        }
+        if self.blocked:
+            data["blocked"] = True
+        return data
 
-logger.info(f"Базовая директория: {BASE_DIR}")
-logger.info(f"Путь к ZIP: {ZIP_FILE_PATH}")
-logger.info(f"Путь к данным: {USERS_FILE}")
 
 # Класс для управления пользователями
 class UserManager:
+    """Хранит пользователей в памяти, а изменения пишет в журнал.
+
+    На диске данные лежат в двух файлах: снимок (users_data.json, прежний
+    формат) и журнал событий (users_data.json.journal), куда на каждое
+    изменение дописывается одна строка. При запуске снимок загружается,
+    а журнал проигрывается поверх него. Фоновый поток периодически
+    сворачивает журнал в новый снимок.
+
+    Изменения попадают в журнал не сразу: события копятся в памяти и
+    дописываются пачкой потоком GroupCommitWriter.
+
+    В памяти пользователи хранятся как UserRecord с ключом - целым id;
+    методы принимают id и строкой, и числом.
+    """
+
     def __init__(self, filename: str):
         self.filename = filename
-        self.users: Dict[str, Dict[str, Any]] = self.load_users()
+        self.journal_filename = filename + ".journal"
+        # Скачивания по версиям архива: {версия: число скачиваний}
+        self.releases_filename = filename + ".releases"
+        self.release_downloads: Dict[str, int] = {}
+        # Порядок захвата блокировок: journal_lock, затем lock
+        self.lock = threading.RLock()
+        self.journal_lock = threading.Lock()
+        self.snapshot_lock = threading.Lock()
+        self.journal_events = 0
+        self.pending_events: List[str] = []
+        self.journal_write_failed = False
+        self.users: Dict[int, UserRecord] = self.load_users()
+        # Агрегаты обновляются при каждом изменении, чтобы статистика не требовала обхода
+        self.total_downloads = 0
+        self.active_day = (0, 0)
+        self.active_today: set = set()
+        self.leaderboard = DownloadLeaderboard(TOP_DOWNLOADERS_MAX)
+        # Порядок добавления пользователей - для обхода порциями с позиции
+        self.user_order: List[int] = list(self.users)
+        self.recount_totals()
+        self.journal = open(self.journal_filename, 'a', encoding='utf-8')
+        if self.journal.tell() and not self._journal_ends_with_newline():
+            # Отделяем недописанную строку, чтобы новые события не склеились с ней
+            self.journal.write("\n")
+            self.journal.flush()
+        self.writer = GroupCommitWriter(
+            self._write_pending_events, USERS_FLUSH_INTERVAL_MS, USERS_FLUSH_MAX_CHANGES, "users-writer"
+        )
+        self._stop_event = threading.Event()
+        self._compactor = threading.Thread(target=self._compaction_loop, daemon=True)
+        self._compactor.start()
 
-    def load_users(self) -> Dict[str, Dict[str, Any]]:
-        """Загружает данные пользователей из файла"""
+    def load_users(self) -> Dict[int, UserRecord]:
+        """Загружает снимок пользователей и проигрывает поверх него журнал"""
+        users, self.journal_events = self.read_users_files(self.filename, self.release_downloads)
+        if self.journal_events:
+            logger.info("Из журнала восстановлено событий: %s", self.journal_events)
+        records: Dict[int, UserRecord] = {}
+        # Словари освобождаются по мере перевода, чтобы не держать две копии
+        while users:
+            user_id, data = users.popitem()
+            records[int(user_id)] = UserRecord.from_json(user_id, data)
+        # popitem идет с конца - восстанавливаем порядок добавления
+        return dict(reversed(records.items()))
+
+    @classmethod
+    def read_users_files(cls, filename: str,
+                         releases: Optional[Dict[str, int]] = None) -> Tuple[Dict[str, Dict[str, Any]], int]:
+        """Читает снимок и журнал, возвращает пользователей и число событий журнала.
+
+        Если передан releases, в него загружаются скачивания по версиям архива.
+        """
+        users: Dict[str, Dict[str, Any]] = {}
+        if releases is None:
+            releases = {}
+        journal_events = 0
         try:
-            if os.path.exists(self.filename):
-                with open(self.filename, 'r', encoding='utf-8') as f:
-                    return json.load(f)
+            if os.path.exists(filename + ".releases"):
+                with open(filename + ".releases", 'r', encoding='utf-8') as f:
+                    releases.update(json.load(f))
+            if os.path.exists(filename):
+                with open(filename, 'r', encoding='utf-8') as f:
+                    users = dict(iter_json_object(f.read()))
             else:
-                logger.info(f"Файл {self.filename} не найден, создаем новый")
+                logger.info("Файл %s не найден, создаем новый", filename)
                 # Создаем пустой файл
-                with open(self.filename, 'w', encoding='utf-8') as f:
+                with open(filename, 'w', encoding='utf-8') as f:
                     json.dump({}, f)
-                return {}
         except Exception as e:
-            logger.error(f"Ошибка загрузки пользователей: {e}")
-            return {}
+            logger.error("Ошибка загрузки пользователей: %s", e)
+            return {}, 0
+
+        journal_filename = filename + ".journal"
+        if os.path.exists(journal_filename):
+            with open(journal_filename, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        # Недописанная строка после аварийного завершения
+                        logger.warning("Пропущена поврежденная запись журнала пользователей")
+                        continue
+                    cls._apply_event(users, event, releases)
+                    journal_events += 1
+        return users, journal_events
+
+    def _journal_ends_with_newline(self) -> bool:
+        """Проверяет, что журнал заканчивается целой строкой"""
+        with open(self.journal_filename, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    @staticmethod
+    def _apply_event(users: Dict[str, Dict[str, Any]], event: Dict[str, Any], releases: Dict[str, int]):
+        """Применяет событие журнала к словарю пользователей.
+
+        События содержат итоговые значения полей, а не приращения, поэтому
+        повторное проигрывание журнала поверх свежего снимка безопасно.
+        """
+        if event["e"] == "release":
+            releases[event["version"]] = event["downloads"]
+            return
+        user_id = event["id"]
+        if event["e"] == "join":
+            users[user_id] = dict(event["user"])
+        elif user_id in users:
+            users[user_id].update(event["fields"])
+
+    def _append_event(self, event: Dict[str, Any]):
+        """Ставит событие в очередь на запись в журнал (вызывается под self.lock)"""
+        self.pending_events.append(json.dumps(event, ensure_ascii=False) + "\n")
+        self.writer.mark_dirty()
+
+    def _write_pending_events(self):
+        """Дописывает накопленные события в журнал одной записью"""
+        with self.journal_lock:
+            with self.lock:
+                events, self.pending_events = self.pending_events, []
+            if not events:
+                return
+            try:
+                # После сбоя в журнале могла остаться недописанная строка:
+                # пустая строка отделяет ее, а при загрузке пропускается
+                self.journal.write(("\n" if self.journal_write_failed else "") + "".join(events))
+                self.journal.flush()
+                os.fsync(self.journal.fileno())
+            except Exception:
+                # Возвращаем пачку в начало очереди - GroupCommitWriter повторит запись.
+                # События содержат итоговые значения, так что повтор записанной части безопасен
+                self.journal_write_failed = True
+                with self.lock:
+                    self.pending_events[:0] = events
+                raise
+            self.journal_write_failed = False
+            self.journal_events += len(events)
 
     def save_users(self):
-        """Сохраняет данные пользователей в файл"""
+        """Сохраняет полный снимок пользователей и очищает журнал"""
+        with self.snapshot_lock:
+            self._save_snapshot()
+
+    def _save_snapshot(self):
+        # Снимок может включать события, еще не записанные в журнал: они
+        # окажутся в хвосте журнала, а повторное применение безопасно
+        with self.journal_lock:
+            with self.lock:
+                snapshot = [
+                    (record.user_id, record.username, record.first_name, record.last_name,
+                     record.join_ts, record.downloads, record.last_active_ts, record.blocked)
+                    for record in self.users.values()
+                ]
+                release_downloads = dict(self.release_downloads)
+            journal_offset = self.journal.tell()
+            events_in_snapshot = self.journal_events
+
         try:
-            with open(self.filename, 'w', encoding='utf-8') as f:
-                json.dump(self.users, f, ensure_ascii=False, indent=2)
+            if release_downloads:
+                tmp_path = self.releases_filename + ".tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(release_downloads, f, ensure_ascii=False, indent=2)
+                os.replace(tmp_path, self.releases_filename)
+            tmp_path = self.filename + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                self._write_snapshot(f, snapshot)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.filename)
         except Exception as e:
-            logger.error(f"Ошибка сохранения пользователей: {e}")
-
-    def add_user(self, user_id: str, username: str, first_name: str, last_name: str = ""):
-        """Добавляет/обновляет информацию о пользователе"""
-        if user_id not in self.users:
-            self.users[user_id] = {
-                "username": username,
-                "first_name": first_name,
-                "last_name": last_name,
-                "join_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "downloads": 0,
-                "last_active": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            }
-            logger.info(f"Добавлен новый пользователь: {username} ({user_id})")
-        else:
-            self.users[user_id]["last_active"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            self.users[user_id]["username"] = username
-            self.users[user_id]["first_name"] = first_name
-            if last_name:
-                self.users[user_id]["last_name"] = last_name
-
-        self.save_users()
-
-    def increment_download(self, user_id: str):
-        """Увеличивает счетчик скачиваний для пользователя"""
-        if user_id in self.users:
-            self.users[user_id]["downloads"] += 1
+            logger.error("Ошибка сохранения пользователей: %s", e)
+            return
+
+        with self.journal_lock:
+            # Переносим в новый журнал только события, записанные после снимка
+            self.journal.close()
+            with open(self.journal_filename, 'r', encoding='utf-8') as f:
+                f.seek(journal_offset)
+                tail = f.read()
+            tmp_path = self.journal_filename + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(tail)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.journal_filename)
+            self.journal = open(self.journal_filename, 'a', encoding='utf-8')
+            self.journal_events -= events_in_snapshot
+
+    @staticmethod
+    def _write_snapshot(f, snapshot: List[tuple]):
+        """Пишет снимок в формате json.dump(..., indent=2), не собирая его в памяти целиком"""
+        if not snapshot:
+            f.write("{}")
+            return
+        f.write("{\n")
+        last = len(snapshot) - 1
+        for i, values in enumerate(snapshot):
+            data = UserRecord(*values).to_json()
+            body = json.dumps(data, ensure_ascii=False, indent=2).replace("\n", "\n  ")
+            f.write(f'  "{values[0]}": {body}' + (",\n" if i < last else "\n"))
+        f.write("}")
+
+    def _compaction_loop(self):
+        """Фоновое сворачивание журнала в снимок"""
+        last_compaction = time.monotonic()
+        while not self._stop_event.wait(1):
+            due = time.monotonic() - last_compaction >= USERS_COMPACT_INTERVAL
+            if self.journal_events >= USERS_COMPACT_EVENTS or (due and self.journal_events):
+                self.save_users()
+                self.check_consistency()
+                last_compaction = time.monotonic()
+
+    def flush(self):
+        """Немедленно записывает накопленные изменения"""
+        self.writer.flush()
+
+    def close(self):
+        """Сохраняет накопленные изменения, финальный снимок и закрывает журнал"""
+        self._stop_event.set()
+        self.writer.stop()
+        if self.journal_events:
             self.save_users()
+        with self.journal_lock:
+            self.journal.close()
 
-    def get_total_users(self) -> int:
-        """Возвращает общее количество пользователей"""
-        return len(self.users)
+    def get_persistence_statistics(self) -> Dict[str, Any]:
+        """Возвращает метрики записи на диск"""
+        stats = self.writer.get_statistics()
+        stats["journal_events"] = self.journal_events
+        return stats
 
-    def get_active_today(self) -> int:
-        """Возвращает количество пользователей, активных сегодня"""
-        today = datetime.now().strftime("%Y-%m-%d")
-        count = 0
-        for user_data in self.users.values():
-            if user_data.get("last_active", "").startswith(today):
-                count += 1
-        return count
-    
-    def get_statistics(self) -> Dict[str, Any]:
-        """Возвращает статистику"""
+    def add_user(self, user_id: str, username: str, first_name: str, last_name: str = "") -> bool:
+        """Добавляет/обновляет информацию о пользователе; True, если пользователь новый"""
+        key = int(user_id)
+        now = int(time.time())
+        with self.lock:
+            record = self.users.get(key)
+            if record is None:
+                record = UserRecord(key, username, first_name, last_name, now, 0, now)
+                self.users[key] = record
+                self.user_order.append(key)
+                self._append_event({"e": "join", "id": str(key), "user": record.to_json()})
+                self._mark_active(key, now)
+                logger.info("Добавлен новый пользователь: %s (%s)", username, user_id, extra={"sampled": True})
+                return True
+            else:
+                record.last_active_ts = now
+                record.username = username
+                record.first_name = first_name
+                fields = {"last_active": format_timestamp(now), "username": username, "first_name": first_name}
+                if last_name:
+                    record.last_name = last_name
+                    fields["last_name"] = last_name
+                if record.blocked:
+                    # Пользователь снова написал боту - значит, разблокировал его
+                    record.blocked = False
+                    fields["blocked"] = False
+                self._append_event({"e": "touch", "id": str(key), "fields": fields})
+                self._mark_active(key, now)
+                return False
+
+    def touch(self, user_id: str):
+        """Обновляет время последней активности пользователя"""
+        key = int(user_id)
+        now = int(time.time())
+        with self.lock:
+            record = self.users.get(key)
+            if record is not None:
+                record.last_active_ts = now
+                self._append_event({"e": "touch", "id": str(key), "fields": {"last_active": format_timestamp(now)}})
+                self._mark_active(key, now)
+
+    def increment_download(self, user_id: str, version: Optional[str] = None):
+        """Увеличивает счетчик скачиваний для пользователя и версии архива"""
+        key = int(user_id)
+        with self.lock:
+            record = self.users.get(key)
+            if record is not None:
+                record.downloads += 1
+                self.total_downloads += 1
+                self.leaderboard.update(key, record.downloads)
+                self._append_event({"e": "download", "id": str(key), "fields": {"downloads": record.downloads}})
+            if version:
+                downloads = self.release_downloads.get(version, 0) + 1
+                self.release_downloads[version] = downloads
+                self._append_event({"e": "release", "version": version, "downloads": downloads})
+
+    def get_release_downloads(self) -> Dict[str, int]:
+        """Возвращает число скачиваний по версиям архива"""
+        with self.lock:
+            return dict(self.release_downloads)
+
+    def mark_blocked(self, user_id: str):
+        """Отмечает, что пользователь заблокировал бота"""
+        key = int(user_id)
+        with self.lock:
+            record = self.users.get(key)
+            if record is not None and not record.blocked:
+                record.blocked = True
+                self._append_event({"e": "blocked", "id": str(key), "fields": {"blocked": True}})
+
+    def claim_update(self, update_id: int) -> bool:
+        """JSON-хранилище работает в одном процессе - повторы отсекает UpdateDispatcher"""
+        return True
+
+    def release_update(self, update_id: int):
+        """Парный к claim_update; в одном процессе делать нечего"""
+
+    def get_user(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Возвращает данные пользователя в формате users_data.json или None"""
+        with self.lock:
+            record = self.users.get(int(user_id))
+            return record.to_json() if record is not None else None
+
+    def iter_user_ids(self, after: int = 0, batch_size: int = 500) -> Iterator[Tuple[int, str]]:
+        """Обходит пользователей порциями, выдавая (позиция, user_id).
+
+        Позиция растет монотонно, поэтому обход можно продолжить с
+        сохраненной позиции. Пользователи, добавленные во время обхода,
+        тоже будут выданы.
+        """
+        position = after
+        while True:
+            with self.lock:
+                chunk = self.user_order[position:position + batch_size]
+            if not chunk:
+                return
+            for key in chunk:
+                position += 1
+                yield position, str(key)
+
+    def iter_user_records(self, after: int = 0, until: Optional[int] = None,
+                          batch_size: int = 500) -> Iterator[Tuple[int, str, Dict[str, Any]]]:
+        """Обходит пользователей порциями, выдавая (позиция, user_id, данные).
+
+        Позиции те же, что у iter_user_ids; until ограничивает обход позицией
+        включительно. В формат users_data.json под блокировкой переводится
+        только текущая порция.
+        """
+        position = after
+        while until is None or position < until:
+            end = position + batch_size if until is None else min(position + batch_size, until)
+            with self.lock:
+                chunk = [(key, self.users[key].to_json()) for key in self.user_order[position:end]]
+            if not chunk:
+                return
+            for key, data in chunk:
+                position += 1
+                yield position, str(key), data
+
+    def page_end(self, after: int, limit: Optional[int] = None) -> Tuple[int, bool]:
+        """Возвращает позицию последнего из limit пользователей после after и признак конца данных"""
+        with self.lock:
+            total = len(self.user_order)
+        end = total if limit is None else min(after + limit, total)
+        return max(end, after), end >= total
+
+    def import_users(self, records: Iterable[Tuple[str, Dict[str, Any]]], batch_size: int = 1000,
+                     overwrite: bool = True) -> Dict[str, int]:
+        """Загружает пользователей пачками; возвращает число добавленных, обновленных и пропущенных.
+
+        Пачка применяется под блокировкой и сразу дописывается в журнал
+        событиями join, поэтому бот между пачками продолжает работать, а
+        прерванный импорт можно повторить. overwrite=False оставляет уже
+        известных пользователей как есть.
+        """
+        counts = {"added": 0, "updated": 0, "skipped": 0}
+        recount = False
+        for batch in iter_batches(records, batch_size):
+            with self.lock:
+                self._roll_active_day(time.time())
+                day_start, day_end = self.active_day
+                for user_id, data in batch:
+                    record = UserRecord.from_json(user_id, data)
+                    key = record.user_id
+                    previous = self.users.get(key)
+                    if previous is None:
+                        self.user_order.append(key)
+                        counts["added"] += 1
+                    elif not overwrite:
+                        counts["skipped"] += 1
+                        continue
+                    else:
+                        self.total_downloads -= previous.downloads
+                        self.active_today.discard(key)
+                        # Топ умеет только увеличивать счетчики - уменьшение требует пересчета
+                        recount = recount or record.downloads < previous.downloads
+                        counts["updated"] += 1
+                    self.users[key] = record
+                    self.total_downloads += record.downloads
+                    self.leaderboard.update(key, record.downloads)
+                    if day_start <= record.last_active_ts < day_end:
+                        self.active_today.add(key)
+                    self._append_event({"e": "join", "id": str(key), "user": record.to_json()})
+            self.writer.flush()
+        if recount:
+            self.recount_totals()
+        return counts
+
+    def _mark_active(self, key: int, now: int):
+        """Отмечает пользователя активным сегодня (вызывается под self.lock)"""
+        self._roll_active_day(now)
+        self.active_today.add(key)
+
+    def _roll_active_day(self, now: float):
+        """Сбрасывает множество активных пользователей после полуночи"""
+        start, end = self.active_day
+        if not start <= now < end:
+            self.active_day = day_bounds(now)
+            self.active_today = set()
+
+    def recount_totals(self) -> Dict[str, int]:
+        """Пересчитывает агрегаты полным обходом пользователей"""
+        with self.lock:
+            self.total_downloads = sum(record.downloads for record in self.users.values())
+            self.leaderboard.rebuild((key, record.downloads) for key, record in self.users.items())
+            self.active_day = day_bounds(time.time())
+            day_start, day_end = self.active_day
+            self.active_today = {
+                key for key, record in self.users.items() if day_start <= record.last_active_ts < day_end
+            }
+            return {
+                "total_users": len(self.users),
+                "total_downloads": self.total_downloads,
+                "active_today": len(self.active_today)
+            }
+
+    def check_consistency(self) -> bool:
+        """Сверяет агрегаты с полным пересчетом и исправляет расхождения"""
+        with self.lock:
+            running = {
+                "total_users": self.get_total_users(),
+                "total_downloads": self.total_downloads,
+                "active_today": self.get_active_today()
+            }
+            recounted = self.recount_totals()
+        if running != recounted:
+            logger.warning("Агрегаты пользователей расходились с пересчетом: %s != %s", running, recounted)
+            return False
+        return True
+
+    def get_total_users(self) -> int:
+        """Возвращает общее количество пользователей"""
+        return len(self.users)
+
+    def get_active_today(self) -> int:
+        """Возвращает количество пользователей, активных сегодня"""
+        with self.lock:
+            self._roll_active_day(time.time())
+            return len(self.active_today)
+
+    def get_total_downloads(self) -> int:
+        """Возвращает общее количество скачиваний"""
+        return self.total_downloads
+
+    def get_top_downloaders(self, limit: int = 5) -> List[Tuple[str, int]]:
+        """Возвращает (имя, скачивания) для самых активных пользователей"""
+        with self.lock:
+            return [
+                (self.users[key].first_name, downloads)
+                for key, downloads in self.leaderboard.top(limit)
+            ]
+
+    def get_statistics(self) -> Dict[str, Any]:
+        """Возвращает статистику"""
+        return {
+            "total_users": self.get_total_users(),
+            "active_today": self.get_active_today(),
+            "total_downloads": self.get_total_downloads(),
+            "last_updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }
+
+
+USER_FIELDS = ("username", "first_name", "last_name", "join_date", "downloads", "last_active")
+
+# Наибольший rowid SQLite - граница обхода "до конца таблицы"
+SQLITE_MAX_ROWID = (1 << 63) - 1
+
+
+class _SQLiteUsersView(Mapping):
+    """Представление таблицы users в виде словаря только для чтения"""
+
+    def __init__(self, manager: "SQLiteUserManager"):
+        self.manager = manager
+
+    def __getitem__(self, user_id: str) -> Dict[str, Any]:
+        user = self.manager.get_user(user_id)
+        if user is None:
+            raise KeyError(user_id)
+        return user
+
+    def __contains__(self, user_id) -> bool:
+        return self.manager.get_user(user_id) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        # Читаем идентификаторы порциями, чтобы не держать блокировку весь обход
+        last_id = ""
+        while True:
+            with self.manager.lock:
+                rows = self.manager.conn.execute(
+                    "SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT 500",
+                    (last_id,)
+                ).fetchall()
+            if not rows:
+                return
+            for (user_id,) in rows:
+                yield user_id
+            last_id = rows[-1][0]
+
+    def __len__(self) -> int:
+        return self.manager.get_total_users()
+
+
+class SQLiteUserManager:
+    """Хранит пользователей в SQLite (режим WAL) с тем же интерфейсом, что и UserManager.
+
+    Одно соединение разделяется между потоком опроса Telegram и потоками
+    Flask и защищено блокировкой. Статистика считается запросами по
+    индексам на last_active и downloads.
+
+    Изменения выполняются в открытой транзакции, которую GroupCommitWriter
+    фиксирует пачкой. Чтения идут через то же соединение и видят их сразу.
+    """
+
+    def __init__(self, filename: str, migrate_from: Optional[str] = None):
+        self.filename = filename
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA busy_timeout=5000")
+        self.create_schema()
+        self.users = _SQLiteUsersView(self)
+        if migrate_from:
+            self.migrate_from_json(migrate_from)
+        self.writer = GroupCommitWriter(
+            self._commit, USERS_FLUSH_INTERVAL_MS, USERS_FLUSH_MAX_CHANGES, "users-writer"
+        )
+
+    def create_schema(self):
+        """Создает таблицы и индексы, если их еще нет"""
+        with self.lock:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id TEXT PRIMARY KEY,
+                    username TEXT NOT NULL DEFAULT '',
+                    first_name TEXT NOT NULL DEFAULT '',
+                    last_name TEXT NOT NULL DEFAULT '',
+                    join_date TEXT NOT NULL,
+                    downloads INTEGER NOT NULL DEFAULT 0,
+                    last_active TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_users_last_active ON users(last_active);
+                CREATE INDEX IF NOT EXISTS idx_users_downloads ON users(downloads);
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS processed_updates (
+                    update_id INTEGER PRIMARY KEY
+                );
+                CREATE TABLE IF NOT EXISTS release_downloads (
+                    version TEXT PRIMARY KEY,
+                    downloads INTEGER NOT NULL DEFAULT 0
+                );
+            """)
+            columns = {row[1] for row in self.conn.execute("PRAGMA table_info(users)")}
+            if "blocked" not in columns:
+                self.conn.execute("ALTER TABLE users ADD COLUMN blocked INTEGER NOT NULL DEFAULT 0")
+
+    def migrate_from_json(self, json_filename: str):
+        """Однократно переносит пользователей из users_data.json (и его журнала)"""
+        with self.lock:
+            done = self.conn.execute("SELECT value FROM meta WHERE key = 'migrated_from'").fetchone()
+            if done or not os.path.exists(json_filename):
+                return
+            releases: Dict[str, int] = {}
+            users, _ = UserManager.read_users_files(json_filename, releases)
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO users (user_id, username, first_name, last_name, "
+                "join_date, downloads, last_active, blocked) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                ((user_id,) + tuple(data.get(field, "") for field in USER_FIELDS)
+                 + (int(data.get("blocked", False)),)
+                 for user_id, data in users.items())
+            )
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO release_downloads (version, downloads) VALUES (?, ?)",
+                releases.items()
+            )
+            self.conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('migrated_from', ?)", (json_filename,)
+            )
+            self.conn.execute("COMMIT")
+        logger.info("Перенесено пользователей из %s в SQLite: %s", json_filename, len(users))
+
+    def _write(self, sql: str, params: tuple) -> sqlite3.Cursor:
+        """Выполняет изменение в текущей транзакции (вызывается под self.lock)"""
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN")
+        cursor = self.conn.execute(sql, params)
+        self.writer.mark_dirty()
+        return cursor
+
+    def _commit(self):
+        """Фиксирует накопленную транзакцию"""
+        with self.lock:
+            if self.conn.in_transaction:
+                self.conn.execute("COMMIT")
+
+    def flush(self):
+        """Немедленно фиксирует накопленные изменения"""
+        self.writer.flush()
+
+    def save_users(self):
+        """Фиксирует изменения и переносит WAL в основной файл базы"""
+        self.writer.flush()
+        with self.lock:
+            self.conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def close(self):
+        """Фиксирует изменения и закрывает соединение с базой"""
+        self.writer.stop()
+        with self.lock:
+            self.conn.close()
+
+    def get_persistence_statistics(self) -> Dict[str, Any]:
+        """Возвращает метрики записи на диск"""
+        return self.writer.get_statistics()
+
+    def get_user(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Возвращает данные пользователя или None"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT username, first_name, last_name, join_date, downloads, last_active, blocked "
+                "FROM users WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        if not row:
+            return None
+        user = dict(zip(USER_FIELDS, row))
+        user["blocked"] = bool(row[-1])
+        return user
+
+    def mark_blocked(self, user_id: str):
+        """Отмечает, что пользователь заблокировал бота"""
+        with self.lock:
+            self._write("UPDATE users SET blocked = 1 WHERE user_id = ?", (user_id,))
+
+    def claim_update(self, update_id: int) -> bool:
+        """Отмечает обновление как принятое; False, если его уже принял другой процесс.
+
+        Отметка фиксируется вместе с групповой транзакцией, а повторы от
+        Telegram приходят через секунды, так что задержки коммита хватает.
+        Старые отметки (на UPDATE_DEDUP_SIZE позади) периодически удаляются.
+        """
+        with self.lock:
+            cursor = self._write(
+                "INSERT OR IGNORE INTO processed_updates (update_id) VALUES (?)", (update_id,)
+            )
+            if cursor.rowcount == 0:
+                return False
+            if update_id % 1000 == 0:
+                self._write(
+                    "DELETE FROM processed_updates WHERE update_id < ?",
+                    (update_id - UPDATE_DEDUP_SIZE,)
+                )
+            return True
+
+    def release_update(self, update_id: int):
+        """Снимает отметку, если обновление не удалось принять (повтор Telegram пройдет)"""
+        with self.lock:
+            self._write("DELETE FROM processed_updates WHERE update_id = ?", (update_id,))
+
+    def iter_user_ids(self, after: int = 0, batch_size: int = 500) -> Iterator[Tuple[int, str]]:
+        """Обходит пользователей порциями по rowid, выдавая (позиция, user_id)"""
+        position = after
+        while True:
+            with self.lock:
+                rows = self.conn.execute(
+                    "SELECT rowid, user_id FROM users WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                    (position, batch_size)
+                ).fetchall()
+            if not rows:
+                return
+            for position, user_id in rows:
+                yield position, user_id
+
+    def iter_user_records(self, after: int = 0, until: Optional[int] = None,
+                          batch_size: int = 500) -> Iterator[Tuple[int, str, Dict[str, Any]]]:
+        """Обходит пользователей порциями по rowid, выдавая (позиция, user_id, данные)"""
+        position = after
+        last = SQLITE_MAX_ROWID if until is None else until
+        while True:
+            with self.lock:
+                rows = self.conn.execute(
+                    "SELECT rowid, user_id, username, first_name, last_name, join_date, downloads, "
+                    "last_active, blocked FROM users WHERE rowid > ? AND rowid <= ? ORDER BY rowid LIMIT ?",
+                    (position, last, batch_size)
+                ).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                position = row[0]
+                user = dict(zip(USER_FIELDS, row[2:8]))
+                user["blocked"] = bool(row[8])
+                yield position, row[1], user
+
+    def page_end(self, after: int, limit: Optional[int] = None) -> Tuple[int, bool]:
+        """Возвращает rowid последнего из limit пользователей после after и признак конца данных"""
+        with self.lock:
+            if limit is not None:
+                row = self.conn.execute(
+                    "SELECT rowid FROM users WHERE rowid > ? ORDER BY rowid LIMIT 1 OFFSET ?",
+                    (after, limit - 1)
+                ).fetchone()
+                if row:
+                    more = self.conn.execute(
+                        "SELECT 1 FROM users WHERE rowid > ? LIMIT 1", (row[0],)
+                    ).fetchone()
+                    return row[0], more is None
+            last = self.conn.execute("SELECT MAX(rowid) FROM users").fetchone()[0]
+        return max(last or 0, after), True
+
+    def import_users(self, records: Iterable[Tuple[str, Dict[str, Any]]], batch_size: int = 1000,
+                     overwrite: bool = True) -> Dict[str, int]:
+        """Загружает пользователей пачками; возвращает число добавленных, обновленных и пропущенных.
+
+        Каждая пачка фиксируется отдельной транзакцией, а между пачками
+        соединение свободно для обработчиков бота. Обновление сохраняет
+        rowid, поэтому позиции выгрузки не меняются.
+        """
+        counts = {"added": 0, "updated": 0, "skipped": 0}
+        for batch in iter_batches(records, batch_size):
+            with self.lock:
+                for user_id, data in batch:
+                    values = tuple(data[field] for field in USER_FIELDS) + (int(data.get("blocked", False)),)
+                    cursor = self._write(
+                        "INSERT OR IGNORE INTO users (user_id, username, first_name, last_name, "
+                        "join_date, downloads, last_active, blocked) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (user_id,) + values
+                    )
+                    if cursor.rowcount:
+                        counts["added"] += 1
+                    elif overwrite:
+                        self._write(
+                            "UPDATE users SET username = ?, first_name = ?, last_name = ?, join_date = ?, "
+                            "downloads = ?, last_active = ?, blocked = ? WHERE user_id = ?",
+                            values + (user_id,)
+                        )
+                        counts["updated"] += 1
+                    else:
+                        counts["skipped"] += 1
+            self.writer.flush()
+        return counts
+
+    def add_user(self, user_id: str, username: str, first_name: str, last_name: str = "") -> bool:
+        """Добавляет/обновляет информацию о пользователе; True, если пользователь новый"""
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self.lock:
+            cursor = self._write(
+                "INSERT OR IGNORE INTO users (user_id, username, first_name, last_name, "
+                "join_date, downloads, last_active) VALUES (?, ?, ?, ?, ?, 0, ?)",
+                (user_id, username, first_name, last_name, now, now)
+            )
+            if cursor.rowcount:
+                logger.info("Добавлен новый пользователь: %s (%s)", username, user_id, extra={"sampled": True})
+                return True
+            self._write(
+                "UPDATE users SET last_active = ?, username = ?, first_name = ?, blocked = 0, "
+                "last_name = CASE WHEN ? != '' THEN ? ELSE last_name END WHERE user_id = ?",
+                (now, username, first_name, last_name, last_name, user_id)
+            )
+            return False
+
+    def touch(self, user_id: str):
+        """Обновляет время последней активности пользователя"""
+        with self.lock:
+            self._write(
+                "UPDATE users SET last_active = ? WHERE user_id = ?",
+                (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), user_id)
+            )
+
+    def increment_download(self, user_id: str, version: Optional[str] = None):
+        """Увеличивает счетчик скачиваний для пользователя и версии архива"""
+        with self.lock:
+            self._write(
+                "UPDATE users SET downloads = downloads + 1 WHERE user_id = ?", (user_id,)
+            )
+            if version:
+                self._write(
+                    "INSERT INTO release_downloads (version, downloads) VALUES (?, 1) "
+                    "ON CONFLICT(version) DO UPDATE SET downloads = downloads + 1", (version,)
+                )
+
+    def get_release_downloads(self) -> Dict[str, int]:
+        """Возвращает число скачиваний по версиям архива"""
+        with self.lock:
+            return dict(self.conn.execute("SELECT version, downloads FROM release_downloads"))
+
+    def get_total_users(self) -> int:
+        """Возвращает общее количество пользователей"""
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def get_active_today(self) -> int:
+        """Возвращает количество пользователей, активных сегодня"""
+        today = datetime.now().strftime("%Y-%m-%d")
+        with self.lock:
+            # Диапазон по индексу last_active: все строки, начинающиеся с сегодняшней даты
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM users WHERE last_active >= ? AND last_active < ?",
+                (today, today + ":")
+            ).fetchone()[0]
+
+    def get_total_downloads(self) -> int:
+        """Возвращает общее количество скачиваний"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COALESCE(SUM(downloads), 0) FROM users WHERE downloads > 0"
+            ).fetchone()[0]
+
+    def get_top_downloaders(self, limit: int = 5) -> List[Tuple[str, int]]:
+        """Возвращает (имя, скачивания) для самых активных пользователей"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT first_name, downloads FROM users WHERE downloads > 0 "
+                "ORDER BY downloads DESC LIMIT ?", (limit,)
+            ).fetchall()
+
+    def get_statistics(self) -> Dict[str, Any]:
+        """Возвращает статистику"""
+        return {
+            "total_users": self.get_total_users(),
+            "active_today": self.get_active_today(),
+            "total_downloads": self.get_total_downloads(),
+            "last_updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }
+
+
+def create_user_manager():
+    """Создает хранилище пользователей, выбранное переменной USER_STORAGE"""
+    if USER_STORAGE == "sqlite":
+        logger.info("Хранилище пользователей: SQLite (%s)", USERS_DB_FILE)
+        return SQLiteUserManager(USERS_DB_FILE, migrate_from=USERS_FILE)
+    logger.info("Хранилище пользователей: JSON с журналом (%s)", USERS_FILE)
+    return UserManager(USERS_FILE)
+
+
+# Выгрузка пользователей: формат -> MIME-тип ответа
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+EXPORT_FIELDS = ("user_id",) + USER_FIELDS + ("blocked",)
+_DATETIME_PATTERN = re.compile(r"\d{4}-\d\d-\d\d \d\d:\d\d:\d\d")
+
+
+def export_user_lines(fmt: str, after: int = 0, until: Optional[int] = None) -> Iterator[str]:
+    """Выдает пользователей с позиции after до until строками NDJSON или CSV.
+
+    Хранилище читается порциями по EXPORT_BATCH_SIZE, и каждая порция
+    сразу отдается потребителю (ответу Flask или файлу), так что ни
+    выгрузка, ни копия пользователей в памяти не собираются. Это не снимок
+    на один момент: изменения, сделанные во время обхода, попадают в еще
+    не прочитанные порции.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    if fmt == "csv":
+        writer.writerow(EXPORT_FIELDS)
+    rows = 0
+    for _, user_id, data in user_manager.iter_user_records(after, until, EXPORT_BATCH_SIZE):
+        blocked = bool(data.get("blocked", False))
+        if fmt == "csv":
+            writer.writerow((user_id,) + tuple(data[field] for field in USER_FIELDS) + (int(blocked),))
+        else:
+            buffer.write(json.dumps({"user_id": user_id, **data, "blocked": blocked}, ensure_ascii=False))
+            buffer.write("\n")
+        rows += 1
+        if rows % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def parse_import_record(raw: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    """Проверяет запись импорта и приводит ее к формату users_data.json"""
+    user_id = str(raw.get("user_id") or "").strip()
+    if not (user_id.isascii() and user_id.isdigit()):
+        raise ValueError(f"некорректный user_id: {user_id!r}")
+    # Оба хранилища должны получить один и тот же ключ ("007" и "7" - один пользователь)
+    user_id = str(int(user_id))
+    data = {field: str(raw.get(field) or "") for field in ("username", "first_name", "last_name")}
+    for field in ("join_date", "last_active"):
+        value = raw.get(field)
+        if not value:
+            value = format_timestamp(int(time.time()))
+        elif _DATETIME_PATTERN.fullmatch(value):
+            # Формат уже проверен - быстрый разбор проверяет только сами значения
+            parse_timestamp(value)
+        else:
+            # parse_timestamp читает поля по позициям и принял бы любые разделители,
+            # поэтому остальные строки разбираются строго. Время приводится к одному
+            # виду, чтобы сравнение строк в SQLite оставалось верным
+            value = datetime.strptime(str(value), DATETIME_FORMAT).strftime(DATETIME_FORMAT)
+        data[field] = value
+    data["downloads"] = int(raw.get("downloads") or 0)
+    data["blocked"] = str(raw.get("blocked", "")).strip().lower() in ("1", "true")
+    return user_id, data
+
+
+class ImportReader:
+    """Разбирает строки NDJSON или CSV (с заголовком) в пары (user_id, данные).
+
+    Строки читаются по одной. Некорректная строка не прерывает импорт: она
+    пропускается и учитывается в rejected, а первые IMPORT_ERRORS_KEEP
+    ошибок сохраняются с номерами строк.
+    """
+
+    def __init__(self, lines: Iterable[str], fmt: str):
+        self.lines = lines
+        self.fmt = fmt
+        self.rejected = 0
+        self.errors: List[str] = []
+
+    def _reject(self, number: int, error: Exception):
+        self.rejected += 1
+        if len(self.errors) < IMPORT_ERRORS_KEEP:
+            self.errors.append(f"строка {number}: {error}")
+
+    def __iter__(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        if self.fmt == "csv":
+            reader = csv.DictReader(self.lines)
+            for row in reader:
+                try:
+                    record = parse_import_record(row)
+                except (ValueError, TypeError) as e:
+                    self._reject(reader.line_num, e)
+                    continue
+                yield record
+            return
+        for number, line in enumerate(self.lines, 1):
+            if not line.strip():
+                continue
+            try:
+                raw = json.loads(line)
+                if not isinstance(raw, dict):
+                    raise ValueError("ожидается JSON-объект")
+                record = parse_import_record(raw)
+            except (ValueError, TypeError) as e:
+                self._reject(number, e)
+                continue
+            yield record
+
+
+def file_sha256(path: str) -> str:
+    """Считает SHA-256 файла, читая его блоками"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Типы событий активности и команды, которые различает история
+ACTIVITY_JOIN = 1
+ACTIVITY_COMMAND = 2
+ACTIVITY_DOWNLOAD = 3
+ACTIVITY_EVENT_METRICS = {ACTIVITY_JOIN: "joins", ACTIVITY_COMMAND: "commands", ACTIVITY_DOWNLOAD: "downloads"}
+ACTIVITY_COMMANDS = ("start", "stats", "download", "help", "broadcast", "text")
+
+
+class ActivityStore:
+    """Журнал событий активности и почасовые/посуточные сводки по нему.
+
+    Каждое событие (новый пользователь, команда, скачивание) - запись
+    фиксированного размера в activity.bin: время, user_id, тип и номер
+    команды, 14 байт. Файл только дописывается пачками через
+    GroupCommitWriter; пачка пишется одним вызовом с O_APPEND, поэтому
+    в файл могут писать несколько процессов.
+
+    Сводки обновляются инкрементально: читается только хвост файла после
+    последнего прочитанного смещения. Смещение вместе со сводками
+    периодически сохраняется в activity_rollups.json, и при запуске вся
+    история не перечитывается. Запросы истории читают только сводки.
+
+    Уникальные пользователи считаются точно для текущих часа и суток -
+    их множества хранятся до смены периода.
+    """
+
+    RECORD = struct.Struct("<IqBB")
+    METRICS = ("joins", "commands", "downloads", "active_users")
+
+    def __init__(self, filename: str, rollups_filename: str, hours_keep: int):
+        self.filename = filename
+        self.rollups_filename = rollups_filename
+        self.hours_keep = hours_keep
+        self.lock = threading.Lock()
+        self.pending_lock = threading.Lock()
+        self.pending: List[bytes] = []
+        self.offset = 0
+        self.days: Dict[str, Dict[str, int]] = {}
+        self.hours: Dict[str, Dict[str, int]] = {}
+        self.open_day: Optional[str] = None
+        self.day_users: set = set()
+        self.open_hour: Optional[str] = None
+        self.hour_users: set = set()
+        self.day_range = (0, 0)
+        self.day_key = ""
+        self.load_checkpoint()
+        self.fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        size = os.fstat(self.fd).st_size
+        if size % self.RECORD.size:
+            # Оборванная запись после аварийного завершения
+            os.ftruncate(self.fd, size - size % self.RECORD.size)
+        self.refresh()
+        self.checkpointed_at = time.monotonic()
+        self.writer = GroupCommitWriter(
+            self._write_pending, USERS_FLUSH_INTERVAL_MS, USERS_FLUSH_MAX_CHANGES, "activity-writer"
+        )
+
+    def load_checkpoint(self):
+        """Загружает сохраненные сводки и смещение в журнале"""
+        try:
+            if not os.path.exists(self.rollups_filename):
+                return
+            with open(self.rollups_filename, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except Exception as e:
+            logger.error("Ошибка загрузки сводок активности: %s", e)
+            return
+        self.offset = state["offset"]
+        self.days = state["days"]
+        self.hours = state["hours"]
+        self.open_day = state["open_day"]
+        self.day_users = set(state["day_users"])
+        self.open_hour = state["open_hour"]
+        self.hour_users = set(state["hour_users"])
+
+    def checkpoint(self):
+        """Атомарно сохраняет сводки вместе со смещением в журнале"""
+        with self.lock:
+            if len(self.hours) > self.hours_keep:
+                for key in sorted(self.hours)[:len(self.hours) - self.hours_keep]:
+                    del self.hours[key]
+            state = {
+                "offset": self.offset,
+                "open_day": self.open_day,
+                "day_users": list(self.day_users),
+                "open_hour": self.open_hour,
+                "hour_users": list(self.hour_users),
+                "days": self.days,
+                "hours": self.hours
+            }
+            tmp_path = f"{self.rollups_filename}.tmp{os.getpid()}"
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(state, f, separators=(',', ':'))
+                os.replace(tmp_path, self.rollups_filename)
+            except Exception as e:
+                logger.error("Ошибка сохранения сводок активности: %s", e)
+        self.checkpointed_at = time.monotonic()
+
+    def record(self, event_type: int, user_id, command: Optional[str] = None):
+        """Ставит событие в очередь на запись"""
+        code = ACTIVITY_COMMANDS.index(command) if command in ACTIVITY_COMMANDS else 255
+        data = self.RECORD.pack(int(time.time()), int(user_id), event_type, code)
+        with self.pending_lock:
+            self.pending.append(data)
+        self.writer.mark_dirty()
+
+    def _write_pending(self):
+        """Дописывает накопленные события одной записью и обновляет сводки"""
+        with self.pending_lock:
+            events, self.pending = self.pending, []
+        data = b"".join(events)
+        try:
+            while data:
+                data = data[os.write(self.fd, data):]
+        except Exception:
+            # Недописанный остаток возвращается в начало очереди - GroupCommitWriter
+            # повторит запись. Записи фиксированной длины, поэтому остаток
+            # дописывает оборванную запись и выравнивание журнала не сбивается
+            with self.pending_lock:
+                self.pending[:0] = [data]
+            raise
+        self.refresh()
+        if time.monotonic() - self.checkpointed_at >= ACTIVITY_CHECKPOINT_INTERVAL:
+            self.checkpoint()
+
+    def refresh(self):
+        """Учитывает в сводках события, дописанные после прошлого чтения (в том числе другими процессами)"""
+        with self.lock:
+            size = os.path.getsize(self.filename)
+            if size < self.offset:
+                logger.warning("Журнал активности стал короче сохраненного смещения, сводки строятся заново")
+                self.offset = 0
+                self.days, self.hours = {}, {}
+                self.open_day, self.day_users, self.open_hour, self.hour_users = None, set(), None, set()
+            end = size - size % self.RECORD.size
+            if end <= self.offset:
+                return
+            with open(self.filename, 'rb') as f:
+                f.seek(self.offset)
+                while self.offset < end:
+                    chunk = f.read(min(end - self.offset, self.RECORD.size * 65536))
+                    if not chunk:
+                        break
+                    for event in self.RECORD.iter_unpack(chunk):
+                        self._apply(*event)
+                    self.offset += len(chunk)
+
+    def _apply(self, timestamp: int, user_id: int, event_type: int, code: int):
+        """Добавляет событие в сводки (вызывается под self.lock)"""
+        metric = ACTIVITY_EVENT_METRICS.get(event_type)
+        if metric is None:
+            return
+        if not self.day_range[0] <= timestamp < self.day_range[1]:
+            self.day_range = day_bounds(timestamp)
+            self.day_key = datetime.fromtimestamp(self.day_range[0]).strftime("%Y-%m-%d")
+        day_key = self.day_key
+        hour_key = f"{day_key} {(timestamp - self.day_range[0]) // 3600:02d}"
+        day = self.days.setdefault(day_key, {})
+        hour = self.hours.setdefault(hour_key, {})
+        names = [metric]
+        if event_type == ACTIVITY_COMMAND and code < len(ACTIVITY_COMMANDS):
+            names.append("command." + ACTIVITY_COMMANDS[code])
+        for bucket in (day, hour):
+            for name in names:
+                bucket[name] = bucket.get(name, 0) + 1
+
+        # События из уже закрытого периода (запоздавшие из другого процесса)
+        # в уникальных пользователях не учитываются
+        if self.open_day is None or day_key > self.open_day:
+            self.open_day, self.day_users = day_key, set()
+        if day_key == self.open_day and user_id not in self.day_users:
+            self.day_users.add(user_id)
+            day["active_users"] = day.get("active_users", 0) + 1
+        if self.open_hour is None or hour_key > self.open_hour:
+            self.open_hour, self.hour_users = hour_key, set()
+        if hour_key == self.open_hour and user_id not in self.hour_users:
+            self.hour_users.add(user_id)
+            hour["active_users"] = hour.get("active_users", 0) + 1
+
+    @classmethod
+    def is_metric(cls, metric: str) -> bool:
+        if metric.startswith("command."):
+            return metric[len("command."):] in ACTIVITY_COMMANDS
+        return metric in cls.METRICS
+
+    def history(self, metric: str, granularity: str, start: datetime, end: datetime) -> List[Dict[str, Any]]:
+        """Возвращает значения метрики по часам или суткам от start до end включительно"""
+        self.refresh()
+        if granularity == "hour":
+            current = start.replace(minute=0, second=0, microsecond=0)
+            step = timedelta(hours=1)
+            key_format = "%Y-%m-%d %H"
+        else:
+            current = start.replace(hour=0, minute=0, second=0, microsecond=0)
+            step = timedelta(days=1)
+            key_format = "%Y-%m-%d"
+        points = []
+        with self.lock:
+            rollups = self.hours if granularity == "hour" else self.days
+            while current <= end:
+                key = current.strftime(key_format)
+                points.append({"t": key, "value": rollups.get(key, {}).get(metric, 0)})
+                current += step
+        return points
+
+    def flush(self):
+        """Немедленно записывает накопленные события"""
+        self.writer.flush()
+
+    def close(self):
+        """Записывает события, сохраняет сводки и закрывает журнал"""
+        if self.fd is None:
+            return
+        self.writer.stop()
+        self.checkpoint()
+        os.close(self.fd)
+        self.fd = None
+
+    def get_statistics(self) -> Dict[str, Any]:
+        """Возвращает размер журнала и сводок"""
+        with self.lock:
+            return {
+                "events": self.offset // self.RECORD.size,
+                "bytes": self.offset,
+                "days": len(self.days),
+                "hours": len(self.hours)
+            }
+
+
+# Кэш file_id для отправляемых файлов
+class FileDeliveryCache:
+    """Хранит file_id, выданные Telegram, чтобы не загружать файл повторно"""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.lock = threading.Lock()
+        # Загрузка одного и того же файла выполняется только одним потоком
+        self.upload_lock = threading.Lock()
+        self.loaded_mtime = self._file_mtime()
+        self.entries: Dict[str, Dict[str, Any]] = self.load_entries()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def load_entries(self) -> Dict[str, Dict[str, Any]]:
+        """Загружает сохраненные file_id из файла"""
+        try:
+            if os.path.exists(self.filename):
+                with open(self.filename, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+        except Exception as e:
+            logger.error("Ошибка загрузки кэша файлов: %s", e)
+        return {}
+
+    def _file_mtime(self) -> Optional[int]:
+        try:
+            return os.stat(self.filename).st_mtime_ns
+        except OSError:
+            return None
+
+    def _reload_if_changed(self) -> bool:
+        """Перечитывает кэш, если его сохранил другой процесс (вызывается под self.lock)"""
+        mtime = self._file_mtime()
+        if mtime == self.loaded_mtime:
+            return False
+        self.loaded_mtime = mtime
+        self.entries = self.load_entries()
+        return True
+
+    def save_entries(self):
+        """Сохраняет кэш file_id в файл"""
+        try:
+            tmp_path = self.filename + ".tmp" + str(os.getpid())
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.filename)
+            self.loaded_mtime = self._file_mtime()
+        except Exception as e:
+            logger.error("Ошибка сохранения кэша файлов: %s", e)
+
+    @staticmethod
+    def cache_key(path: str) -> str:
+        """Ключ кэша: путь относительно DATA_DIR (у версий архива одинаковые имена файлов)"""
+        path = os.path.abspath(path)
+        if path.startswith(os.path.abspath(DATA_DIR) + os.sep):
+            return os.path.relpath(path, DATA_DIR)
+        return os.path.basename(path)
+
+    def get_file_id(self, path: str, record: bool = True) -> Optional[str]:
+        """Возвращает file_id, если файл на диске не изменился с момента загрузки"""
+        key = self.cache_key(path)
+        stat = os.stat(path)
+        with self.lock:
+            entry = self.entries.get(key)
+            if not (entry and entry["mtime"] == stat.st_mtime_ns) and self._reload_if_changed():
+                entry = self.entries.get(key)
+            if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+                if record:
+                    self.hits += 1
+                return entry["file_id"]
+
+        if entry and entry["size"] == stat.st_size:
+            # Файл могли просто перезаписать тем же содержимым - сверяем хэш
+            if file_sha256(path) == entry["sha256"]:
+                with self.lock:
+                    entry["mtime"] = stat.st_mtime_ns
+                    if record:
+                        self.hits += 1
+                    self.save_entries()
+                return entry["file_id"]
+
+        with self.lock:
+            if record:
+                self.misses += 1
+            if entry:
+                self.invalidations += 1
+                self.entries.pop(key, None)
+                self.save_entries()
+                logger.info("Файл %s изменился, кэшированный file_id сброшен", key)
+        return None
+
+    def store(self, path: str, file_id: str):
+        """Запоминает file_id, полученный после загрузки файла"""
+        key = self.cache_key(path)
+        stat = os.stat(path)
+        sha256 = file_sha256(path)
+        with self.lock:
+            self.entries[key] = {
+                "file_id": file_id,
+                "size": stat.st_size,
+                "mtime": stat.st_mtime_ns,
+                "sha256": sha256,
+                "uploaded_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            }
+            self.save_entries()
+        logger.info("Файл %s загружен в Telegram, file_id сохранен", key)
+
+    def invalidate(self, path: str):
+        """Сбрасывает file_id, например если Telegram его больше не принимает"""
+        key = self.cache_key(path)
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.invalidations += 1
+                self.save_entries()
+
+    def get_statistics(self) -> Dict[str, Any]:
+        """Возвращает статистику попаданий в кэш"""
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "cached_files": len(self.entries)
+            }
+
+
+# Нарезка больших архивов на тома
+class ArchiveVolumes:
+    """Делит архив на тома не больше volume_size для отправки через Bot API.
+
+    Тома нарезаются один раз потоковым копированием и лежат в volumes_dir
+    вместе с манифестом, поэтому после перезапуска архив не перечитывается.
+    Пока размер и время изменения архива совпадают с манифестом, повторная
+    нарезка не нужна. Архив, который помещается в один файл, отправляется
+    как есть. Тома - это куски исходного файла (name.001, name.002, ...),
+    их открывают 7-Zip или WinRAR.
+    """
+
+    def __init__(self, volumes_dir: str, volume_size: int):
+        self.volumes_dir = volumes_dir
+        self.volume_size = volume_size
+        self.lock = threading.Lock()
+        self.manifests: Dict[str, Dict[str, Any]] = {}
+        self.splits = 0
+
+    def get_manifest(self, path: str) -> Dict[str, Any]:
+        """Возвращает {"size", "mtime", "volumes": [{"path", "size"}]}, при необходимости нарезая архив"""
+        stat = os.stat(path)
+        with self.lock:
+            manifest = self.manifests.get(path)
+            if manifest is None or manifest["size"] != stat.st_size or manifest["mtime"] != stat.st_mtime_ns:
+                manifest = self._load_or_split(path, stat)
+                self.manifests[path] = manifest
+            return manifest
+
+    def _load_or_split(self, path: str, stat: os.stat_result) -> Dict[str, Any]:
+        manifest = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+        if stat.st_size <= self.volume_size:
+            manifest["volumes"] = [{"path": path, "size": stat.st_size}]
+            return manifest
+
+        name = os.path.basename(path)
+        target_dir = os.path.join(self.volumes_dir, f"{name}-{stat.st_size}-{stat.st_mtime_ns}")
+        manifest_path = os.path.join(target_dir, "manifest.json")
+        if not os.path.exists(manifest_path):
+            self._split(path, stat, target_dir)
+            self._remove_stale(name, target_dir)
+
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            volumes = json.load(f)["volumes"]
+        manifest["volumes"] = [
+            {"path": os.path.join(target_dir, volume["name"]), "size": volume["size"]}
+            for volume in volumes
+        ]
+        return manifest
+
+    def _split(self, path: str, stat: os.stat_result, target_dir: str):
+        """Нарезает архив во временный каталог и атомарно переименовывает его"""
+        started = time.monotonic()
+        name = os.path.basename(path)
+        tmp_dir = f"{target_dir}.tmp{os.getpid()}"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        volumes = []
+        with open(path, 'rb') as src:
+            while True:
+                volume_name = f"{name}.{len(volumes) + 1:03d}"
+                written = 0
+                with open(os.path.join(tmp_dir, volume_name), 'wb') as dst:
+                    while written < self.volume_size:
+                        chunk = src.read(min(UPLOAD_CHUNK_SIZE, self.volume_size - written))
+                        if not chunk:
+                            break
+                        dst.write(chunk)
+                        written += len(chunk)
+                if written == 0:
+                    os.remove(os.path.join(tmp_dir, volume_name))
+                    break
+                volumes.append({"name": volume_name, "size": written})
+                if written < self.volume_size:
+                    break
+
+        current = os.stat(path)
+        if current.st_size != stat.st_size or current.st_mtime_ns != stat.st_mtime_ns:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise RuntimeError(f"Архив {name} изменился во время нарезки")
+
+        with open(os.path.join(tmp_dir, "manifest.json"), 'w', encoding='utf-8') as f:
+            json.dump({"source": name, "size": stat.st_size, "volumes": volumes}, f, ensure_ascii=False, indent=2)
+        try:
+            os.rename(tmp_dir, target_dir)
+        except OSError:
+            # Тот же архив уже нарезал другой процесс
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.splits += 1
+        logger.info(
+            "Архив %s разделен на %s томов за %.1f с", name, len(volumes), time.monotonic() - started
+        )
+
+    def _remove_stale(self, name: str, keep_dir: str):
+        """Удаляет тома прошлых версий архива"""
+        if not os.path.isdir(self.volumes_dir):
+            return
+        for entry in os.listdir(self.volumes_dir):
+            entry_path = os.path.join(self.volumes_dir, entry)
+            if entry.startswith(name + "-") and entry_path != keep_dir and ".tmp" not in entry:
+                shutil.rmtree(entry_path, ignore_errors=True)
+
+
+# Версии распространяемого архива
+class ReleaseManager:
+    """Публикует версии архива и хранит указатель на текущую.
+
+    Исходный архив (ZIP_FILE_PATH) можно заменять на ходу. Наблюдатель
+    watchdog замечает изменение, и фоновый поток дожидается, пока размер
+    и время изменения перестанут меняться, проверяет, что это целый ZIP,
+    копирует его в releases/<версия>/, попутно считая SHA-256, и атомарно
+    переписывает releases/current.json. Версия - начало SHA-256, так что
+    одинаковое содержимое дает ту же версию.
+
+    Пользователям архив отправляется только из неизменяемой копии, поэтому
+    недописанный файл не уйдет, а смена версии не требует перезапуска.
+    Другие процессы замечают новый указатель по времени изменения файла.
+    """
+
+    def __init__(self, source_path: str, releases_dir: str, settle_seconds: float, keep: int):
+        self.source_path = source_path
+        self.releases_dir = releases_dir
+        self.settle_seconds = settle_seconds
+        self.keep = keep
+        self.pointer_file = os.path.join(releases_dir, "current.json")
+        # Публикация выполняется одним потоком за раз
+        self.lock = threading.Lock()
+        self.current: Optional[Dict[str, Any]] = None
+        self.pointer_mtime: Optional[int] = None
+        self.checked_at = 0.0
+        self.published = 0
+        self.rejected = 0
+        self.on_publish: List[Any] = []
+        self.observer = None
+        self.changed = threading.Event()
+        self._stop_event = threading.Event()
+        self._load_pointer()
+
+    def _load_pointer(self):
+        """Читает указатель на текущую версию, если файл версии на месте"""
+        try:
+            self.pointer_mtime = os.stat(self.pointer_file).st_mtime_ns
+            with open(self.pointer_file, 'r', encoding='utf-8') as f:
+                release = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.error("Ошибка чтения указателя версии архива: %s", e)
+            return
+        release["path"] = os.path.join(self.releases_dir, release["version"], release["name"])
+        if os.path.exists(release["path"]):
+            self.current = release
+
+    def get_current(self) -> Optional[Dict[str, Any]]:
+        """Возвращает текущую версию; раз в секунду сверяет указатель на диске"""
+        now = time.monotonic()
+        if now - self.checked_at >= 1:
+            self.checked_at = now
+            try:
+                mtime = os.stat(self.pointer_file).st_mtime_ns
+            except OSError:
+                mtime = None
+            if mtime != self.pointer_mtime:
+                self._load_pointer()
+        return self.current
+
+    def scan(self) -> bool:
+        """Публикует исходный архив, если он отличается от текущей версии"""
+        with self.lock:
+            try:
+                stat = os.stat(self.source_path)
+            except FileNotFoundError:
+                return False
+            current = self.current
+            if current and current["source_size"] == stat.st_size and current["source_mtime"] == stat.st_mtime_ns:
+                return False
+            stat = self._wait_stable(stat)
+            if stat is None:
+                return False
+            if not zipfile.is_zipfile(self.source_path):
+                self.rejected += 1
+                logger.warning("%s не является целым ZIP-архивом, версия не опубликована", self.source_path)
+                return False
+            release = self._publish(stat)
+        if release is None:
+            return False
+        for callback in self.on_publish:
+            callback(release)
+        return True
+
+    def _wait_stable(self, stat: os.stat_result) -> Optional[os.stat_result]:
+        """Ждет, пока файл перестанет меняться; None, если он исчез"""
+        while time.time() - stat.st_mtime_ns / 1e9 < self.settle_seconds:
+            if self._stop_event.wait(self.settle_seconds):
+                return None
+            try:
+                current = os.stat(self.source_path)
+            except FileNotFoundError:
+                return None
+            if current.st_size == stat.st_size and current.st_mtime_ns == stat.st_mtime_ns:
+                break
+            stat = current
+        return stat
+
+    def _publish(self, stat: os.stat_result) -> Optional[Dict[str, Any]]:
+        """Копирует архив в каталог версии и переключает указатель (вызывается под self.lock)"""
+        name = os.path.basename(self.source_path)
+        os.makedirs(self.releases_dir, exist_ok=True)
+        tmp_path = os.path.join(self.releases_dir, f"{name}.tmp{os.getpid()}")
+        digest = hashlib.sha256()
+        with open(self.source_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            for chunk in iter(lambda: src.read(UPLOAD_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                dst.write(chunk)
+        current = os.stat(self.source_path)
+        if current.st_size != stat.st_size or current.st_mtime_ns != stat.st_mtime_ns:
+            # Архив перезаписали во время копирования - дождемся следующего события
+            os.remove(tmp_path)
+            self.changed.set()
+            return None
+
+        sha256 = digest.hexdigest()
+        version = sha256[:12]
+        release_dir = os.path.join(self.releases_dir, version)
+        os.makedirs(release_dir, exist_ok=True)
+        release_path = os.path.join(release_dir, name)
+        if os.path.exists(release_path):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, release_path)
+
+        release = {
+            "version": version,
+            "sha256": sha256,
+            "name": name,
+            "size": stat.st_size,
+            "source_size": stat.st_size,
+            "source_mtime": stat.st_mtime_ns,
+            "published_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }
+        tmp_pointer = f"{self.pointer_file}.tmp{os.getpid()}"
+        with open(tmp_pointer, 'w', encoding='utf-8') as f:
+            json.dump(release, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_pointer, self.pointer_file)
+        self.pointer_mtime = os.stat(self.pointer_file).st_mtime_ns
+
+        previous = self.current
+        release["path"] = release_path
+        self.current = release
+        self.published += 1
+        self._remove_old_releases(version)
+        if previous is None or previous["version"] != version:
+            logger.info("Опубликована версия архива %s (%.2f MB)", version, stat.st_size / (1024 * 1024))
+        return release
+
+    def _remove_old_releases(self, keep_version: str):
+        """Удаляет версии сверх RELEASES_KEEP, начиная с самых старых"""
+        versions = [
+            entry for entry in os.listdir(self.releases_dir)
+            if entry != keep_version and os.path.isdir(os.path.join(self.releases_dir, entry))
+        ]
+        versions.sort(key=lambda entry: os.path.getmtime(os.path.join(self.releases_dir, entry)))
+        for entry in versions[:max(0, len(versions) - (self.keep - 1))]:
+            shutil.rmtree(os.path.join(self.releases_dir, entry), ignore_errors=True)
+
+    def start_watching(self):
+        """Запускает наблюдение за каталогом исходного архива"""
+        if self.observer is not None:
+            return
+        manager = self
+
+        class ArchiveEventHandler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                paths = (event.src_path, getattr(event, "dest_path", ""))
+                if any(os.path.abspath(path) == manager.source_path for path in paths if path):
+                    manager.changed.set()
+
+        self.observer = Observer()
+        self.observer.schedule(ArchiveEventHandler(), os.path.dirname(self.source_path), recursive=False)
+        self.observer.daemon = True
+        self.observer.start()
+        threading.Thread(target=self._watch_loop, daemon=True, name="release-watcher").start()
+        logger.info("Наблюдение за архивом %s запущено", self.source_path)
+
+    def _watch_loop(self):
+        """Публикует архив после того, как события об изменении затихнут"""
+        while not self._stop_event.is_set():
+            self.changed.wait()
+            while self.changed.is_set():
+                self.changed.clear()
+                if self._stop_event.wait(self.settle_seconds):
+                    return
+            try:
+                self.scan()
+            except Exception as e:
+                logger.error("Ошибка публикации архива: %s", e)
+
+    def stop(self):
+        """Останавливает наблюдение"""
+        self._stop_event.set()
+        self.changed.set()
+        if self.observer is not None:
+            self.observer.stop()
+
+    def get_statistics(self) -> Dict[str, Any]:
+        """Возвращает текущую версию и скачивания по версиям"""
+        current = self.get_current()
+        return {
+            "current": {key: value for key, value in current.items() if key != "path"} if current else None,
+            "published": self.published,
+            "rejected": self.rejected,
+            # Пока пользователи загружаются, /health не ждет их ради счетчиков
+            "downloads": user_manager.get_release_downloads() if user_manager.ready else {}
+        }
+
+
+def get_update_chat_id(update: telebot.types.Update) -> Optional[int]:
+    """Возвращает id чата, к которому относится обновление"""
+    for message in (update.message, update.edited_message, update.channel_post,
+                    update.edited_channel_post):
+        if message is not None:
+            return message.chat.id
+    if update.callback_query is not None and update.callback_query.message is not None:
+        return update.callback_query.message.chat.id
+    return None
+
+
+# Очередь входящих обновлений с пулом обработчиков
+class UpdateDispatcher:
+    """Принимает обновления Telegram и обрабатывает их пулом потоков.
+
+    У каждого чата своя очередь, и в работе одновременно не больше одного
+    его обновления, поэтому внутри чата порядок сохраняется. Свободный
+    поток берет следующий чат с ожидающими обновлениями, так что медленная
+    отправка в одном чате не задерживает остальные. Всего в очередях не
+    больше queue_size обновлений.
+
+    Повторно присланные Telegram update_id отбрасываются, в том числе уже
+    принятые соседним процессом (через хранилище).
+    """
+
+    def __init__(self, bot_instance: telebot.TeleBot, workers: int, queue_size: int, dedup_size: int):
+        self.bot = bot_instance
+        self.lock = threading.Lock()
+        self.capacity = queue_size
+        # Очереди чатов, у которых есть ожидающие или обрабатываемые обновления
+        self.chats: Dict[Any, deque] = {}
+        self.depth = 0
+        self.space = threading.Condition(self.lock)
+        # Чаты, готовые к обработке; чат попадает сюда, только если он не в работе
+        self.ready: queue.Queue = queue.Queue()
+        self.seen_updates: OrderedDict = OrderedDict()
+        self.dedup_size = dedup_size
+        self.accepted = 0
+        self.processed = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.failed = 0
+        self.threads = [
+            threading.Thread(target=self._worker, daemon=True, name=f"update-worker-{i}")
+            for i in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, update: telebot.types.Update, on_done=None,
+               timeout: Optional[float] = None, claim: bool = True) -> str:
+        """Ставит обновление в очередь: "accepted", "duplicate" или "rejected".
+
+        on_done(update_id) вызывается после обработки принятого обновления.
+        С timeout submit ждет места в очереди, а не отказывает сразу.
+        claim=False пропускает межпроцессную проверку - для обновлений,
+        которые этот процесс уже принимал до перезапуска.
+        """
+        with self.lock:
+            if update.update_id in self.seen_updates:
+                self.duplicates += 1
+                return "duplicate"
+            # Резервируем update_id сразу, чтобы параллельный повтор не прошел проверку
+            self.seen_updates[update.update_id] = True
+            if len(self.seen_updates) > self.dedup_size:
+                self.seen_updates.popitem(last=False)
+
+        # При нескольких процессах повтор мог прийти в соседний процесс
+        if claim and not user_manager.claim_update(update.update_id):
+            with self.lock:
+                self.duplicates += 1
+            return "duplicate"
+
+        chat_id = get_update_chat_id(update)
+        key = chat_id if chat_id is not None else ("update", update.update_id)
+        with self.lock:
+            if timeout is not None:
+                self.space.wait_for(lambda: self.depth < self.capacity, timeout)
+            if self.depth >= self.capacity:
+                if claim:
+                    user_manager.release_update(update.update_id)
+                self.seen_updates.pop(update.update_id, None)
+                self.rejected += 1
+                return "rejected"
+            self.depth += 1
+            self.accepted += 1
+            updates = self.chats.get(key)
+            if updates is None:
+                # Чат не в работе - сразу отдаем его потокам
+                self.chats[key] = deque([(update, on_done)])
+                self.ready.put(key)
+            else:
+                updates.append((update, on_done))
+        return "accepted"
+
+    def _worker(self):
+        """Обрабатывает по одному обновлению готовых чатов"""
+        while True:
+            key = self.ready.get()
+            if key is None:
+                return
+            with self.lock:
+                update, on_done = self.chats[key][0]
+            try:
+                with logging_context(update_id=update.update_id, chat_id=get_update_chat_id(update)):
+                    try:
+                        self.bot.process_new_updates([update])
+                        with self.lock:
+                            self.processed += 1
+                    except Exception as e:
+                        with self.lock:
+                            self.failed += 1
+                        logger.error("Ошибка обработки обновления %s: %s", update.update_id, e)
+            finally:
+                if on_done is not None:
+                    on_done(update.update_id)
+                with self.lock:
+                    updates = self.chats[key]
+                    updates.popleft()
+                    self.depth -= 1
+                    self.space.notify_all()
+                    # Остальные обновления чата - в конец очереди, чтобы не занимать поток
+                    if updates:
+                        self.ready.put(key)
+                    else:
+                        del self.chats[key]
+
+    def queue_depth(self) -> int:
+        """Возвращает число принятых, но еще не обработанных обновлений"""
+        return self.depth
+
+    def get_statistics(self) -> Dict[str, Any]:
+        """Возвращает состояние очереди обновлений"""
+        with self.lock:
+            return {
+                "workers": len(self.threads),
+                "queue_depth": self.depth,
+                "queue_capacity": self.capacity,
+                "active_chats": len(self.chats),
+                "accepted": self.accepted,
+                "processed": self.processed,
+                "duplicates": self.duplicates,
+                "rejected": self.rejected,
+                "failed": self.failed
+            }
+
+    def stop(self, timeout: float = 10):
+        """Дожидается обработки очереди и останавливает потоки"""
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            self.space.wait_for(lambda: self.depth == 0, timeout)
+        for _ in self.threads:
+            self.ready.put(None)
+        for thread in self.threads:
+            thread.join(max(0, deadline - time.monotonic()))
+
+
+# Опрос Telegram
+class PollingEngine:
+    """Получает обновления через getUpdates и передает их UpdateDispatcher.
+
+    Обновления запрашиваются пачками до batch_size и обрабатываются пулом
+    UpdateDispatcher: внутри чата по порядку, а медленная отправка в одном
+    чате не задерживает остальные.
+
+    Telegram считает пачку доставленной, когда следующий getUpdates приходит
+    с большим offset, поэтому до этого пачка сохраняется в файл состояния
+    вместе с новым offset. Обработанные обновления убираются из файла
+    групповой записью; после перезапуска оставшиеся отправляются в пул
+    заново, а опрос продолжается с сохраненного offset.
+
+    Необработанных обновлений не бывает больше max_pending: пока пул не
+    справился с ними, новые не запрашиваются и остаются у Telegram. Это же
+    ограничивает размер файла состояния.
+
+    После ошибки опрос повторяется через экспоненциально растущую паузу
+    (от backoff_base до backoff_max секунд) со случайным разбросом, чтобы
+    перезапущенные процессы не обращались к API одновременно.
+    """
+
+    def __init__(self, bot_instance: telebot.TeleBot, dispatcher: "UpdateDispatcher", state_file: str,
+                 batch_size: int, poll_timeout: int, backoff_base: float, backoff_max: float,
+                 max_pending: int):
+        self.bot = bot_instance
+        self.dispatcher = dispatcher
+        self.state_file = state_file
+        self.batch_size = batch_size
+        self.poll_timeout = poll_timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_pending = max(max_pending, batch_size)
+        self.lock = threading.Lock()
+        self.drained = threading.Condition(self.lock)
+        self.stop_event = threading.Event()
+        self.offset = 0
+        # Полученные, но еще не обработанные обновления в формате Bot API
+        self.pending: Dict[int, Dict[str, Any]] = {}
+        self.failures = 0
+        self.batches = 0
+        self.fetched = 0
+        self.errors = 0
+        self.resumed = 0
+        self.last_backoff = 0.0
+        # Готовые обновления убираются из файла раз в интервал: повторно после
+        # сбоя обработаются только те, что успели завершиться за это время
+        self.writer = GroupCommitWriter(
+            self.save_state, USERS_FLUSH_INTERVAL_MS, self.max_pending, "polling-state-writer"
+        )
+
+    def load_state(self):
+        """Загружает offset и необработанные обновления прошлого запуска"""
+        try:
+            if os.path.exists(self.state_file):
+                with open(self.state_file, 'r', encoding='utf-8') as f:
+                    state = json.load(f)
+                with self.lock:
+                    self.offset = state.get("offset", 0)
+                    self.pending = {update["update_id"]: update for update in state.get("pending", [])}
+        except Exception as e:
+            logger.error("Ошибка загрузки состояния опроса: %s", e)
+
+    def save_state(self):
+        """Атомарно сохраняет offset и необработанные обновления"""
+        with self.lock:
+            state = {"offset": self.offset, "pending": list(self.pending.values())}
+        tmp_path = self.state_file + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp_path, self.state_file)
+
+    def run(self):
+        """Опрашивает Telegram до вызова stop(); блокирует вызывающий поток"""
+        self.load_state()
+        with self.lock:
+            resumed = sorted(self.pending.values(), key=lambda update: update["update_id"])
+        if resumed:
+            logger.info("Повторная обработка обновлений после перезапуска: %s", len(resumed))
+            self.resumed += len(resumed)
+            for raw in resumed:
+                self._submit(raw, claim=False)
+
+        while not self.stop_event.is_set():
+            with self.lock:
+                # Следующая пачка должна поместиться в окно необработанных
+                if not self.drained.wait_for(
+                        lambda: len(self.pending) + self.batch_size <= self.max_pending, timeout=1):
+                    continue
+            try:
+                updates = telebot.apihelper.get_updates(
+                    self.bot.token, offset=self.offset or None, limit=self.batch_size,
+                    timeout=self.poll_timeout + 10, long_polling_timeout=self.poll_timeout
+                )
+            except Exception as e:
+                self.backoff(e)
+                continue
+            self.failures = 0
+            if updates:
+                self._accept(updates)
+
+    def _accept(self, updates: List[Dict[str, Any]]):
+        """Сохраняет пачку и раздает ее пулу обработки"""
+        with self.lock:
+            for raw in updates:
+                self.pending[raw["update_id"]] = raw
+            self.offset = max(self.offset, updates[-1]["update_id"] + 1)
+            self.batches += 1
+            self.fetched += len(updates)
+        # Следующий getUpdates подтвердит пачку, поэтому она записывается сразу
+        self.writer.mark_dirty(len(updates))
+        self.writer.flush()
+        for raw in updates:
+            self._submit(raw)
+
+    def _submit(self, raw: Dict[str, Any], claim: bool = True):
+        """Передает обновление пулу, дожидаясь места в очереди"""
+        try:
+            update = telebot.types.Update.de_json(raw)
+        except Exception as e:
+            logger.error("Не удалось разобрать обновление %s: %s", raw.get('update_id'), e)
+            self._done(raw["update_id"])
+            return
+        while not self.stop_event.is_set():
+            status = self.dispatcher.submit(update, on_done=self._done, timeout=1, claim=claim)
+            if status == "duplicate":
+                self._done(update.update_id)
+            if status != "rejected":
+                return
+
+    def _done(self, update_id: int):
+        """Убирает обработанное обновление из файла состояния"""
+        with self.lock:
+            self.pending.pop(update_id, None)
+            self.drained.notify()
+        self.writer.mark_dirty()
+
+    def backoff(self, error: Exception):
+        """Ждет перед повтором: экспоненциальная пауза с разбросом"""
+        self.failures += 1
+        self.errors += 1
+        bot_status["error_count"] += 1
+        delay = min(self.backoff_max, self.backoff_base * 2 ** min(self.failures - 1, 30))
+        # Половина паузы фиксирована, вторая половина случайна
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        self.last_backoff = delay
+        logger.error("Ошибка получения обновлений: %s. Повтор через %.1f с", error, delay)
+        self.stop_event.wait(delay)
+
+    def stop(self):
+        """Прекращает опрос; уже принятые обновления дорабатывает UpdateDispatcher"""
+        self.stop_event.set()
+
+    def close(self):
+        """Сохраняет состояние после остановки пула обработки"""
+        self.writer.stop()
+
+    def get_statistics(self) -> Dict[str, Any]:
+        """Возвращает состояние опроса"""
+        with self.lock:
+            return {
+                "offset": self.offset,
+                "pending": len(self.pending),
+                "max_pending": self.max_pending,
+                "batches": self.batches,
+                "fetched": self.fetched,
+                "avg_batch_size": round(self.fetched / self.batches, 2) if self.batches else 0,
+                "resumed": self.resumed,
+                "errors": self.errors,
+                "consecutive_failures": self.failures,
+                "last_backoff_seconds": round(self.last_backoff, 3)
+            }
+
+
+# Рассылка сообщений всем пользователям
+class BroadcastManager:
+    """Рассылает сообщение всем пользователям с сохранением контрольных точек.
+
+    Пользователи читаются из хранилища потоком, порциями по BROADCAST_BATCH,
+    и отправляются пулом потоков с низким приоритетом через планировщик
+    исходящих сообщений. После каждой порции позиция сохраняется в файл,
+    поэтому после падения рассылка продолжается с того же места.
+
+    При нескольких процессах рассылку ведет тот, кто захватил файловую
+    блокировку; остальные только читают ее состояние из файла.
+    """
+
+    def __init__(self, state_file: str):
+        self.state_file = state_file
+        self.lock = threading.Lock()
+        self.process_lock = ProcessLock(state_file + ".lock")
+        self.thread: Optional[threading.Thread] = None
+        self.cancel_event = threading.Event()
+        self.state: Optional[Dict[str, Any]] = self.load_state()
+
+    def load_state(self) -> Optional[Dict[str, Any]]:
+        """Загружает контрольную точку последней рассылки"""
+        try:
+            if os.path.exists(self.state_file):
+                with open(self.state_file, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+        except Exception as e:
+            logger.error("Ошибка загрузки состояния рассылки: %s", e)
+        return None
+
+    def save_state(self):
+        """Атомарно сохраняет контрольную точку (вызывается под self.lock)"""
+        try:
+            tmp_path = self.state_file + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.state, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.state_file)
+        except Exception as e:
+            logger.error("Ошибка сохранения состояния рассылки: %s", e)
+
+    def is_running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, text: str, initiated_by: str) -> Dict[str, Any]:
+        """Запускает новую рассылку; ValueError, если предыдущая еще идет"""
+        with self.lock:
+            if self.is_running() or not self.process_lock.acquire():
+                raise ValueError("Рассылка уже выполняется")
+            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            self.state = {
+                "id": datetime.now().strftime("%Y%m%d%H%M%S"),
+                "text": text,
+                "initiated_by": initiated_by,
+                "status": "running",
+                "cursor": 0,
+                "total": user_manager.get_total_users(),
+                "processed": 0,
+                "sent": 0,
+                "blocked": 0,
+                "failed": 0,
+                "skipped": 0,
+                "started_at": now,
+                "updated_at": now,
+                "finished_at": None
+            }
+            self.save_state()
+            self._launch()
+            return dict(self.state)
+
+    def resume_pending(self):
+        """Продолжает рассылку, прерванную перезапуском процесса"""
+        with self.lock:
+            self.state = self.load_state()
+            if self.state and self.state["status"] == "running" and not self.is_running():
+                if not self.process_lock.acquire():
+                    return
+                logger.info("Продолжаем рассылку %s с позиции %s", self.state['id'], self.state['cursor'])
+                self._launch()
+
+    def cancel(self) -> bool:
+        """Останавливает текущую рассылку после текущей порции"""
+        if not self.is_running():
+            return False
+        self.cancel_event.set()
+        return True
+
+    def _launch(self):
+        self.cancel_event.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True, name="broadcast")
+        self.thread.start()
+
+    def _run(self):
+        state_id = self.state["id"]
+        logger.info("Рассылка %s запущена", state_id)
+        run_started = time.monotonic()
+        processed_at_start = self.state["processed"]
+        try:
+            with ThreadPoolExecutor(max_workers=BROADCAST_WORKERS) as pool:
+                batch: List[Tuple[int, str]] = []
+                for position, user_id in user_manager.iter_user_ids(after=self.state["cursor"]):
+                    batch.append((position, user_id))
+                    if len(batch) >= BROADCAST_BATCH:
+                        self._send_batch(pool, batch, run_started, processed_at_start)
+                        batch = []
+                        if self.cancel_event.is_set():
+                            break
+                if batch and not self.cancel_event.is_set():
+                    self._send_batch(pool, batch, run_started, processed_at_start)
+            status = "cancelled" if self.cancel_event.is_set() else "finished"
+        except Exception as e:
+            # Состояние остается "running" - рассылка продолжится при следующем запуске
+            logger.error("Рассылка %s прервана ошибкой: %s", state_id, e)
+            self.process_lock.release()
+            return
+
+        with self.lock:
+            self.state["status"] = status
+            self.state["finished_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            self.state["eta_seconds"] = 0
+            self.save_state()
+            self.process_lock.release()
+        logger.info("Рассылка %s завершена: %s, отправлено %s", state_id, status, self.state['sent'])
+
+    def _send_batch(self, pool: ThreadPoolExecutor, batch: List[Tuple[int, str]],
+                    run_started: float, processed_at_start: int):
+        """Отправляет порцию и сохраняет контрольную точку"""
+        futures = [pool.submit(self._send_one, user_id, self.state["text"]) for _, user_id in batch]
+        wait(futures)
+        with self.lock:
+            for future in futures:
+                self.state[future.result()] += 1
+            self.state["processed"] += len(batch)
+            self.state["cursor"] = batch[-1][0]
+            self.state["total"] = max(self.state["total"], user_manager.get_total_users())
+            self.state["updated_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            elapsed = time.monotonic() - run_started
+            rate = (self.state["processed"] - processed_at_start) / elapsed if elapsed else 0
+            remaining = max(0, self.state["total"] - self.state["processed"])
+            self.state["rate_per_second"] = round(rate, 2)
+            self.state["eta_seconds"] = round(remaining / rate) if rate else None
+            self.save_state()
+
+    @staticmethod
+    def _send_one(user_id: str, text: str) -> str:
+        """Отправляет сообщение одному пользователю, возвращает итог"""
+        user = user_manager.get_user(user_id)
+        if user is None or user.get("blocked"):
+            return "skipped"
+        try:
+            with outbound_scheduler.priority(PRIORITY_BULK):
+                bot.send_message(int(user_id), text)
+            return "sent"
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code == 403:
+                # Пользователь заблокировал бота или удалил аккаунт
+                user_manager.mark_blocked(user_id)
+                return "blocked"
+            logger.warning("Не удалось отправить рассылку пользователю %s: %s", user_id, e)
+            return "failed"
+        except Exception as e:
+            logger.warning("Не удалось отправить рассылку пользователю %s: %s", user_id, e)
+            return "failed"
+
+    def get_status(self) -> Dict[str, Any]:
+        """Возвращает прогресс и оценку времени до окончания рассылки"""
+        with self.lock:
+            if not self.is_running():
+                # Рассылку мог вести другой процесс
+                self.state = self.load_state()
+            if not self.state:
+                return {"status": "idle"}
+            status = {key: value for key, value in self.state.items() if key != "text"}
+        status["running"] = self.is_running()
+        return status
+
+
+def is_admin(user_id: str) -> bool:
+    """Проверяет, что пользователь Telegram - администратор бота"""
+    return user_id in ADMIN_IDS
+
+
+def is_admin_request() -> bool:
+    """Проверяет токен администратора в HTTP-запросе"""
+    token = request.headers.get("X-Admin-Token", "")
+    # Сравнение за постоянное время не выдает токен по времени ответа
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8"))
+
+
+class LazyService:
+    """Заместитель службы, которая создается в фоне при запуске.
+
+    Обращение к атрибуту ждет, пока служба будет готова, и передается ей,
+    поэтому обработчики пользуются user_manager как обычным объектом.
+    Проверки готовности смотрят на ready и не блокируются. HTTP-запрос не
+    ждет вовсе: поток gunicorn не занимается на время запуска, а клиент
+    получает 503 с Retry-After.
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._instance = None
+        self._ready = threading.Event()
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def set_instance(self, instance):
+        """Подставляет созданную службу и будит ожидающие потоки"""
+        self._instance = instance
+        self._ready.set()
+
+    def __getattr__(self, attr: str):
+        if not self._ready.is_set() and has_request_context():
+            raise ServiceUnavailable(f"Служба {self._name} еще загружается", retry_after=5)
+        if not self._ready.wait(STARTUP_TIMEOUT):
+            raise RuntimeError(f"Служба {self._name} не готова за {STARTUP_TIMEOUT:g} с")
+        return getattr(self._instance, attr)
+
+
+class StartupState:
+    """Этапы фонового запуска и их длительность"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.done = threading.Event()
+        self.stages: Dict[str, float] = {}
+        self.current: Optional[str] = None
+        self.error: Optional[str] = None
+        self.ready_after: Optional[float] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.done.is_set() and self.error is None
+
+    @contextmanager
+    def stage(self, name: str):
+        """Замеряет этап запуска"""
+        self.current = name
+        started = time.monotonic()
+        yield
+        self.stages[name] = round(time.monotonic() - started, 3)
+        self.current = None
+
+    def finish(self, error: Optional[BaseException] = None):
+        """Отмечает окончание запуска (успешное или с ошибкой)"""
+        if error is not None:
+            self.error = f"{self.current}: {error}"
+        self.ready_after = round(time.monotonic() - self.started, 3)
+        self.done.set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Ждет окончания запуска; True, если все этапы прошли успешно"""
+        self.done.wait(timeout)
+        return self.ready
+
+    def get_status(self) -> Dict[str, Any]:
         return {
-            "total_users": self.get_total_users(),
-            "active_today": self.get_active_today(),
-            "total_downloads": sum(user["downloads"] for user in self.users.values()),
-            "last_updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            "ready": self.ready,
+            "stage": self.current,
+            "stages": dict(self.stages),
+            "ready_after": self.ready_after,
+            "error": self.error,
+            "uptime": round(time.monotonic() - self.started, 3)
         }
 
 
-# Инициализация менеджера пользователей
-user_manager = UserManager(USERS_FILE)
+# Хранилища загружаются в initialize_services(), до этого к ним ведут заместители
+user_manager = LazyService("user_manager")
+activity_store = LazyService("activity_store")
+startup = StartupState()
+
+
+def _close_services():
+    """Закрывает хранилища при выходе, если они успели загрузиться"""
+    for service in (activity_store, user_manager):
+        if service.ready:
+            service.close()
+
+
+atexit.register(_close_services)
+file_cache = FileDeliveryCache(FILE_CACHE_PATH)
+archive_volumes = ArchiveVolumes(VOLUMES_DIR, DELIVERY_VOLUME_SIZE)
+update_dispatcher = UpdateDispatcher(bot, UPDATE_WORKERS, UPDATE_QUEUE_SIZE, UPDATE_DEDUP_SIZE)
+polling_engine = PollingEngine(
+    bot, update_dispatcher, POLLING_STATE_FILE, POLL_BATCH_SIZE, POLL_TIMEOUT,
+    POLL_BACKOFF_BASE, POLL_BACKOFF_MAX, POLL_MAX_PENDING
+)
+# atexit вызывает в обратном порядке: опрос прекращается, пул дорабатывает
+# очередь, затем сохраняется состояние опроса
+atexit.register(polling_engine.close)
+atexit.register(update_dispatcher.stop)
+atexit.register(polling_engine.stop)
+broadcast_manager = BroadcastManager(BROADCAST_STATE_FILE)
+leader_lock = ProcessLock(LEADER_LOCK_FILE)
+
+# Метрики процесса и очередей вычисляются в момент опроса /metrics
+process = psutil.Process()
+metrics.gauge("process_resident_memory_bytes", "Resident memory size of the bot process",
+              lambda: process.memory_info().rss)
+# Пока пользователи загружаются, /metrics не ждет их и отдает нули
+metrics.gauge("bot_ready", "1 when startup has finished and storages are loaded",
+              lambda: int(startup.ready))
+metrics.gauge("bot_users_total", "Registered users",
+              lambda: user_manager.get_total_users() if user_manager.ready else 0)
+metrics.gauge("bot_users_active_today", "Users active today",
+              lambda: user_manager.get_active_today() if user_manager.ready else 0)
+metrics.gauge("bot_downloads_total", "Application downloads",
+              lambda: user_manager.get_total_downloads() if user_manager.ready else 0)
+metrics.gauge("bot_update_queue_depth", "Incoming updates waiting for a worker",
+              update_dispatcher.queue_depth)
+metrics.gauge("bot_outbound_queue_depth", "Outbound Telegram requests waiting to be sent",
+              outbound_scheduler.queue_depth)
+metrics.gauge("bot_storage_pending_changes", "User changes not yet flushed to disk",
+              lambda: user_manager.writer.pending if user_manager.ready else 0)
+metrics.counter("bot_updates_duplicate_total", "Updates dropped as duplicates by update_id",
+                func=lambda: update_dispatcher.duplicates)
+metrics.counter("bot_updates_rejected_total", "Webhook updates rejected because the queue was full",
+                func=lambda: update_dispatcher.rejected)
+metrics.counter("bot_file_cache_hits_total", "Sends served by a cached Telegram file_id",
+                func=lambda: file_cache.hits)
+metrics.counter("bot_file_cache_misses_total", "Sends that required uploading the file",
+                func=lambda: file_cache.misses)
+metrics.counter("bot_outbound_retries_total", "Outbound requests retried after 429",
+                func=lambda: outbound_scheduler.retried)
+metrics.counter("bot_errors_total", "Polling loop restarts after an error",
+                func=lambda: bot_status["error_count"])
+metrics.counter("bot_polling_batches_total", "Non-empty getUpdates batches received",
+                func=lambda: polling_engine.batches)
+metrics.gauge("bot_polling_pending_updates", "Polled updates not yet processed",
+              lambda: len(polling_engine.pending))
+
+# Указатель на текущую версию архива читается сразу, изменившийся ZIP-файл
+# публикует процесс-лидер (см. publish_release)
+release_manager = ReleaseManager(
+    os.path.abspath(ZIP_FILE_PATH), RELEASES_DIR, ARCHIVE_SETTLE_SECONDS, RELEASES_KEEP
+)
+atexit.register(release_manager.stop)
+
+
+def initialize_services():
+    """Медленная часть запуска: загрузка хранилищ.
+
+    Выполняется в фоновом потоке, пока веб-сервер уже отвечает на /health.
+    Этапы и их длительность видны в /ready.
+    """
+    try:
+        with startup.stage("users"):
+            user_manager.set_instance(create_user_manager())
+        with startup.stage("activity"):
+            activity_store.set_instance(
+                ActivityStore(ACTIVITY_FILE, ACTIVITY_ROLLUPS_FILE, ACTIVITY_HOURS_KEEP)
+            )
+    except Exception as e:
+        logger.error("Ошибка запуска на этапе %s: %s", startup.current, e)
+        startup.finish(e)
+        return
+    startup.finish()
+    logger.info("Запуск завершен за %.3f с, этапы: %s", startup.ready_after, startup.stages)
+
 
-# Проверка существования ZIP-файла
-if not os.path.exists(ZIP_FILE_PATH):
-    logger.warning(f"ZIP файл не найден по пути: {ZIP_FILE_PATH}")
-    logger.info("Бот будет работать, но функция скачивания недоступна")
-    ZIP_AVAILABLE = False
+if STARTUP_BACKGROUND:
+    threading.Thread(target=initialize_services, daemon=True, name="startup").start()
 else:
-    ZIP_AVAILABLE = True
-    file_size = os.path.getsize(ZIP_FILE_PATH) / (1024 * 1024)  # Размер в МБ
-    logger.info(f"ZIP файл найден. Размер: {file_size:.2f} MB")
+    initialize_services()
 
 
 # Маршруты Flask
-@app.route('/')
-def home():
-    """Главная страница"""
-    stats = user_manager.get_statistics()
-    html = """
+# Шаблон главной страницы компилируется один раз при импорте
+HOME_TEMPLATE_SOURCE = """
     <!DOCTYPE html>
     <html>
     <head>
@@ -314,51 +3642,324 @@ def home():
     </body>
     </html>
     """
-    return render_template_string(
-        html,
-        total_users=stats["total_users"],
-        active_today=stats["active_today"],
-        total_downloads=stats["total_downloads"],
-        last_updated=stats["last_updated"],
-        start_time=bot_status["last_start"] or "Неизвестно",
-        error_count=bot_status["error_count"],
-        zip_available=ZIP_AVAILABLE
-    )
+HOME_TEMPLATE = app.jinja_env.from_string(HOME_TEMPLATE_SOURCE)
+
+
+class DashboardCache:
+    """Хранит отрисованную главную страницу вместе с ее ETag.
+
+    Страница перерисовывается не чаще раза в ttl секунд и не реже: даже
+    без изменений пользователей "активных сегодня" и время обновления
+    должны устаревать не больше чем на ttl. Главная страница обращается
+    к кэшу только после запуска, поэтому get не ждет загрузки хранилищ.
+
+    ETag и время изменения считаются по показанным данным без времени
+    отрисовки: если за ttl ничего не изменилось, клиент с прежним ETag
+    получает 304.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.page: Optional[str] = None
+        self.etag = ""
+        self.last_modified: Optional[datetime] = None
+        self.rendered_at = 0.0
+
+    def get(self) -> Tuple[str, str, datetime]:
+        """Возвращает (html, etag, время изменения), перерисовывая при необходимости"""
+        with self.lock:
+            if self.page is not None and time.monotonic() - self.rendered_at < self.ttl:
+                return self.page, self.etag, self.last_modified
+
+        release = release_manager.get_current()
+        stats = user_manager.get_statistics()
+        data = {
+            "total_users": stats["total_users"],
+            "active_today": stats["active_today"],
+            "total_downloads": stats["total_downloads"],
+            "start_time": bot_status["last_start"] or "Неизвестно",
+            "error_count": bot_status["error_count"],
+            "zip_available": release is not None
+        }
+        page = HOME_TEMPLATE.render(last_updated=stats["last_updated"], **data)
+        etag = hashlib.sha1(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+        with self.lock:
+            self.page = page
+            if etag != self.etag:
+                self.etag = etag
+                self.last_modified = datetime.now(timezone.utc).replace(microsecond=0)
+            self.rendered_at = time.monotonic()
+            return self.page, self.etag, self.last_modified
+
+
+dashboard_cache = DashboardCache(DASHBOARD_CACHE_TTL)
+
+
+@app.route('/')
+def home():
+    """Главная страница"""
+    if not startup.ready:
+        # Статистика появится, когда хранилища загрузятся
+        return 'Starting', 503, {'Retry-After': '5'}
+    page, etag, last_modified = dashboard_cache.get()
+    response = make_response(page)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    # Браузеры и мониторинг каждый раз перепроверяют страницу и получают 304
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 
 @app.route('/health')
 def health():
-    """Проверка здоровья сервиса"""
+    """Проверка здоровья сервиса.
+
+    Отвечает сразу, в том числе во время запуска: сведения о пользователях
+    добавляются, только когда хранилище загружено.
+    """
     health_status = {
-        "status": "healthy",
+        "status": "healthy" if startup.ready else "starting",
+        "ready": startup.ready,
         "bot_running": bot_status["is_running"],
         "timestamp": datetime.now().isoformat(),
-        "zip_file_available": ZIP_AVAILABLE,
-        "users_file_exists": os.path.exists(USERS_FILE),
-        "total_users": user_manager.get_total_users(),
-        "memory_usage": os.path.getsize(USERS_FILE) if os.path.exists(USERS_FILE) else 0
+        "zip_file_available": release_manager.get_current() is not None,
+        "release": release_manager.get_statistics()["current"],
+        "update_queue_depth": update_dispatcher.queue_depth(),
+        "outbound_queue_depth": outbound_scheduler.queue_depth(),
+        "memory_usage": process.memory_info().rss,
+        "pid": os.getpid(),
+        "leader": leader_lock.held
     }
+    if user_manager.ready:
+        health_status.update({
+            "users_file_exists": os.path.exists(user_manager.filename),
+            "total_users": user_manager.get_total_users(),
+            "storage": user_manager.get_persistence_statistics(),
+            "users_file_size": os.path.getsize(user_manager.filename) if os.path.exists(user_manager.filename) else 0
+        })
     return jsonify(health_status), 200
 
 
+@app.route('/ready')
+def ready():
+    """Готовность к обработке обновлений: 503, пока идет запуск"""
+    status = startup.get_status()
+    return jsonify(status), 200 if status["ready"] else 503
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Метрики в текстовом формате Prometheus"""
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
 @app.route('/stats')
 def api_stats():
     """API для получения статистики"""
+    if not startup.ready:
+        return jsonify({"error": "starting"}), 503, {'Retry-After': '5'}
     stats = user_manager.get_statistics()
+    stats["file_cache"] = file_cache.get_statistics()
+    stats["releases"] = release_manager.get_statistics()
+    stats["rate_limiter"] = user_rate_limiter.get_statistics()
+    stats["rate_limiter"]["duplicate_downloads"] = download_cooldown.rejected
+    stats["activity"] = activity_store.get_statistics()
     return jsonify(stats), 200
 
 
+@app.route('/stats/top')
+def api_top_downloaders():
+    """API для получения топа скачивающих"""
+    if not startup.ready:
+        return jsonify({"error": "starting"}), 503, {'Retry-After': '5'}
+    limit = request.args.get('limit', TOP_DOWNLOADERS_DEFAULT, type=int)
+    limit = max(1, min(limit, TOP_DOWNLOADERS_MAX))
+    top = [
+        {"rank": rank, "first_name": name, "downloads": downloads}
+        for rank, (name, downloads) in enumerate(user_manager.get_top_downloaders(limit), 1)
+    ]
+    return jsonify({"limit": limit, "top": top}), 200
+
+
+def parse_history_time(value: Optional[str]) -> Optional[datetime]:
+    """Разбирает границу периода: "YYYY-MM-DD" или "YYYY-MM-DDTHH[:MM]" (локальное время)"""
+    if not value:
+        return None
+    for time_format in ("%Y-%m-%d", "%Y-%m-%dT%H", "%Y-%m-%dT%H:%M", "%Y-%m-%d %H", "%Y-%m-%d %H:%M"):
+        try:
+            return datetime.strptime(value, time_format)
+        except ValueError:
+            continue
+    raise ValueError(f"invalid time: {value}")
+
+
+@app.route('/stats/history')
+def api_stats_history():
+    """История метрики по почасовым или посуточным сводкам"""
+    metric = request.args.get('metric', 'active_users')
+    granularity = request.args.get('granularity', 'day')
+    if not ActivityStore.is_metric(metric):
+        metrics_list = list(ActivityStore.METRICS) + [f"command.{name}" for name in ACTIVITY_COMMANDS]
+        return jsonify({"error": f"unknown metric, expected one of: {', '.join(metrics_list)}"}), 400
+    if granularity not in ("day", "hour"):
+        return jsonify({"error": "granularity must be day or hour"}), 400
+    try:
+        end = parse_history_time(request.args.get('to')) or datetime.now()
+        default_span = timedelta(days=29) if granularity == "day" else timedelta(hours=23)
+        start = parse_history_time(request.args.get('from')) or end - default_span
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if start > end:
+        return jsonify({"error": "from must not be after to"}), 400
+    step = timedelta(days=1) if granularity == "day" else timedelta(hours=1)
+    if (end - start) / step >= ACTIVITY_HISTORY_MAX_POINTS:
+        return jsonify({"error": f"range is limited to {ACTIVITY_HISTORY_MAX_POINTS} points"}), 400
+    if not startup.ready:
+        return jsonify({"error": "starting"}), 503, {'Retry-After': '5'}
+
+    points = activity_store.history(metric, granularity, start, end)
+    return jsonify({
+        "metric": metric,
+        "granularity": granularity,
+        "from": points[0]["t"],
+        "to": points[-1]["t"],
+        "total": sum(point["value"] for point in points),
+        "points": points
+    }), 200
+
+
 @app.route('/webhook', methods=['POST'])
 def webhook():
-    """Webhook для Telegram (опционально)"""
+    """Webhook для Telegram: обновление ставится в очередь, ответ отдается сразу"""
+    if not startup.ready:
+        # Хранилища еще загружаются - Telegram повторит доставку позже
+        return 'Starting', 503, {'Retry-After': '5'}
     if request.headers.get('content-type') == 'application/json':
         json_string = request.get_data().decode('utf-8')
         update = telebot.types.Update.de_json(json_string)
-        bot.process_new_updates([update])
+        if update_dispatcher.submit(update) == "rejected":
+            # Очередь переполнена - Telegram повторит доставку позже
+            return 'Queue is full', 503, {'Retry-After': '1'}
         return ''
     return 'Bad request', 400
 
 
+@app.route('/webhook/stats')
+def webhook_stats():
+    """Состояние очереди входящих обновлений"""
+    return jsonify(update_dispatcher.get_statistics()), 200
+
+
+@app.route('/polling/stats')
+def polling_stats():
+    """Состояние опроса Telegram (BOT_MODE=polling)"""
+    return jsonify(polling_engine.get_statistics()), 200
+
+
+@app.route('/outbound/stats')
+def outbound_stats():
+    """Состояние очереди исходящих сообщений и задержки по методам"""
+    return jsonify(outbound_scheduler.get_statistics()), 200
+
+
+@app.route('/broadcast', methods=['POST'])
+def api_broadcast():
+    """Запуск рассылки всем пользователям (только для админов)"""
+    if not is_admin_request():
+        return jsonify({"error": "forbidden"}), 403
+    payload = request.get_json(silent=True) or {}
+    text = (payload.get("text") or "").strip()
+    if not text:
+        return jsonify({"error": "text is required"}), 400
+    if not startup.ready:
+        return jsonify({"error": "starting"}), 503, {'Retry-After': '5'}
+    try:
+        state = broadcast_manager.start(text, initiated_by="api")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 409
+    return jsonify(state), 202
+
+
+@app.route('/broadcast/status')
+def api_broadcast_status():
+    """Прогресс текущей или последней рассылки"""
+    if not is_admin_request():
+        return jsonify({"error": "forbidden"}), 403
+    return jsonify(broadcast_manager.get_status()), 200
+
+
+@app.route('/broadcast/cancel', methods=['POST'])
+def api_broadcast_cancel():
+    """Остановка текущей рассылки"""
+    if not is_admin_request():
+        return jsonify({"error": "forbidden"}), 403
+    return jsonify({"cancelled": broadcast_manager.cancel()}), 200
+
+
+@app.route('/export/users')
+def api_export_users():
+    """Потоковая выгрузка пользователей в NDJSON или CSV (только для админов).
+
+    cursor - позиция, после которой продолжить, limit - размер страницы
+    (без него выгружается все до конца). Позиция следующей страницы
+    приходит в X-Next-Cursor, а X-Export-Complete: 1 означает, что
+    пользователей дальше нет; с этой позиции потом можно выгрузить только
+    новых пользователей.
+    """
+    if not is_admin_request():
+        return jsonify({"error": "forbidden"}), 403
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": f"format must be one of: {', '.join(EXPORT_FORMATS)}"}), 400
+    cursor = request.args.get('cursor', 0, type=int)
+    limit = request.args.get('limit', type=int)
+    if cursor < 0 or (limit is not None and limit < 1):
+        return jsonify({"error": "cursor must be >= 0 and limit >= 1"}), 400
+    if not startup.ready:
+        return jsonify({"error": "starting"}), 503, {'Retry-After': '5'}
+    end, complete = user_manager.page_end(cursor, limit)
+    response = Response(export_user_lines(fmt, cursor, end), mimetype=EXPORT_FORMATS[fmt])
+    response.headers['X-Next-Cursor'] = str(end)
+    response.headers['X-Export-Complete'] = '1' if complete else '0'
+    response.headers['Content-Disposition'] = f'attachment; filename="users-{cursor}-{end}.{fmt}"'
+    return response
+
+
+@app.route('/import/users', methods=['POST'])
+def api_import_users():
+    """Загрузка пользователей из тела запроса в NDJSON или CSV (только для админов).
+
+    Тело читается построчно и применяется пачками по IMPORT_BATCH_SIZE.
+    Известные пользователи перезаписываются, с skip_existing=1 -
+    пропускаются. Некорректные строки пропускаются и считаются в rejected,
+    первые из них перечислены в errors. Повторная загрузка того же файла
+    безопасна.
+    """
+    if not is_admin_request():
+        return jsonify({"error": "forbidden"}), 403
+    fmt = request.args.get('format') or ('csv' if request.mimetype == 'text/csv' else 'ndjson')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": f"format must be one of: {', '.join(EXPORT_FORMATS)}"}), 400
+    if not startup.ready:
+        return jsonify({"error": "starting"}), 503, {'Retry-After': '5'}
+    overwrite = request.args.get('skip_existing') != '1'
+    lines = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+    started = time.perf_counter()
+    reader = ImportReader(lines, fmt)
+    try:
+        counts = user_manager.import_users(reader, IMPORT_BATCH_SIZE, overwrite)
+    except (UnicodeDecodeError, csv.Error) as e:
+        logger.warning("Импорт пользователей прерван: %s", e)
+        return jsonify({"error": str(e)}), 400
+    counts["rejected"] = reader.rejected
+    logger.info("Импортировано пользователей за %.3f с: %s", time.perf_counter() - started, counts)
+    if reader.errors:
+        logger.warning("Пропущены некорректные строки импорта: %s", "; ".join(reader.errors))
+    counts["errors"] = reader.errors
+    return jsonify(counts), 200
+
+
 @app.route('/restart', methods=['POST'])
 def restart():
     """Перезапуск бота (только для админов)"""
@@ -367,26 +3968,146 @@ def restart():
     return jsonify({"status": "restarting", "timestamp": datetime.now().isoformat()}), 202
 
 
-# Обработчики команд Telegram бота
-@bot.message_handler(commands=['start'])
-def send_welcome(message):
-    """Приветственное сообщение"""
-    user_id = str(message.from_user.id)
-    username = message.from_user.username or "без username"
-    first_name = message.from_user.first_name or ""
-    last_name = message.from_user.last_name or ""
+# Ограничение частоты запросов пользователей
+class _RateWindow:
+    """Времена последних запросов одного ключа"""
+    __slots__ = ("hits", "warned")
 
-    # Добавляем пользователя в базу
-    user_manager.add_user(user_id, username, first_name, last_name)
+    def __init__(self, limit: int):
+        self.hits: deque = deque(maxlen=limit)
+        self.warned = False
+
+
+class SlidingWindowLimiter:
+    """Не больше limit событий за window секунд на ключ (скользящее окно).
+
+    Для каждого ключа хранятся времена последних limit событий, а сами
+    ключи - в OrderedDict с вытеснением давно не появлявшихся, поэтому
+    память ограничена capacity записями при любом числе пользователей.
+    """
+
+    def __init__(self, limit: int, window: float, capacity: int):
+        self.limit = limit
+        self.window = window
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.windows: OrderedDict = OrderedDict()
+        self.allowed = 0
+        self.rejected = 0
+        self.evicted = 0
+
+    def hit(self, key) -> Tuple[bool, bool]:
+        """Учитывает событие; возвращает (разрешено, нужно ли предупредить).
+
+        Предупреждать стоит один раз за серию отказов, чтобы ответы на
+        флуд сами не превращались в поток сообщений.
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.windows.get(key)
+            if entry is None:
+                entry = self.windows[key] = _RateWindow(self.limit)
+                if len(self.windows) > self.capacity:
+                    self.windows.popitem(last=False)
+                    self.evicted += 1
+            else:
+                self.windows.move_to_end(key)
+            if len(entry.hits) < self.limit or now - entry.hits[0] >= self.window:
+                entry.hits.append(now)
+                entry.warned = False
+                self.allowed += 1
+                return True, False
+            self.rejected += 1
+            warn = not entry.warned
+            entry.warned = True
+            return False, warn
+
+    def retry_after(self, key) -> float:
+        """Через сколько секунд ключ снова получит разрешение"""
+        with self.lock:
+            entry = self.windows.get(key)
+            if entry is None or len(entry.hits) < self.limit:
+                return 0.0
+            return max(0.0, entry.hits[0] + self.window - time.monotonic())
+
+    def get_statistics(self) -> Dict[str, Any]:
+        """Возвращает счетчики разрешенных и отклоненных событий"""
+        with self.lock:
+            return {
+                "limit": self.limit,
+                "window_seconds": self.window,
+                "tracked_keys": len(self.windows),
+                "allowed": self.allowed,
+                "rejected": self.rejected,
+                "evicted": self.evicted
+            }
+
+
+user_rate_limiter = SlidingWindowLimiter(USER_RATE_LIMIT, USER_RATE_WINDOW, USER_RATE_TABLE_SIZE)
+download_cooldown = SlidingWindowLimiter(1, DOWNLOAD_COOLDOWN, USER_RATE_TABLE_SIZE)
+
+
+# Метрики обработчиков
+handler_updates = metrics.counter("bot_updates_total", "Processed updates by command", ("command",))
+handler_errors = metrics.counter("bot_handler_errors_total", "Handler exceptions by command", ("command",))
+handler_latency = metrics.histogram(
+    "bot_handler_duration_seconds", "Message handler execution time by command", ("command",)
+)
+handler_throttled = metrics.counter(
+    "bot_throttled_updates_total", "Updates rejected by the per-user rate limiter", ("command",)
+)
+metrics.counter("bot_duplicate_downloads_total", "Repeated /download within the cooldown, served without counting",
+                func=lambda: download_cooldown.rejected)
+metrics.gauge("bot_rate_limiter_tracked_users", "Users tracked by the per-user rate limiter",
+              lambda: len(user_rate_limiter.windows))
+
+
+def instrumented(command: str):
+    """Декоратор: ограничивает частоту, считает вызовы, ошибки и время работы обработчика"""
+    def decorator(handler):
+        updates = handler_updates.labels(command)
+        errors = handler_errors.labels(command)
+        latency = handler_latency.labels(command)
+        throttled = handler_throttled.labels(command)
+
+        @functools.wraps(handler)
+        def wrapper(message):
+            with logging_context(user_id=message.from_user.id, command=command):
+                return handle(message)
+
+        def handle(message):
+            allowed, warn = user_rate_limiter.hit(message.from_user.id)
+            if not allowed:
+                throttled.inc()
+                if warn:
+                    wait_seconds = max(1, round(user_rate_limiter.retry_after(message.from_user.id)))
+                    bot.reply_to(message, f"⏳ Слишком много запросов. Попробуйте через {wait_seconds} с.")
+                logger.warning("Пользователь %s превысил лимит запросов (%s)", message.from_user.id, command)
+                return
+            updates.inc()
+            activity_store.record(ACTIVITY_COMMAND, message.from_user.id, command)
+            started = time.perf_counter()
+            try:
+                return handler(message)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                latency.observe(elapsed)
+                logger.info("Обработана команда %s", command,
+                            extra={"sampled": True, "latency_ms": round(elapsed * 1000, 2)})
+        return wrapper
+    return decorator
 
-    welcome_text = f"""
-👋 Привет, {first_name}!
 
+# Тексты ответов: статические части собираются один раз при импорте
+WELCOME_BODY_TEMPLATE = """
 Я бот для распространения приложения -AltShift-.
 
 📊 Статистика на данный момент:
-• Всего пользователей: {user_manager.get_total_users()}
-• Активных сегодня: {user_manager.get_active_today()}
+• Всего пользователей: {total_users}
+• Активных сегодня: {active_today}
 
 ✨ Доступные команды:
 /start - Приветственное сообщение
@@ -396,44 +4117,160 @@ def send_welcome(message):
 
 📱 Для связи с разработчиком: https://t.me/theEvil429
     """
+
+STATS_TEMPLATE = """
+📈 СТАТИСТИКА БОТА:
+
+👥 Пользователи:
+• Всего зарегистрировано: {total_users}
+• Активных сегодня: {active_today}
+
+📥 Скачивания приложения:
+• Всего скачиваний: {total_downloads}{release_line}
+
+🏆 Топ-{limit} скачивающих:
+{top_downloaders}
+
+📦 Кэш файла приложения:
+• Попаданий: {cache_hits}
+• Промахов: {cache_misses}
+
+🔄 Бот обновлен: {updated_at}
+    """
+
+HELP_TEXT = """
+🆘 ПОМОЩЬ И ИНСТРУКЦИИ
+
+📋 Основные команды:
+/start - Начать работу с ботом
+/stats - Статистика пользователей
+/download - Скачать приложение
+/help - Эта справка
+
+📥 Как установить приложение:
+1. Используйте команду /download
+2. Сохраните архив на компьютер
+3. Распакуйте архив программой WinRAR или 7-Zip
+4. Запустите файл .exe из распакованной папки
+
+⚠️ Возможные проблемы:
+• Антивирус блокирует файл - добавьте в исключения
+• Файл не запускается - установите Microsoft Visual C++ Redistributable
+• Архив поврежден - попробуйте скачать заново
+
+💬 Техническая поддержка:
+По всем вопросам пишите: https://t.me/theEvil429
+
+🌐 Дополнительные ресурсы:
+• GitHub: https://github.com/Fgmod/AltShift-v1.0.0
+    """
+
+TEXT_REPLY_SUFFIX = (
+    "! 👋\n\n"
+    "Я понимаю только команды. Попробуйте:\n"
+    "/start - для начала работы\n"
+    "/help - для получения справки"
+)
+
+
+class ReplyCache:
+    """Кэш полустатических фрагментов ответов.
+
+    Фрагмент (например, блок статистики) строится не чаще раза в ttl
+    секунд и общий для всех пользователей; в ответ подставляется только
+    имя. Так /start не считает статистику на каждое сообщение.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.fragments: Dict[Any, Tuple[float, str]] = {}
+        self.hits = 0
+        self.renders = 0
+
+    def get(self, key, render) -> str:
+        """Возвращает фрагмент по ключу, перестраивая его вызовом render() по истечении ttl"""
+        now = time.monotonic()
+        with self.lock:
+            cached = self.fragments.get(key)
+            if cached is not None and now - cached[0] < self.ttl:
+                self.hits += 1
+                return cached[1]
+        text = render()
+        with self.lock:
+            self.fragments[key] = (now, text)
+            self.renders += 1
+        return text
+
+
+reply_cache = ReplyCache(REPLY_CACHE_TTL)
+
+
+def render_welcome_body() -> str:
+    return WELCOME_BODY_TEMPLATE.format(
+        total_users=user_manager.get_total_users(),
+        active_today=user_manager.get_active_today()
+    )
+
+
+def render_stats(limit: int) -> str:
+    cache_stats = file_cache.get_statistics()
+    release = release_manager.get_current()
+    release_line = ""
+    if release is not None:
+        release_downloads = user_manager.get_release_downloads().get(release["version"], 0)
+        release_line = f"\n• Текущей версии ({release['version']}): {release_downloads}"
+    return STATS_TEMPLATE.format(
+        total_users=user_manager.get_total_users(),
+        active_today=user_manager.get_active_today(),
+        total_downloads=user_manager.get_total_downloads(),
+        release_line=release_line,
+        limit=limit,
+        top_downloaders=get_top_downloaders(limit),
+        cache_hits=cache_stats["hits"],
+        cache_misses=cache_stats["misses"],
+        updated_at=datetime.now().strftime("%d.%m.%Y %H:%M")
+    )
+
+
+# Обработчики команд Telegram бота
+@bot.message_handler(commands=['start'])
+@instrumented("start")
+def send_welcome(message):
+    """Приветственное сообщение"""
+    user_id = str(message.from_user.id)
+    username = message.from_user.username or "без username"
+    first_name = message.from_user.first_name or ""
+    last_name = message.from_user.last_name or ""
+
+    # Добавляем пользователя в базу
+    if user_manager.add_user(user_id, username, first_name, last_name):
+        activity_store.record(ACTIVITY_JOIN, user_id)
+
+    welcome_text = "\n👋 Привет, " + first_name + "!\n" + reply_cache.get("welcome", render_welcome_body)
     bot.reply_to(message, welcome_text)
 
 
 @bot.message_handler(commands=['stats'])
+@instrumented("stats")
 def show_stats(message):
     """Показать статистику пользователей"""
     user_id = str(message.from_user.id)
 
-    if user_id in user_manager.users:
-        user_manager.users[user_id]["last_active"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        user_manager.save_users()
-
-    stats_text = f"""
-📈 СТАТИСТИКА БОТА:
-
-👥 Пользователи:
-• Всего зарегистрировано: {user_manager.get_total_users()}
-• Активных сегодня: {user_manager.get_active_today()}
-
-📥 Скачивания приложения:
-• Всего скачиваний: {sum(user["downloads"] for user in user_manager.users.values())}
+    user_manager.touch(user_id)
 
-🏆 Топ-5 скачивающих:
-{get_top_downloaders()}
+    # /stats 10 - показать топ-10 вместо топа по умолчанию
+    args = message.text.split()[1:]
+    limit = int(args[0]) if args and args[0].isdigit() else TOP_DOWNLOADERS_DEFAULT
+    limit = max(1, min(limit, TOP_DOWNLOADERS_MAX))
 
-🔄 Бот обновлен: {datetime.now().strftime("%d.%m.%Y %H:%M")}
-    """
+    stats_text = reply_cache.get(("stats", limit), lambda: render_stats(limit))
     bot.reply_to(message, stats_text)
 
 
-def get_top_downloaders() -> str:
+def get_top_downloaders(limit: int = TOP_DOWNLOADERS_DEFAULT) -> str:
     """Возвращает строку с топом скачивающих"""
-    top_users = sorted(
-        [(data["first_name"], data["downloads"])
-         for data in user_manager.users.values() if data["downloads"] > 0],
-        key=lambda x: x[1],
-        reverse=True
-    )[:5]
+    top_users = user_manager.get_top_downloaders(limit)
 
     if not top_users:
         return "Пока нет данных о скачиваниях"
@@ -444,25 +4281,82 @@ def get_top_downloaders() -> str:
     return result
 
 
+def send_cached_document(chat_id: int, path: str, caption: str):
+    """Отправляет файл по кэшированному file_id, загружая его только при промахе"""
+    file_id = file_cache.get_file_id(path)
+    if file_id:
+        try:
+            bot.send_document(chat_id, file_id, caption=caption)
+            return
+        except telebot.apihelper.ApiTelegramException as e:
+            logger.warning("Telegram отклонил кэшированный file_id: %s", e)
+            file_cache.invalidate(path)
+
+    with file_cache.upload_lock:
+        # Пока мы ждали, файл мог загрузить другой поток
+        file_id = file_cache.get_file_id(path, record=False)
+        if file_id:
+            bot.send_document(chat_id, file_id, caption=caption)
+            return
+
+        sent = bot.upload_document(chat_id, path, caption=caption)
+        file_cache.store(path, sent.document.file_id)
+
+
+def send_archive(chat_id: int, path: str, caption: str):
+    """Отправляет архив одним файлом или по томам, если он больше лимита загрузки"""
+    volumes = archive_volumes.get_manifest(path)["volumes"]
+    if len(volumes) == 1:
+        send_cached_document(chat_id, volumes[0]["path"], caption)
+        return
+
+    first_volume = os.path.basename(volumes[0]["path"])
+    for index, volume in enumerate(volumes, 1):
+        part_caption = f"📦 Часть {index} из {len(volumes)}"
+        if index == 1:
+            part_caption = (
+                f"{caption.rstrip()}\n\n📚 Архив разделен на части ({len(volumes)} шт.): скачайте все "
+                f"в одну папку и откройте {first_volume} в 7-Zip или WinRAR"
+            )
+        send_cached_document(chat_id, volume["path"], part_caption)
+
+
+def prewarm_archive(path: str):
+    """Заранее нарезает архив и загружает тома в PREWARM_CHAT_ID в фоне"""
+    try:
+        volumes = archive_volumes.get_manifest(path)["volumes"]
+        if not PREWARM_CHAT_ID:
+            return
+        with outbound_scheduler.priority(PRIORITY_BULK):
+            for volume in volumes:
+                with file_cache.upload_lock:
+                    if file_cache.get_file_id(volume["path"], record=False):
+                        continue
+                    sent = bot.upload_document(
+                        int(PREWARM_CHAT_ID), volume["path"], caption=os.path.basename(volume["path"])
+                    )
+                    file_cache.store(volume["path"], sent.document.file_id)
+        logger.info("Архив %s заранее загружен в Telegram: томов %s", os.path.basename(path), len(volumes))
+    except Exception as e:
+        logger.error("Ошибка предварительной загрузки архива: %s", e)
+
+
 @bot.message_handler(commands=['download'])
+@instrumented("download")
 def send_application(message):
     """Отправка ZIP-архива с приложением"""
     user_id = str(message.from_user.id)
 
-    if not ZIP_AVAILABLE:
+    release = release_manager.get_current()
+    if release is None:
         bot.reply_to(message, "❌ Файл приложения временно недоступен. Попробуйте позже.")
         return
 
     bot.send_chat_action(message.chat.id, 'upload_document')
 
     try:
-        file_size_mb = os.path.getsize(ZIP_FILE_PATH) / (1024 * 1024)
-        
-        with open(ZIP_FILE_PATH, 'rb') as zip_file:
-            bot.send_document(
-                message.chat.id,
-                zip_file,
-                caption=f"""
+        file_size_mb = release["size"] / (1024 * 1024)
+        caption = f"""
 📦 Ваше приложение готово к скачиванию!
 
 📝 Инструкция по установки:
@@ -479,9 +4373,18 @@ def send_application(message):
 
 ❓ Проблемы? Пишите: https://t.me/theEvil429
                 """
-            )
+        send_archive(message.chat.id, release["path"], caption)
 
-        user_manager.increment_download(user_id)
+        # Повторное нажатие вскоре после скачивания: файл ушел по file_id,
+        # но скачивание не учитывается и на диск ничего не пишется
+        counted, _ = download_cooldown.hit((user_id, release["version"]))
+        if not counted:
+            logger.info("Пользователь %s повторно запросил приложение, скачивание не учтено", user_id,
+                        extra={"sampled": True})
+            return
+
+        user_manager.increment_download(user_id, release["version"])
+        activity_store.record(ACTIVITY_DOWNLOAD, user_id)
         
         bot.send_message(
             message.chat.id,
@@ -489,86 +4392,161 @@ def send_application(message):
             "Если возникли проблемы со скачиванием, попробуйте команду /download еще раз."
         )
 
-        logger.info(f"Пользователь {user_id} скачал приложение")
+        logger.info("Пользователь %s скачал приложение", user_id, extra={"sampled": True})
 
     except Exception as e:
         error_msg = f"❌ Ошибка при отправке файла: {str(e)}"
         bot.reply_to(message, error_msg)
-        logger.error(f"Ошибка отправки файла пользователю {user_id}: {e}")
+        logger.error("Ошибка отправки файла пользователю %s: %s", user_id, e)
 
 
 @bot.message_handler(commands=['help'])
+@instrumented("help")
 def send_help(message):
     """Помощь и инструкции"""
-    help_text = """
-🆘 ПОМОЩЬ И ИНСТРУКЦИИ
-
-📋 Основные команды:
-/start - Начать работу с ботом
-/stats - Статистика пользователей
-/download - Скачать приложение
-/help - Эта справка
+    bot.reply_to(message, HELP_TEXT)
 
-📥 Как установить приложение:
-1. Используйте команду /download
-2. Сохраните архив на компьютер
-3. Распакуйте архив программой WinRAR или 7-Zip
-4. Запустите файл .exe из распакованной папки
 
-⚠️ Возможные проблемы:
-• Антивирус блокирует файл - добавьте в исключения
-• Файл не запускается - установите Microsoft Visual C++ Redistributable
-• Архив поврежден - попробуйте скачать заново
+@bot.message_handler(commands=['broadcast'])
+@instrumented("broadcast")
+def start_broadcast(message):
+    """Рассылка сообщения всем пользователям (только для админов)"""
+    user_id = str(message.from_user.id)
+    if not is_admin(user_id):
+        # Для остальных команда - обычный текст; лимит и метрики уже учтены этим обработчиком
+        reply_commands_hint(message)
+        return
 
-💬 Техническая поддержка:
-По всем вопросам пишите: https://t.me/theEvil429
+    text = message.text.partition(" ")[2].strip()
+    if text == "status":
+        status = broadcast_manager.get_status()
+        bot.reply_to(message, json.dumps(status, ensure_ascii=False, indent=2))
+        return
+    if not text:
+        bot.reply_to(message, "Использование: /broadcast <текст сообщения> или /broadcast status")
+        return
 
-🌐 Дополнительные ресурсы:
-• GitHub: https://github.com/Fgmod/AltShift-v1.0.0
-    """
-    bot.reply_to(message, help_text)
+    try:
+        state = broadcast_manager.start(text, initiated_by=user_id)
+    except ValueError as e:
+        bot.reply_to(message, f"❌ {e}")
+        return
+    bot.reply_to(message, f"📣 Рассылка {state['id']} запущена для {state['total']} пользователей.\n"
+                          f"Прогресс: /broadcast status")
+    logger.info("Администратор %s запустил рассылку %s", user_id, state['id'])
 
 
 @bot.message_handler(func=lambda message: True)
+@instrumented("text")
 def handle_text(message):
     """Обработка текстовых сообщений"""
-    response = f"Привет, {message.from_user.first_name}! 👋\n\n"
-    response += "Я понимаю только команды. Попробуйте:\n"
-    response += "/start - для начала работы\n"
-    response += "/help - для получения справки"
-    bot.reply_to(message, response)
+    reply_commands_hint(message)
+
+
+def reply_commands_hint(message):
+    """Отвечает подсказкой со списком команд"""
+    bot.reply_to(message, "Привет, " + str(message.from_user.first_name) + TEXT_REPLY_SUFFIX)
 
 
 def run_telegram_bot():
-    """Запуск Telegram бота с автоматическим перезапуском"""
-    while True:
+    """Запуск опроса Telegram: пачки getUpdates обрабатывает пул UpdateDispatcher.
+
+    Ошибки сети и API PollingEngine переживает сам, повторяя запрос с
+    растущей паузой; здесь перехватываются только непредвиденные сбои.
+    """
+    while not polling_engine.stop_event.is_set():
         try:
             bot_status["is_running"] = True
             bot_status["last_start"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            
+
             logger.info("=" * 50)
             logger.info("Запуск Telegram бота...")
-            logger.info(f"Токен: {BOT_TOKEN[:10]}...")
-            logger.info(f"Всего пользователей: {user_manager.get_total_users()}")
-            logger.info(f"ZIP файл доступен: {ZIP_AVAILABLE}")
+            logger.info("Токен: %s...", BOT_TOKEN[:10])
+            logger.info("Всего пользователей: %s", user_manager.get_total_users())
+            logger.info("ZIP файл доступен: %s", release_manager.get_current() is not None)
+            logger.info("Опрос: до %s обновлений за запрос, обработчиков: %s", POLL_BATCH_SIZE, UPDATE_WORKERS)
             logger.info("=" * 50)
 
-            bot.infinity_polling(timeout=60, long_polling_timeout=60, restart_on_change=True)
+            polling_engine.run()
 
         except Exception as e:
-            bot_status["error_count"] += 1
             bot_status["is_running"] = False
-            
-            logger.error(f"Бот упал с ошибкой: {e}")
-            logger.info("Перезапуск через 10 секунд...")
-            time.sleep(10)
+            logger.error("Бот упал с ошибкой: %s", e)
+            polling_engine.backoff(e)
+    bot_status["is_running"] = False
 
 
 def start_bot_in_thread():
-    """Запуск бота в отдельном потоке"""
-    bot_thread = threading.Thread(target=run_telegram_bot, daemon=True)
-    bot_thread.start()
+    """Запуск бота в отдельном потоке.
+
+    При нескольких процессах опрашивать Telegram или регистрировать
+    webhook должен ровно один - тот, кто захватил блокировку лидера.
+    Остальные процессы только обрабатывают входящие /webhook. Лидер
+    дожидается загрузки хранилищ в своем потоке, не задерживая веб-сервер.
+    """
+    if not leader_lock.acquire():
+        bot_status["is_running"] = BOT_MODE == "webhook"
+        logger.info("Процесс %s обслуживает только webhook, лидер - другой процесс", os.getpid())
+        threading.Thread(target=wait_for_leadership, daemon=True, name="leader-election").start()
+        return
+    logger.info("Процесс %s стал лидером", os.getpid())
+    threading.Thread(target=run_leader_services, daemon=True, name="leader").start()
+
+
+def wait_for_leadership():
+    """Ждет, пока лидер завершится и освободит блокировку, и занимает его место"""
+    while True:
+        time.sleep(LEADER_RETRY_INTERVAL)
+        if leader_lock.acquire():
+            logger.info("Процесс %s стал лидером вместо завершившегося", os.getpid())
+            run_leader_services()
+            return
+
+
+def publish_release():
+    """Публикует изменившийся архив; выполняет только лидер.
+
+    Остальные процессы не хешируют архив при каждом запуске, а читают
+    указатель на текущую версию, который записывает лидер.
+    """
+    try:
+        release_manager.scan()
+    except Exception as e:
+        logger.error("Ошибка публикации архива: %s", e)
+    release = release_manager.get_current()
+    if release is None:
+        logger.warning("ZIP файл не найден по пути: %s", ZIP_FILE_PATH)
+        logger.info("Бот будет работать, но функция скачивания недоступна, пока архив не появится")
+    else:
+        file_size = release["size"] / (1024 * 1024)  # Размер в МБ
+        logger.info("ZIP файл найден. Размер: %.2f MB, версия %s", file_size, release['version'])
+
+
+def run_leader_services():
+    """Службы процесса-лидера; запускаются, когда хранилища загружены"""
+    if not startup.wait():
+        logger.error("Запуск не завершен (%s), бот не запущен", startup.error)
+        return
+    publish_release()
+    broadcast_manager.resume_pending()
+    # Новые версии архива публикует и заранее загружает только лидер
+    release_manager.on_publish.append(lambda release: prewarm_archive(release["path"]))
+    release_manager.start_watching()
+    release = release_manager.get_current()
+    if release is not None:
+        threading.Thread(target=prewarm_archive, args=(release["path"],), daemon=True, name="prewarm").start()
+
+    if BOT_MODE == "webhook":
+        # Обновления приходят на /webhook, опрос Telegram не нужен
+        bot.remove_webhook()
+        bot.set_webhook(url=WEBHOOK_URL)
+        bot_status["is_running"] = True
+        bot_status["last_start"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        logger.info("Webhook зарегистрирован: %s", WEBHOOK_URL)
+        return
+
     logger.info("Telegram бот запущен в отдельном потоке")
+    run_telegram_bot()
 
 
 # Запуск приложения
@@ -577,11 +4555,9 @@ if __name__ == "__main__":
     start_bot_in_thread()
     
     # Определяем порт для Render
-    port = 5000
-    
-    # Запускаем Flask сервер
-    logger.info(f"Запуск Flask сервера на порту {port}...")
-    if __name__ == "__main__":
-        start_bot_in_thread()
-        app.run()
+    port = int(os.getenv("PORT", "5000"))
+
+    # Запускаем Flask сервер (для продакшена - gunicorn -c gunicorn.conf.py tgbotAltShift:app)
+    logger.info("Запуск Flask сервера на порту %s...", port)
+    app.run(host=os.getenv("HOST", "127.0.0.1"), port=port)
 
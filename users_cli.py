@@ -0,0 +1,118 @@
+"""Выгрузка и загрузка пользователей работающего бота через HTTP API.
+
+Команды обращаются к /export/users и /import/users с токеном ADMIN_TOKEN,
+поэтому бот не останавливается, а сам скрипт не загружает хранилище и не
+держит пользователей в памяти - данные копируются потоком между ответом
+сервера и файлом.
+
+    python users_cli.py export --format csv --output users.csv
+    python users_cli.py export --cursor 120000 --output new_users.ndjson
+    python users_cli.py import users.csv --skip-existing
+
+Выгрузка идет страницами по --page-size пользователей. Позиция после
+последней страницы печатается в конце: с нее следующая выгрузка отдаст
+только новых пользователей.
+
+Адрес бота берется из BOT_URL (по умолчанию http://127.0.0.1:$PORT).
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+FORMATS = ("ndjson", "csv")
+CONTENT_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default=os.getenv("BOT_URL", f"http://127.0.0.1:{os.getenv('PORT', '5000')}"),
+                        help="адрес веб-сервера бота")
+    parser.add_argument("--token", default=os.getenv("ADMIN_TOKEN", ""), help="токен администратора")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="выгрузить пользователей в файл")
+    export.add_argument("--format", choices=FORMATS, help="формат (по умолчанию - по расширению файла)")
+    export.add_argument("--output", default="-", help="файл выгрузки, '-' - stdout")
+    export.add_argument("--cursor", type=int, default=0, help="позиция, после которой начать")
+    export.add_argument("--page-size", type=int, default=100000, help="пользователей в одном запросе")
+
+    load = commands.add_parser("import", help="загрузить пользователей из файла")
+    load.add_argument("input", help="файл NDJSON или CSV с заголовком")
+    load.add_argument("--format", choices=FORMATS, help="формат (по умолчанию - по расширению файла)")
+    load.add_argument("--skip-existing", action="store_true", help="не перезаписывать известных пользователей")
+    return parser.parse_args()
+
+
+def guess_format(path: str, fmt: str) -> str:
+    return fmt or ("csv" if path.lower().endswith(".csv") else "ndjson")
+
+
+def open_url(args, path: str, params: dict, **kwargs):
+    url = f"{args.url.rstrip('/')}{path}?{urllib.parse.urlencode(params)}"
+    request = urllib.request.Request(url, **kwargs)
+    request.add_header("X-Admin-Token", args.token)
+    try:
+        return urllib.request.urlopen(request)
+    except urllib.error.HTTPError as e:
+        raise SystemExit(f"{e.code} {e.reason}: {e.read().decode('utf-8', 'replace')}")
+
+
+def export_users(args):
+    """Копирует страницы выгрузки в файл, пока сервер не ответит X-Export-Complete: 1"""
+    fmt = guess_format(args.output, args.format)
+    out = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+    cursor, first_page = args.cursor, True
+    try:
+        while True:
+            params = {"format": fmt, "cursor": cursor, "limit": args.page_size}
+            with open_url(args, "/export/users", params) as response:
+                if fmt == "csv" and not first_page:
+                    # Каждая страница CSV начинается с заголовка - в файле он нужен один раз
+                    response.readline()
+                shutil.copyfileobj(response, out, 1024 * 1024)
+                cursor = int(response.headers["X-Next-Cursor"])
+                complete = response.headers["X-Export-Complete"] == "1"
+            first_page = False
+            if complete:
+                break
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+    print(f"Выгрузка завершена, следующая позиция: {cursor}", file=sys.stderr)
+
+
+def import_users(args):
+    """Отправляет файл телом запроса; сервер разбирает его построчно"""
+    fmt = guess_format(args.input, args.format)
+    params = {"format": fmt, "skip_existing": "1" if args.skip_existing else "0"}
+    with open(args.input, "rb") as f:
+        headers = {"Content-Type": CONTENT_TYPES[fmt], "Content-Length": str(os.fstat(f.fileno()).st_size)}
+        with open_url(args, "/import/users", params, data=f, headers=headers, method="POST") as response:
+            counts = json.load(response)
+    print(f"Добавлено: {counts['added']}, обновлено: {counts['updated']}, пропущено: {counts['skipped']}, "
+          f"отклонено: {counts['rejected']}", file=sys.stderr)
+    for error in counts["errors"]:
+        print(f"  {error}", file=sys.stderr)
+
+
+def main():
+    args = parse_args()
+    if not args.token:
+        raise SystemExit("Нужен токен администратора: ADMIN_TOKEN или --token")
+    if args.command == "export":
+        export_users(args)
+    else:
+        import_users(args)
+
+
+if __name__ == "__main__":
+    main()